@@ -1,6 +1,13 @@
 """2d_vis.py: Create a visualization of 2d keypoints
 read in a json file and visualize pose, face and hands
-Paths - should be the folder where Open Pose JSON output was stored"""
+Paths - should be the folder where Open Pose JSON output was stored
+
+usage:
+2d_vis.py path_to_json_dir [path_to_catalog speaker_ids]
+    path_to_catalog: keypoint store or catalog.sqlite (see clip_catalog.py), the folders to visualize are selected from
+    the catalog instead of listing path_to_json_dir
+    speaker_ids: comma separated, only visualize the folders of these speakers, e.g. 1,5
+"""
 
 import json
 import math
@@ -15,6 +22,13 @@ from cv2 import LINE_AA
 import os
 from pathlib import Path
 
+try:
+    from keypoints2text.kp_to_text_real_data.clip_catalog import open_catalog, split_from_path, parse_clip_id
+    from keypoints2text.kp_to_text_real_data.missing_joints import to_float_array
+except ImportError:  # server uses different imports than local
+    from clip_catalog import open_catalog, split_from_path, parse_clip_id
+    from missing_joints import to_float_array
+
 
 class JSONVis:
 
@@ -37,9 +51,16 @@ class JSONVis:
         temp_df = json.load(open(self.path_to_json / self.file))
         if file is not None:
             temp_df = json.load(open(self.path_to_json / file))
-        temp_x_pose = temp_df['people'][0][key][0::3]
-        temp_y_pose = temp_df['people'][0][key][1::3]
-        return [temp_x_pose, temp_y_pose]
+        # joints x (x, y, c), missing joints ("Null", null) -> NaN
+        points = to_float_array(temp_df['people'][0][key]).reshape(-1, 3)
+        return [points[:, 0], points[:, 1]]
+
+    def to_pixels(self, values):
+        """
+        Pixel coordinates of x or y values, missing joints (NaN) become 0 like the joints OpenPose did not detect
+        :return: list of int
+        """
+        return np.nan_to_num(values).astype(int).tolist()
 
     def get_confidence(self, key_file, file=None):
         """
@@ -81,8 +102,8 @@ class JSONVis:
         position from: https://github.com/CMU-Perceptual-Computing-Lab/openpose/blob/master/doc/output.md
         """
 
-        xs = [int(i) for i in points[0]]
-        ys = [int(i) for i in points[1]]
+        xs = self.to_pixels(points[0])
+        ys = self.to_pixels(points[1])
 
         # neck
         cv2.line(frame, (xs[0], ys[0]), (xs[1], ys[1]), self.cl("gray"), 2, LINE_AA)
@@ -144,8 +165,8 @@ class JSONVis:
     def draw_face(self, frame, key, thickness):
         points = self.get_points(key)
 
-        xs = [int(i) for i in points[0]]
-        ys = [int(i) for i in points[1]]
+        xs = self.to_pixels(points[0])
+        ys = self.to_pixels(points[1])
         poly = np.array([xs, ys]).T.tolist()
 
         # face shape
@@ -184,8 +205,8 @@ class JSONVis:
         finger_confidence = {}
 
         # obtain joint positions
-        xs = [int(i) for i in points[0]]
-        ys = [int(i) for i in points[1]]
+        xs = self.to_pixels(points[0])
+        ys = self.to_pixels(points[1])
         poly = np.array([xs, ys]).T.tolist()
 
         # Fill dictionary with finger joint points, used this points
@@ -246,12 +267,9 @@ class JSONVis:
         else:
             return frame
 
-    def draw_main(self, path_to_json_dir):
-        # get subdirectories of the path
-        os.walk(path_to_json_dir)
-        subdirectories = [x[1] for x in os.walk(path_to_json_dir)]
+    def draw_main(self, path_to_json_dir, path_to_catalog="", speaker_ids=None):
         data_dir_origin = Path(path_to_json_dir)
-        subdirectories = subdirectories[0]
+        subdirectories = self.get_folders(data_dir_origin, path_to_catalog, speaker_ids)
 
         # create new target directory, the centralized fiels will be saved there
         if not os.path.exists(data_dir_origin.parent / str(data_dir_origin.name + "_visualized")):
@@ -271,6 +289,24 @@ class JSONVis:
             self.draw()
             print("%s done" % subdir)
 
+    def get_folders(self, path_to_json_dir, path_to_catalog="", speaker_ids=None):
+        """
+        Folders to visualize, selected from the clip catalog if there is one
+        :param path_to_json_dir: directory containing one folder per clip
+        :param path_to_catalog: keypoint store or catalog.sqlite, "" lists path_to_json_dir
+        :param speaker_ids: only folders of these speakers, None for all
+        :return: list of folder names
+        """
+        catalog = open_catalog(path_to_catalog) if path_to_catalog else None
+        if catalog is None:
+            subdirectories = next(os.walk(path_to_json_dir))[1]
+            if speaker_ids is not None:
+                subdirectories = [subdir for subdir in subdirectories if parse_clip_id(subdir)[2] in speaker_ids]
+            return subdirectories
+        with catalog:
+            return [subdir for subdir in catalog.clip_ids(split_from_path(path_to_json_dir), speaker_ids)
+                    if os.path.isdir(path_to_json_dir / subdir)]
+
     def draw(self):
         fourcc = cv2.VideoWriter_fourcc(*'MP42')
         video = cv2.VideoWriter(str(self.path_to_output / 'json_vis.avi'), fourcc, float(self.FPS), (self.width, self.height))
@@ -437,9 +473,16 @@ if __name__ == '__main__':
         path_to_json_dir = sys.argv[1]
     else:
         path_to_json_dir = r"C:\Users\Asdf\Downloads\How2Sign_samples\openpose_output\json"
+    path_to_catalog = ""
+    if len(sys.argv) > 2:
+        path_to_catalog = sys.argv[2]
+
+    speaker_ids = None
+    if len(sys.argv) > 3:
+        speaker_ids = [int(speaker_id) for speaker_id in sys.argv[3].split(",")]
     vis = JSONVis(width, height, FPS)
     start_time = time.time()
-    vis.draw_main(path_to_json_dir)
+    vis.draw_main(path_to_json_dir, path_to_catalog, speaker_ids)
 
     print("--- %s seconds ---" % (time.time() - start_time))
 
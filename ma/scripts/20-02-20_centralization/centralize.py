@@ -8,6 +8,9 @@ Pose
 Face & Hands    -> Use all
 Set all other keypoints (legs) to none
 
+Missing joints (0 in the OpenPose output) and the legs are missing (NaN in the store, null in json), see
+missing_joints.py
+
 Take Keypoint: Pose[0] as "zero" and subtract all ponts from that point, e.g.
     X_n (X coordinate of neck)
     Y_n (Y coordinate of neck)
@@ -17,6 +20,15 @@ Take Keypoint: Pose[0] as "zero" and subtract all ponts from that point, e.g.
 
 Finally set X_n, Y_n to 0
 
+output_format:
+    "store" (default): each clip folder (or archive, see save_files.py) is read at once, centralized as one array and
+        written into a keypoint store as one chunk per clip, with catalog.sqlite. Missing joints are NaN.
+    "json": debugging only, one centralized json file per frame in the layout of the json directory
+
+usage:
+centralize.py path_to_json_dir [path_to_target_dir] [output_format] [encoding]
+    path_to_target_dir: default <path_to_json_dir>_centralized
+    encoding: float32 (default) or float16 for "store"
 """
 
 import json
@@ -24,19 +36,36 @@ import os
 import sys
 import time
 from pathlib import Path
+import numpy as np
+
+try:
+    from keypoints2text.kp_to_text_real_data.missing_joints import centralize_keypoints, keypoints_from_person, \
+        set_person_keypoints
+    from keypoints2text.kp_to_text_real_data.keypoint_store import ShardWriter, read_clip_source, is_clip_archive, \
+        is_keypoint_store, clip_id_from_source
+    from keypoints2text.kp_to_text_real_data.clip_catalog import ClipCatalog, clip_row, catalog_path, split_from_path
+except ImportError:  # server uses different imports than local
+    from missing_joints import centralize_keypoints, keypoints_from_person, set_person_keypoints
+    from keypoint_store import ShardWriter, read_clip_source, is_clip_archive, is_keypoint_store, clip_id_from_source
+    from clip_catalog import ClipCatalog, clip_row, catalog_path, split_from_path
+
+OUTPUT_FORMATS = ("store", "json")
 
 
 class Centralize:
 
-    def __init__(self, path_to_json_dir, path_to_target_dir):
+    def __init__(self, path_to_json_dir, path_to_target_dir, output_format="store", encoding="float32"):
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError("Unknown output format %s, use one of %s" % (output_format, ", ".join(OUTPUT_FORMATS)))
+        if encoding == "int16":
+            raise ValueError("int16 stores can not hold missing joints (NaN), use float32 or float16")
         self.path_to_json = path_to_json_dir
         self.path_to_target_dir = path_to_target_dir
+        self.output_format = output_format
+        self.encoding = encoding
 
     def centralize(self):
-        # get subdirectories of the path
-        subdirectories = [x[1] for x in os.walk(self.path_to_json)]
         data_dir_origin = Path(self.path_to_json)
-        subdirectories = subdirectories[0]
 
         # create new target directory, the files will be saved there
         if self.path_to_target_dir == "":
@@ -44,6 +73,43 @@ class Centralize:
         else:
             data_dir_target = Path(self.path_to_target_dir)
 
+        if self.output_format == "json":
+            self.centralize_json(data_dir_origin, data_dir_target)
+        else:
+            self.centralize_store(data_dir_origin, data_dir_target)
+        return data_dir_target
+
+    def centralize_store(self, data_dir_origin, data_dir_target):
+        """
+        Write the centralized clips into a new keypoint store, one write per clip instead of one file per frame
+        :param data_dir_origin: json directory, one folder or archive per clip
+        :param data_dir_target: directory of the new store, must not be a store already
+        """
+        if is_keypoint_store(data_dir_target):
+            raise ValueError("%s is a keypoint store already" % data_dir_target)
+        with os.scandir(data_dir_origin) as entries:
+            sources = sorted(entry.name for entry in entries if entry.is_dir() or is_clip_archive(entry.name))
+
+        split = split_from_path(data_dir_origin)
+        shard_writer = ShardWriter(data_dir_target, self.encoding)
+        catalog_rows = []
+        with shard_writer.new_shard() as writer:
+            for source in sources:
+                keypoints = read_clip_source(data_dir_origin / source)[0]
+                clip_id = clip_id_from_source(source)
+                catalog_rows.append(clip_row(clip_id, keypoints, split, writer.path_to_store.name, writer.num_frames))
+                writer.add_clip(clip_id, centralize_keypoints(keypoints))
+                print("%s done" % source)
+        shard_writer.commit(writer)
+        with ClipCatalog(catalog_path(data_dir_target)) as catalog:
+            catalog.add_clips(catalog_rows)
+
+    def centralize_json(self, data_dir_origin, data_dir_target):
+        """Debugging output: write each centralized frame as its own json file, missing joints are null"""
+        # get subdirectories of the path
+        subdirectories = [x[1] for x in os.walk(data_dir_origin)]
+        subdirectories = subdirectories[0]
+
         # create new target directory, the fils will be saved there
         if not os.path.exists(data_dir_target):
             os.makedirs(data_dir_target)
@@ -52,102 +118,17 @@ class Centralize:
             if not os.path.exists(data_dir_target / subdir):
                 os.makedirs(data_dir_target / subdir)
 
-        # used keys of openpose here
-        keys = ['pose_keypoints_2d', 'face_keypoints_2d', 'hand_left_keypoints_2d', 'hand_right_keypoints_2d']
-        folder_keys = {'pose_keypoints_2d': [], 'face_keypoints_2d': [], 'hand_left_keypoints_2d': [],
-                       'hand_right_keypoints_2d': []}
-
         for subdir in subdirectories:
             json_files = [pos_json for pos_json in os.listdir(data_dir_origin / subdir)
                           if pos_json.endswith('.json')]
 
-            all_files = {}
-
-            # load files from one folder into dictionary
+            # centralize each file of the folder
             for file in json_files:
                 temp_df = json.load(open(data_dir_origin / subdir / file))
-                # print(temp_df)
-                all_files[file] = {}
-                once = 1
-                # init dictionaries & write x, y values into dictionary
-                for k in keys:
-                    all_files[file][k] = {'x': [], 'y': []}
-                    all_files[file][k]['x'].append(temp_df['people'][0][k][0::3])
-                    all_files[file][k]['y'].append(temp_df['people'][0][k][1::3])
-                    temp_c = temp_df['people'][0][k][2::3]
-                    results_x = []
-                    results_y = []
-                    x_in_key = all_files[file][k]['x'][0]
-                    y_in_key = all_files[file][k]['y'][0]
-
-                    # set neck once
-                    if once == 1:
-                        neck_zero_x = all_files[file][k]['x'][0][0]
-                        neck_zero_y = all_files[file][k]['y'][0][0]
-                        once = 0
-
-                    # compute for pose
-                    if k == "pose_keypoints_2d":
-                        results_x.append(0)
-                        results_y.append(0)
-                        # start with 1 -> element 0 is neck
-                        # get upper body
-                        for idx in range(1, len(x_in_key[:9])):
-                            if x_in_key[idx] == 0:
-                                results_x.append('Null')
-                            else:
-                                results_x.append(neck_zero_x - x_in_key[idx])
-
-                            if y_in_key[idx] == 0:
-                                results_y.append("Null")
-                            else:
-                                results_y.append(neck_zero_y - y_in_key[idx])
-
-                        # add Null as legs
-                        results_x += (['Null'] * 6)
-                        results_y += (['Null'] * 6)
-
-                        for idx in range(15, len(x_in_key[:19])):
-                            if x_in_key[idx] == 0:
-                                results_x.append('Null')
-                            else:
-                                results_x.append(neck_zero_x - x_in_key[idx])
-
-                            if y_in_key[idx] == 0:
-                                results_y.append("Null")
-                            else:
-                                results_y.append(neck_zero_y - y_in_key[idx])
-
-                        # add more legs
-                        results_x += (['Null'] * 6)
-                        results_y += (['Null'] * 6)
-
-                        values = []
-                        for index in range(len(temp_c)):
-                            values.append(results_x[index])
-                            values.append(results_y[index])
-                            values.append(temp_c[index])
-                        temp_df['people'][0][k] = values
-                    else:
-                        # start with 1 -> element 0 is neck
-                        # get upper body
-                        for idx in range(0, len(x_in_key)):
-                            if x_in_key[idx] == 0:
-                                results_x.append('Null')
-                            else:
-                                results_x.append(neck_zero_x - x_in_key[idx])
-
-                            if y_in_key[idx] == 0:
-                                results_y.append("Null")
-                            else:
-                                results_y.append(neck_zero_y - y_in_key[idx])
-
-                        values = []
-                        for index in range(len(temp_c)):
-                            values.append(results_x[index])
-                            values.append(results_y[index])
-                            values.append(temp_c[index])
-                        temp_df['people'][0][k] = values
+                keypoints = keypoints_from_person(temp_df['people'][0], np.float64)
+                centralized = centralize_keypoints(keypoints[np.newaxis], dtype=np.float64)[0]
+                # missing joints are written as null
+                set_person_keypoints(temp_df['people'][0], centralized, for_json=True)
 
                 # ## Save our changes to JSON file
                 jsonFile = open(data_dir_target / subdir / file, "w+")
@@ -168,7 +149,17 @@ if __name__ == '__main__':
     if len(sys.argv) > 2:
         path_to_target_dir = sys.argv[2]
 
-    norm = Centralize(path_to_json_dir, path_to_target_dir)
+    # "store" or "json" (debugging)
+    output_format = "store"
+    if len(sys.argv) > 3:
+        output_format = sys.argv[3]
+
+    # encoding of the keypoint store
+    encoding = "float32"
+    if len(sys.argv) > 4:
+        encoding = sys.argv[4]
+
+    norm = Centralize(path_to_json_dir, path_to_target_dir, output_format, encoding)
     start_time = time.time()
     norm.centralize()
     print("--- %s seconds ---" % (time.time() - start_time))
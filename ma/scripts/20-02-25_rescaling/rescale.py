@@ -1,258 +1,266 @@
-"""rescale.py: rescale skeletons towards a mean and draw new
-
-Get one video / folder from each UID
-train: 1,2,3,4,5,8,9,11
-val: 1,2,3,5,8
-test: 1,2,3,5,8,10
-
-- compute mean length of each limb
-
-
+"""rescale.py: rescale the skeletons of all speakers towards the mean limb lengths and write them into a keypoint store
+
+limbs.json holds the joint pairs (parent, child) of each OpenPose key as a tree, parents before children:
+    pose    from the neck (pose 1) over the head and the arms, the legs are not rescaled
+    face    from the nose tip (face 30), moved along with the nose (pose 0)
+    hands   from the wrist (hand 0) along the fingers, moved along with the wrists (pose 4 and 7)
+
+- compute the length of every limb in all frames of a clip at once, a limb is missing if one of its joints is
+  missing (0 or NaN)
+- mean length of each limb per speaker (catalog.sqlite, otherwise the folder name), one process per speaker
+- target length of each limb: mean of the speaker means, every speaker counts the same
+- keep the angles of the limbs and redraw each skeleton from its root with the target lengths, one numpy operation per
+  level of the tree for all frames of a clip
+- output: new keypoint store, limb_lengths.json with the mean lengths of the speakers and the targets
+
+Joints which can not be redrawn (the joint or its parent is missing) keep their values, the confidence is kept.
+
+usage:
+rescale.py path_to_store path_to_target_store [num_workers] [clips_per_speaker] [path_to_limbs]
+    num_workers: amount of processes, default 1
+    clips_per_speaker: compute the means from the first clips of each speaker only, default all clips
+    path_to_limbs: joint pair table, default limbs.json next to this script
 """
 
 import json
-import math
 import os
 import sys
 import time
+from multiprocessing import Pool
 from pathlib import Path
+import numpy as np
+
+try:
+    from keypoints2text.kp_to_text_real_data.keypoint_store import open_store, is_keypoint_store, key_slices, \
+        ShardWriter, shard_entry, KEYS
+    from keypoints2text.kp_to_text_real_data.keypoint_stats import part_range, null_list
+    from keypoints2text.kp_to_text_real_data.normalization_stats import clip_groups
+except ImportError:  # server uses different imports than local
+    from keypoint_store import open_store, is_keypoint_store, key_slices, ShardWriter, shard_entry, KEYS
+    from keypoint_stats import part_range, null_list
+    from normalization_stats import clip_groups
+
+LIMBS_FILE = Path(__file__).resolve().parent / "limbs.json"
+
+
+class Limbs:
+    """
+    Joint pair table of limbs.json with joint indexes of the keypoint store (137 joints)
+    usage:
+        limbs = Limbs()
+        lengths = limbs.lengths(keypoints)  # (frames, limbs)
+        rescaled = limbs.retarget(keypoints, target_lengths)
+    """
+
+    def __init__(self, path_to_limbs=LIMBS_FILE):
+        with open(path_to_limbs) as f:
+            table = json.load(f)
+        slices = key_slices()
+        self.names = []
+        parents = []
+        children = []
+        # one stage per key: (root, anchor or None, list of (parents, children, limb indexes) per level of the tree)
+        self.stages = []
+        for k in KEYS:
+            if k not in table:
+                continue
+            offset = slices[k].start
+            entry = table[k]
+            root = offset + entry["root"]
+            anchor = None
+            if "anchor" in entry:
+                anchor_key, anchor_joint = entry["anchor"]
+                anchor = slices[anchor_key].start + anchor_joint
+            depth = {root: 0}
+            levels = {}
+            for parent, child in entry["limbs"]:
+                if offset + parent not in depth or offset + child in depth:
+                    raise ValueError("Limbs of %s are not a tree from joint %d in parent order: %d-%d" %
+                                     (k, entry["root"], parent, child))
+                depth[offset + child] = depth[offset + parent] + 1
+                levels.setdefault(depth[offset + child], []).append(len(parents))
+                self.names.append("%s %d-%d" % (k, parent, child))
+                parents.append(offset + parent)
+                children.append(offset + child)
+            self.stages.append((root, anchor, [np.asarray(levels[level]) for level in sorted(levels)]))
+        self.parents = np.asarray(parents)
+        self.children = np.asarray(children)
+
+    def __len__(self):
+        return len(self.names)
+
+    def lengths(self, keypoints):
+        """
+        Length of every limb in every frame
+        :param keypoints: array (frames, 137, 3)
+        :return: float64 array (frames, limbs), NaN where one of the joints of the limb is missing
+        """
+        xy = np.asarray(keypoints, dtype=np.float64)[:, :, :2]
+        valid = valid_joints(xy)
+        lengths = np.hypot(*np.moveaxis(xy[:, self.children] - xy[:, self.parents], -1, 0))
+        lengths[~(valid[:, self.children] & valid[:, self.parents])] = np.nan
+        return lengths
+
+    def retarget(self, keypoints, target_lengths):
+        """
+        Redraw the skeletons with the target lengths, the angles of the limbs are kept. Roots stay in place, anchored
+        roots (face, hands) are moved along with their anchor joint.
+        :param keypoints: array (frames, 137, 3)
+        :param target_lengths: array (limbs,), NaN keeps the length of the limb
+        :return: float32 array (frames, 137, 3)
+        """
+        keypoints = np.asarray(keypoints)
+        xy = keypoints[:, :, :2].astype(np.float64)
+        valid = valid_joints(xy)
+        rescaled = xy.copy()
+        for root, anchor, levels in self.stages:
+            if anchor is not None:
+                shift = np.where(valid[:, anchor, None], rescaled[:, anchor] - xy[:, anchor], 0.0)
+                rescaled[:, root] = np.where(valid[:, root, None], xy[:, root] + shift, xy[:, root])
+            for limbs in levels:
+                parents = self.parents[limbs]
+                children = self.children[limbs]
+                direction = xy[:, children] - xy[:, parents]
+                length = np.hypot(direction[..., 0], direction[..., 1])
+                target = np.where(np.isnan(target_lengths[limbs]), length, target_lengths[limbs])
+                usable = valid[:, children] & valid[:, parents] & (length > 0)
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    placed = rescaled[:, parents] + direction * (target / length)[..., None]
+                rescaled[:, children] = np.where(usable[..., None], placed, xy[:, children])
+        result = keypoints.astype(np.float32)
+        result[:, :, :2] = rescaled
+        return result
+
+
+def valid_joints(xy):
+    """True for joints which are neither missing (x and y 0) nor NaN, xy: array (..., joints, 2)"""
+    return np.isfinite(xy).all(axis=-1) & (xy != 0).any(axis=-1)
+
+
+def speaker_limb_sums(args):
+    """
+    Sum and count of the lengths of each limb over the clips of one speaker, runs in the worker processes
+    :param args: (path to store, speaker, clip indexes, path to limbs.json)
+    :return: speaker, sums (limbs,), counts (limbs,)
+    """
+    path_to_store, speaker, indexes, path_to_limbs = args
+    store = open_store(path_to_store)
+    limbs = Limbs(path_to_limbs)
+    sums = np.zeros(len(limbs), dtype=np.float64)
+    counts = np.zeros(len(limbs), dtype=np.int64)
+    for idx in indexes:
+        lengths = limbs.lengths(store.get_clip_by_index(idx))
+        sums += np.nansum(lengths, axis=0)
+        counts += np.isfinite(lengths).sum(axis=0)
+    return speaker, sums, counts
+
+
+def rescale_clip_range(args):
+    """
+    Rescale the clips start <= idx < stop of a store into a new shard, runs in the worker processes
+    :param args: (path to store, path to target store, shard name, start, stop, target lengths, path to limbs.json)
+    :return: manifest entry of the shard
+    """
+    path_to_store, path_to_target, name, start, stop, target_lengths, path_to_limbs = args
+    store = open_store(path_to_store)
+    clip_ids = store.keys()
+    limbs = Limbs(path_to_limbs)
+    with ShardWriter(path_to_target).new_shard(name) as writer:
+        for idx in range(start, stop):
+            writer.add_clip(clip_ids[idx], limbs.retarget(store.get_clip_by_index(idx), target_lengths))
+    return shard_entry(writer)
 
 
 class Rescale:
 
-    def __init__(self, path_to_json_dir, path_to_target_dir, path_to_train, path_to_test, path_to_val):
-        self.path_to_json = Path(path_to_json_dir)
+    def __init__(self, path_to_store, path_to_target_dir, num_workers=1, clips_per_speaker=None,
+                 path_to_limbs=LIMBS_FILE):
+        """
+        :param path_to_store: (sharded) keypoint store
+        :param path_to_target_dir: directory of the new store, must not be a store already
+        :param num_workers: amount of processes
+        :param clips_per_speaker: compute the means from the first clips of each speaker only, None uses all clips
+        :param path_to_limbs: joint pair table
+        """
+        self.path_to_store = Path(path_to_store)
         self.path_to_target_dir = Path(path_to_target_dir)
-        self.path_to_train = Path(path_to_train)
-        self.path_to_val = Path(path_to_val)
-        self.path_to_test = Path(path_to_test)
-
-    def rescale(self):
-        speakers_train = [1,2,3,4,5,8,9,11]
-        speakers_val = [1,2,3,5,8]
-        speakers_test = [1,2,3,5,8,10]
-        keys = ['pose_keypoints_2d', 'face_keypoints_2d', 'hand_left_keypoints_2d', 'hand_right_keypoints_2d']
-
-        speakers_train = self.get_folders(self.path_to_train, speakers_train)
-        speakers_val = self.get_folders(self.path_to_val, speakers_val)
-        speakers_test = self.get_folders(self.path_to_test, speakers_test)
-
-        print(speakers_train)
-        print(speakers_val)
-        print(speakers_test)
-
-        # obtaining the specific folders
-        # TODO: use all obtained folders and their keypoint files to calculate mean limb lengths
-
-        for subdir in speakers_train:
-            current_subdir = self.path_to_train / subdir
-            json_files = [pos_json for pos_json in os.listdir(current_subdir)
-                          if pos_json.endswith('.json')]
-
-            all_files = {}
-            # load files from one folder into dictionary
-            for file in json_files:
-                temp_df = json.load(open(current_subdir / file))
-                for k in keys:
-                    all_files[file][k] = {'x': [], 'y': []}
-                    all_files[file][k]['x'].append(temp_df['people'][0][k][0::3])
-                    all_files[file][k]['y'].append(temp_df['people'][0][k][1::3])
-
-                    x_in_key = all_files[file][k]['x'][0]
-                    y_in_key = all_files[file][k]['y'][0]
-                    # get limbs
-                    self.dist((x_in_key[0], x_in_key[1]), (y_in_key[0], y_in_key[1]))
-
+        self.num_workers = num_workers
+        self.clips_per_speaker = clips_per_speaker
+        self.path_to_limbs = Path(path_to_limbs)
+        self.limbs = Limbs(path_to_limbs)
 
+    def mean_limb_lengths(self):
         """
-        Build pose: right arm is the person's right arm. not the viwer's right arm:
-        [0-1]:          neck
-        [1-4]:          right arm
-        [1-5,6,7]:      left arm
-        [1-8]:          back
-        [8-11]:         right leg
-        [8-12,13,14]:   left leg
-        [24, 11, 22, 23]: right foot - not implemented
-        [21, 14, 19, 20]: left foot - not implemented
-        [17, 15, 0, 16, 18]: head
-        position from: https://github.com/CMU-Perceptual-Computing-Lab/openpose/blob/master/doc/output.md
+        Mean length of each limb per speaker
+        :return: dictionary speaker -> float64 array (limbs,), NaN for limbs without values
         """
-    def dist(self, p1, p2):
-        return math.hypot(p2[0] - p1[0], p2[1] - p1[1])
+        clip_ids = open_store(self.path_to_store).keys()
+        indexes = {}
+        for idx, speaker in enumerate(clip_groups(self.path_to_store, "speaker", clip_ids)):
+            indexes.setdefault(speaker, []).append(idx)
+        tasks = [(str(self.path_to_store), speaker, speaker_indexes[:self.clips_per_speaker], str(self.path_to_limbs))
+                 for speaker, speaker_indexes in indexes.items()]
+        if self.num_workers <= 1 or len(tasks) == 1:
+            results = list(map(speaker_limb_sums, tasks))
+        else:
+            with Pool(min(self.num_workers, len(tasks))) as pool:
+                results = list(pool.imap_unordered(speaker_limb_sums, tasks))
+        means = {}
+        with np.errstate(invalid="ignore", divide="ignore"):
+            for speaker, sums, counts in sorted(results, key=lambda result: result[0]):
+                means[speaker] = np.where(counts > 0, sums / counts, np.nan)
+        return means
 
-    def get_folders(self, path_to_folder, speakers_set):
+    def rescale(self):
         """
-        Gte an array of speakers IDs and return the first occurence of folders in a specific folder
-        :param path_to_folder: train, val or test folder path
-        :param speakers_set: IDs of speakers to be found in the folder
-        :return: list of folder names containing the speakers ID of speakers_set
+        Rescale all clips of the store towards the mean of the speaker means and write them into the target store
+        :return: path to the new store
         """
-        subdirectories = [x[1] for x in os.walk(path_to_folder)]
-        subdirectories = subdirectories[0]
-
-        for element in subdirectories:
-            speaker_id = int(element.split("-")[-2])
-            if speaker_id in speakers_set:
-                index_of_finding = speakers_set.index(speaker_id)
-                speakers_set.remove(speaker_id)
-                speakers_set.insert(index_of_finding, element)
-        return speakers_set
+        if is_keypoint_store(self.path_to_target_dir):
+            raise ValueError("%s is a keypoint store already" % self.path_to_target_dir)
+        os.makedirs(self.path_to_target_dir, exist_ok=True)
+
+        speaker_means = self.mean_limb_lengths()
+        target_lengths = target_mean(list(speaker_means.values()), len(self.limbs))
+        with open(self.path_to_target_dir / "limb_lengths.json", "w") as f:
+            f.write(json.dumps({"limbs": self.limbs.names, "target": null_list(target_lengths),
+                                "speakers": {speaker: null_list(means) for speaker, means in speaker_means.items()}}))
+
+        num_clips = len(open_store(self.path_to_store))
+        num_workers = max(1, min(self.num_workers, num_clips))
+        ranges = [(str(self.path_to_store), str(self.path_to_target_dir), "shard_%05d" % part) +
+                  part_range(num_clips, part, num_workers) + (target_lengths, str(self.path_to_limbs))
+                  for part in range(num_workers)]
+        if num_workers == 1:
+            shards = [rescale_clip_range(ranges[0])]
+        else:
+            with Pool(num_workers) as pool:
+                shards = pool.map(rescale_clip_range, ranges)  # in clip order
+        # the shards become visible together with the manifest
+        ShardWriter(self.path_to_target_dir).append_shards(shards)
+        return self.path_to_target_dir
 
 
-"""
-        # get subdirectories of the path
-        os.walk(self.path_to_json)
-        subdirectories = [x[1] for x in os.walk(self.path_to_json)]
-        data_dir_origin = Path(self.path_to_json)
-        subdirectories = subdirectories[0]
-
-        # create new target directory, the files will be saved there
-        if self.path_to_target_dir == "":
-            data_dir_target = data_dir_origin.parent / str(data_dir_origin.name + "_centralized")
-        else:
-            data_dir_target = Path(self.path_to_target_dir)
-
-        # create new target directory, the fils will be saved there
-        if not os.path.exists(data_dir_target):
-            os.makedirs(data_dir_target)
-
-        for subdir in subdirectories:
-            if not os.path.exists(data_dir_target / subdir):
-                os.makedirs(data_dir_target / subdir)
-
-        # used keys of openpose here
-        keys = ['pose_keypoints_2d', 'face_keypoints_2d', 'hand_left_keypoints_2d', 'hand_right_keypoints_2d']
-        folder_keys = {'pose_keypoints_2d': [], 'face_keypoints_2d': [], 'hand_left_keypoints_2d': [],
-                       'hand_right_keypoints_2d': []}
-
-        for subdir in subdirectories:
-            json_files = [pos_json for pos_json in os.listdir(data_dir_origin / subdir)
-                          if pos_json.endswith('.json')]
-
-            all_files = {}
-            once = 1
-            # load files from one folder into dictionary
-            for file in json_files:
-                temp_df = json.load(open(data_dir_origin / subdir / file))
-                # print(temp_df)
-                all_files[file] = {}
-
-                # init dictionaries & write x, y values into dictionary
-                for k in keys:
-                    all_files[file][k] = {'x': [], 'y': []}
-                    all_files[file][k]['x'].append(temp_df['people'][0][k][0::3])
-                    all_files[file][k]['y'].append(temp_df['people'][0][k][1::3])
-                    temp_c = temp_df['people'][0][k][2::3]
-                    results_x = []
-                    results_y = []
-                    x_in_key = all_files[file][k]['x'][0]
-                    y_in_key = all_files[file][k]['y'][0]
-
-                    # set neck once
-                    if once == 1:
-                        neck_zero_x = all_files[file][k]['x'][0][0]
-                        neck_zero_y = all_files[file][k]['x'][0][0]
-                        once = 0
-
-                    # compute for pose
-                    if k == "pose_keypoints_2d":
-                        results_x.append(0)
-                        results_y.append(0)
-                        # start with 1 -> element 0 is neck
-                        # get upper body
-                        for idx in range(1, len(x_in_key[:9])):
-                            if x_in_key[idx] == 0:
-                                results_x.append('Null')
-                            else:
-                                results_x.append(neck_zero_x - x_in_key[idx])
-
-                            if y_in_key[idx] == 0:
-                                results_y.append("Null")
-                            else:
-                                results_y.append(neck_zero_y - y_in_key[idx])
-
-                        # add Null as legs
-                        results_x += (['Null'] * 6)
-                        results_y += (['Null'] * 6)
-
-                        for idx in range(15, len(x_in_key[:19])):
-                            if x_in_key[idx] == 0:
-                                results_x.append('Null')
-                            else:
-                                results_x.append(neck_zero_x - x_in_key[idx])
-
-                            if y_in_key[idx] == 0:
-                                results_y.append("Null")
-                            else:
-                                results_y.append(neck_zero_y - y_in_key[idx])
-
-                        # add more legs
-                        results_x += (['Null'] * 6)
-                        results_y += (['Null'] * 6)
-
-                        values = []
-                        for index in range(len(temp_c)):
-                            values.append(results_x[index])
-                            values.append(results_y[index])
-                            values.append(temp_c[index])
-                        temp_df['people'][0][k] = values
-                    else:
-                        # start with 1 -> element 0 is neck
-                        # get upper body
-                        for idx in range(0, len(x_in_key)):
-                            if x_in_key[idx] == 0:
-                                results_x.append('Null')
-                            else:
-                                results_x.append(neck_zero_x - x_in_key[idx])
-
-                            if y_in_key[idx] == 0:
-                                results_y.append("Null")
-                            else:
-                                results_y.append(neck_zero_y - y_in_key[idx])
-
-                        values = []
-                        for index in range(len(temp_c)):
-                            values.append(results_x[index])
-                            values.append(results_y[index])
-                            values.append(temp_c[index])
-                        temp_df['people'][0][k] = values
-
-                # ## Save our changes to JSON file
-                jsonFile = open(data_dir_target / subdir / file, "w+")
-                jsonFile.write(json.dumps(temp_df))
-                jsonFile.close()
-            print("%s done" % subdir)
-            """
+def target_mean(speaker_means, num_limbs):
+    """Mean of the speaker means per limb, speakers without a value for a limb are left out"""
+    if not speaker_means:
+        return np.full(num_limbs, np.nan)
+    means = np.stack(speaker_means)
+    counts = np.isfinite(means).sum(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(counts > 0, np.nansum(means, axis=0) / counts, np.nan)
 
 
 if __name__ == '__main__':
-    # origin json files directory
-    if len(sys.argv) > 1:
-        path_to_json_dir = sys.argv[1]
-    else:
-        print("set json file directory")
-
-    # target directory
-    path_to_target_dir = ""
-    if len(sys.argv) > 2:
-        path_to_target_dir = sys.argv[2]
-
-    # path_to_train
-    path_to_train = ""
-    if len(sys.argv) > 3:
-        path_to_train = sys.argv[3]
-
-    # path_to_test
-    path_to_test = ""
-    if len(sys.argv) > 4:
-        path_to_test = sys.argv[4]
-
-    # path_to_val
-    path_to_val = ""
-    if len(sys.argv) > 5:
-        path_to_val = sys.argv[5]
-
-    norm = Rescale(path_to_json_dir, path_to_target_dir, path_to_train, path_to_test, path_to_val)
+    if len(sys.argv) < 3 or not is_keypoint_store(sys.argv[1]):
+        print(__doc__)
+        sys.exit()
+
+    num_workers = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    clips_per_speaker = int(sys.argv[4]) if len(sys.argv) > 4 else None
+    path_to_limbs = sys.argv[5] if len(sys.argv) > 5 else LIMBS_FILE
+
+    rescale = Rescale(sys.argv[1], sys.argv[2], num_workers, clips_per_speaker, path_to_limbs)
     start_time = time.time()
-    norm.rescale()
+    rescale.rescale()
     print("--- %s seconds ---" % (time.time() - start_time))
@@ -5,6 +5,13 @@
 
 Version description:
 - data read in row per row and transpose
+- missing joints are NaN (older npy files with "Null" are read as well), mean, stdev and normalization are numpy
+  operations on whole arrays, see missing_joints.py. Joints without mean and stdev are null in all_mean_stdev.json
+- optional RSS budget in MB (4th argument): the normalized folders are streamed into the sharded keypoint store
+  all_files_normalized.store instead of all_files_normalized.npy, one clip per folder (frames sorted by frame number),
+  a shard is committed each time the budget is reached. Only the input is held in memory: np.load reads the whole
+  dictionary and the mean and stdev pass collects all values, use a keypoint store and normalize_store.py to normalize
+  any corpus size in bounded memory
 """
 
 import json
@@ -12,22 +19,32 @@ import random
 
 import numpy as np
 import os
-import statistics
 from pathlib import Path
 import sys
 import time
-import warnings
 import os
-import psutil
 import copy
 
+try:
+    from keypoints2text.kp_to_text_real_data.memory_budget import MemoryBudget
+    from keypoints2text.kp_to_text_real_data.keypoint_store import ShardWriter, is_keypoint_store, sorted_frame_names
+    from keypoints2text.kp_to_text_real_data.missing_joints import centralize_keypoints, normalize_values, \
+        mean_stdev, mean_stdev_arrays, to_float_array, to_json_list, keypoints_from_person, \
+        set_person_keypoints
+except ImportError:  # server uses different imports than local
+    from memory_budget import MemoryBudget
+    from keypoint_store import ShardWriter, is_keypoint_store, sorted_frame_names
+    from missing_joints import centralize_keypoints, normalize_values, mean_stdev, mean_stdev_arrays, to_float_array, \
+        to_json_list, keypoints_from_person, set_person_keypoints
+
 class Normalize:
 
-    def __init__(self, path_to_numpy_file, path_to_target_dir="", path_to_json_dir=""):
+    def __init__(self, path_to_numpy_file, path_to_target_dir="", path_to_json_dir="", memory_budget_mb=None):
         self.path_to_numpy_file = Path(path_to_numpy_file)
         self.path_to_target_dir = path_to_target_dir
         self.path_to_json = Path(path_to_json_dir)
         self.keys = ['pose_keypoints_2d', 'face_keypoints_2d', 'hand_left_keypoints_2d', 'hand_right_keypoints_2d']
+        self.memory_budget = MemoryBudget(memory_budget_mb)
 
         # set global? np.load settings. If not, np.load throws error
         old = np.load
@@ -70,101 +87,15 @@ class Normalize:
         # used keys of openpose here
         for subdir in all_files_dictionary.keys():
 
-            all_files = {}
             round_precision = 5
 
-            # load files from one folder into dictionary
-            for file in all_files_dictionary[subdir]:
-                temp_df = all_files_dictionary[subdir][file]
-                # print(temp_df)
-                all_files[file] = {}
-                once = 1
-                # init dictionaries & write x, y values into dictionary
-                for k in self.keys:
-                    all_files[file][k] = {'x': [], 'y': []}
-                    all_files[file][k]['x'].append(temp_df['people'][0][k][0::3])
-                    all_files[file][k]['y'].append(temp_df['people'][0][k][1::3])
-                    temp_c = temp_df['people'][0][k][2::3]
-                    results_x = []
-                    results_y = []
-                    x_in_key = all_files[file][k]['x'][0]
-                    y_in_key = all_files[file][k]['y'][0]
-
-                    # set neck once
-                    if once == 1:
-                        neck_zero_x = all_files[file][k]['x'][0][0]
-                        neck_zero_y = all_files[file][k]['y'][0][0]
-                        once = 0
-
-                    # compute for pose
-                    if k == "pose_keypoints_2d":
-                        results_x.append(0)
-                        results_y.append(0)
-                        # start with 1 -> element 0 is neck
-                        # get upper body
-                        for idx in range(1, len(x_in_key[:9])):
-                            if x_in_key[idx] == 0:
-                                results_x.append('Null')
-                            else:
-                                results_x.append(round(neck_zero_x - x_in_key[idx], round_precision))
-
-                            if y_in_key[idx] == 0:
-                                results_y.append("Null")
-                            else:
-                                results_y.append(round(neck_zero_y - y_in_key[idx], round_precision))
-
-                        # add Null as legs
-                        results_x += (['Null'] * 6)
-                        results_y += (['Null'] * 6)
-
-                        for idx in range(15, len(x_in_key[:19])):
-                            if x_in_key[idx] == 0:
-                                results_x.append('Null')
-                            else:
-                                results_x.append(round(neck_zero_x - x_in_key[idx], round_precision))
-
-                            if y_in_key[idx] == 0:
-                                results_y.append("Null")
-                            else:
-                                results_y.append(round(neck_zero_y - y_in_key[idx], round_precision))
-
-                        # add more legs
-                        results_x += (['Null'] * 6)
-                        results_y += (['Null'] * 6)
-
-                        values = []
-                        for index in range(len(temp_c)):
-                            values.append(results_x[index])
-                            values.append(results_y[index])
-                            values.append(temp_c[index])
-                        temp_df['people'][0][k] = values
-                    else:
-                        # start with 1 -> element 0 is neck
-                        # get upper body
-                        for idx in range(0, len(x_in_key)):
-                            if x_in_key[idx] == 0:
-                                results_x.append('Null')
-                            else:
-                                results_x.append(round(neck_zero_x - x_in_key[idx], round_precision))
-
-                            if y_in_key[idx] == 0:
-                                results_y.append("Null")
-                            else:
-                                results_y.append(round(neck_zero_y - y_in_key[idx], round_precision))
-
-                        values = []
-                        for index in range(len(temp_c)):
-                            values.append(results_x[index])
-                            values.append(results_y[index])
-                            values.append(temp_c[index])
-                        temp_df['people'][0][k] = values
-
-                all_files_dictionary[subdir][file] = temp_df
-
-                # ## Save our changes to JSON file
-                # jsonFile = open(data_dir_target / subdir / file, "w+")
-                # jsonFile.write(json.dumps(temp_df))
-                # jsonFile.close()
+            # files x 137 joints x (x, y, c), missing joints -> NaN
+            files = list(all_files_dictionary[subdir])
+            keypoints = np.stack([keypoints_from_person(all_files_dictionary[subdir][file]['people'][0], np.float64)
+                                  for file in files])
+            centralized = centralize_keypoints(keypoints, round_precision, np.float64)
+            for index, file in enumerate(files):
+                set_person_keypoints(all_files_dictionary[subdir][file]['people'][0], centralized[index])
 
         print("centralization done")
         self.save_to_numpy(all_files_dictionary)
@@ -207,36 +138,12 @@ class Normalize:
 
         print("Files read, computing mean and stdev")
         for k in self.keys:
-            mean_stdev_x = []
-            mean_stdev_y = []
-
-            for list in np.array(all_files_xy['all'][k]['x']).T.tolist():
-                # print(*list)
-                if "Null" in list:
-                    list = [i for i in list if i != "Null"]
-                    if list == []:
-                        mean_stdev_x.append(["Null", "Null"])
-                    else:
-                        list = [float(item) for item in list]
-                        mean_stdev_x.append([np.mean(list), statistics.pstdev(list)])
-                else:
-                    list = [float(item) for item in list]
-                    mean_stdev_x.append([np.mean(list), statistics.pstdev(list)])
-                    # print(mean_stdev_x)
-
-            for list in np.array(all_files_xy['all'][k]['y']).T.tolist():
-                if "Null" in list:
-                    list = [i for i in list if i != "Null"]
-                    if list == []:
-                        mean_stdev_y.append(["Null", "Null"])
-                    else:
-                        list = [float(item) for item in list]
-                        mean_stdev_y.append([np.mean(list), statistics.pstdev(list)])
-                else:
-                    list = [float(item) for item in list]
-                    mean_stdev_y.append([np.mean(list), statistics.pstdev(list)])
-
-            all_mean_stdev[k] = [np.array(mean_stdev_x).T.tolist(), np.array(mean_stdev_y).T.tolist()]
+            # files x joints, missing values are excluded
+            mean_stdev_x = mean_stdev(all_files_xy['all'][k]['x'])
+            mean_stdev_y = mean_stdev(all_files_xy['all'][k]['y'])
+
+            all_mean_stdev[k] = [[to_json_list(mean_stdev_x[0]), to_json_list(mean_stdev_x[1])],
+                                 [to_json_list(mean_stdev_y[0]), to_json_list(mean_stdev_y[1])]]
 
         # print(all_mean_stdev)
 
@@ -267,37 +174,24 @@ class Normalize:
                 temp_df = all_files[subdir][file]
                 if once == 1:
                     for k in self.keys:
-                        all_files_xy['all'][k] = {'x': np.empty((len(temp_df['people'][0][k][0::3]), 0), dtype=np.float),
-                                                  'y': np.empty((len(temp_df['people'][0][k][1::3]), 0), dtype=np.float)}
+                        all_files_xy['all'][k] = {'x': np.empty((len(temp_df['people'][0][k][0::3]), 0), dtype=np.float64),
+                                                  'y': np.empty((len(temp_df['people'][0][k][1::3]), 0), dtype=np.float64)}
 
                     once = 0
 
                 for k in self.keys:
                     all_files_xy['all'][k]['x'] = np.c_[
-                        all_files_xy['all'][k]['x'], np.array(temp_df['people'][0][k][0::3])]
+                        all_files_xy['all'][k]['x'], to_float_array(temp_df['people'][0][k][0::3], np.float64)]
                     all_files_xy['all'][k]['y'] = np.c_[
-                        all_files_xy['all'][k]['y'], np.array(temp_df['people'][0][k][1::3])]
+                        all_files_xy['all'][k]['y'], to_float_array(temp_df['people'][0][k][1::3], np.float64)]
         print("Files read, computing mean and stdev")
 
         for k in self.keys:
-            mean_stdev_x = []
-            mean_stdev_y = []
-            for list in np.array(all_files_xy['all'][k]['x']):
-                warnings.simplefilter(action='ignore', category=FutureWarning)
-                if "Null" in list:
-                    mean_stdev_x.append(["Null", "Null"])
-                else:
-                    list = [float(item) for item in list]
-                    mean_stdev_x.append([np.mean(list), statistics.pstdev(list)])
-
-            for list in np.array(all_files_xy['all'][k]['y']):
-                if "Null" in list:
-                    mean_stdev_y.append(["Null", "Null"])
-                else:
-                    list = [float(item) for item in list]
-                    mean_stdev_y.append([np.mean(list), statistics.pstdev(list)])
-
-            all_mean_stdev[k] = [np.array(mean_stdev_x).T.tolist(), np.array(mean_stdev_y).T.tolist()]
+            # joints x files
+            mean_stdev_x = mean_stdev(all_files_xy['all'][k]['x'].T, skip_missing=False)
+            mean_stdev_y = mean_stdev(all_files_xy['all'][k]['y'].T, skip_missing=False)
+            all_mean_stdev[k] = [[to_json_list(mean_stdev_x[0]), to_json_list(mean_stdev_x[1])],
+                                 [to_json_list(mean_stdev_y[0]), to_json_list(mean_stdev_y[1])]]
 
         # write the computed means and std_dev into json file
         f = open(self.path_to_target_dir / "all_mean_stdev.json", "w")
@@ -342,26 +236,12 @@ class Normalize:
         print("Files read, computing mean and stdev")
 
         for k in self.keys:
-            mean_stdev_x = []
-            mean_stdev_y = []
             self.print_memory_usage()
-            for list in np.array(all_files_xy['all'][k]['x']):
-
-                warnings.simplefilter(action='ignore', category=FutureWarning)
-                if 'Null' in list:
-                    mean_stdev_x.append(["Null", "Null"])
-                else:
-                    list = [float(item) for item in list]
-                    mean_stdev_x.append([np.mean(list), statistics.pstdev(list)])
-
-            for list in np.array(all_files_xy['all'][k]['y']):
-                if 'Null' in list:
-                    mean_stdev_y.append(["Null", "Null"])
-                else:
-                    list = [float(item) for item in list]
-                    mean_stdev_y.append([np.mean(list), statistics.pstdev(list)])
-
-            all_mean_stdev[k] = [np.array(mean_stdev_x).T.tolist(), np.array(mean_stdev_y).T.tolist()]
+            # joints x files
+            mean_stdev_x = mean_stdev(to_float_array(all_files_xy['all'][k]['x'], np.float64).T, skip_missing=False)
+            mean_stdev_y = mean_stdev(to_float_array(all_files_xy['all'][k]['y'], np.float64).T, skip_missing=False)
+            all_mean_stdev[k] = [[to_json_list(mean_stdev_x[0]), to_json_list(mean_stdev_x[1])],
+                                 [to_json_list(mean_stdev_y[0]), to_json_list(mean_stdev_y[1])]]
 
         # write the computed means and std_dev into json file
         f = open(self.path_to_target_dir / "all_mean_stdev.json", "w")
@@ -375,58 +255,25 @@ class Normalize:
         all_files = self.dictionary_check(all_files_dictionary_centralized)
         self.print_memory_usage()
 
+        if self.memory_budget.budget_mb is not None:
+            self.normalize_to_store(all_mean_stdev, all_files)
+            return
+
         all_files_save = {}
+        # joints x (x, y), NaN for joints without mean and stdev
+        mean, stdev = mean_stdev_arrays([all_mean_stdev[k] for k in self.keys])
         # use mean and stdev to compute values for the json files
         for subdir in all_files.keys():
             all_files_save[subdir] = {}
-            for file in all_files[subdir]:
+            # files x 137 joints x (x, y, c), missing values stay NaN, the confidence is kept
+            files = list(all_files[subdir])
+            keypoints = np.stack([keypoints_from_person(all_files[subdir][file]['people'][0], np.float64)
+                                  for file in files])
+            keypoints[:, :, :2] = normalize_values(keypoints[:, :, :2], mean, stdev, np.float64)
+            for index, file in enumerate(files):
                 data = all_files[subdir][file]
-
-                # x -> [0::3]
-                # y -> [1:.3]
-                # c -> [2::3] (confidence)
-                for k in self.keys:
-                    # x values
-                    temp_x = data['people'][0][k][0::3]
-                    temp_y = data['people'][0][k][1::3]
-                    temp_c = data['people'][0][k][2::3]
-
-                    # get x values and normalize it
-                    for index in range(len(temp_x)):
-                        mean_x = all_mean_stdev[k][0][0][index]
-                        stdev_x = all_mean_stdev[k][0][1][index]
-
-                        mean_y = all_mean_stdev[k][1][0][index]
-                        stdev_y = all_mean_stdev[k][1][1][index]
-
-                        if temp_x[index] == "Null":
-                            temp_x[index] = temp_x[index]
-                        elif str(stdev_x) == "Null":
-                            temp_x[index] = temp_x[index]
-                        elif float(stdev_x) == 0:
-                            temp_x[index] = temp_x[index]
-                        else:
-                            temp_x[index] = (temp_x[index] - float(mean_x)) / float(stdev_x)
-
-                        if temp_y[index] == "Null":
-                            temp_y[index] = temp_y[index]
-                        elif str(stdev_y) == "Null":
-                            temp_y[index] = temp_y[index]
-                        elif float(stdev_y) == 0:
-                            temp_y[index] = temp_y[index]
-                        else:
-                            temp_y[index] = (temp_y[index] - float(mean_y)) / float(stdev_y)
-
-                    # build new array of normalized values
-                    values = []
-                    for index in range(len(temp_x)):
-                        values.append(temp_x[index])
-                        values.append(temp_y[index])
-                        values.append(temp_c[index])
-
-                    # copy the array of normalized values where it came from
-                    data['people'][0][k] = values
-
+                # copy the normalized values where they came from
+                set_person_keypoints(data['people'][0], keypoints[index])
                 all_files_save[subdir][file] = data
         self.print_memory_usage()
         # print(all_files_save)
@@ -474,9 +321,45 @@ class Normalize:
         np.save(dictionary_file_path, all_files)
         return Path(dictionary_file_path)
 
+    def normalize_to_store(self, all_mean_stdev, all_files):
+        """
+        Normalize the folders into the sharded keypoint store all_files_normalized.store, each folder is written as
+        soon as it is normalized and dropped from the input. A shard is committed each time the memory budget is
+        reached, the normalized folders are never collected in memory.
+        :param all_mean_stdev: means and stdevs of compute_mean_stdev_transposed
+        :param all_files: input dictionary, emptied while the folders are written
+        """
+        store_path = self.path_to_target_dir / 'all_files_normalized.store'
+        if is_keypoint_store(store_path):
+            raise ValueError("%s is a keypoint store already" % store_path)
+        print("Saving normalized results to %s " % store_path.name)
+        shard_writer = ShardWriter(store_path)
+        writer = None
+        # joints x (x, y), NaN for joints without mean and stdev
+        mean, stdev = mean_stdev_arrays([all_mean_stdev[k] for k in self.keys])
+        for subdir in list(all_files.keys()):
+            if writer is None:
+                writer = shard_writer.new_shard()
+            # files x 137 joints x (x, y, c) in frame order as in the stores of save_files.py
+            files = sorted_frame_names(all_files[subdir])
+            keypoints = np.stack([keypoints_from_person(all_files[subdir][file]['people'][0], np.float64)
+                                  for file in files])
+            keypoints[:, :, :2] = normalize_values(keypoints[:, :, :2], mean, stdev, np.float64)
+            writer.add_clip(subdir, keypoints)
+            del all_files[subdir]
+
+            if self.memory_budget.exceeded():
+                print("Memory budget reached, committing %s (%d folders)" % (writer.path_to_store.name,
+                                                                               len(writer.clip_ids)))
+                shard_writer.commit(writer)
+                writer = None
+                self.memory_budget.flushed()
+        if writer is not None:
+            shard_writer.commit(writer)
+        self.print_memory_usage()
+
     def print_memory_usage(self):
-        process = psutil.Process(os.getpid())
-        print("Current memory usage: %s MB" % str(process.memory_info().rss / 1000000))  # divided to get mb
+        self.memory_budget.print_memory_usage()
 
 
 if __name__ == '__main__':
@@ -499,7 +382,12 @@ if __name__ == '__main__':
     if len(sys.argv) > 3:
         path_to_json_dir = sys.argv[3]
 
-    norm = Normalize(path_to_numpy_file, path_to_target_dir, path_to_json_dir)
+    # RSS budget in MB, 0 -> no budget
+    memory_budget_mb = 0
+    if len(sys.argv) > 4:
+        memory_budget_mb = float(sys.argv[4])
+
+    norm = Normalize(path_to_numpy_file, path_to_target_dir, path_to_json_dir, memory_budget_mb)
     start_time = time.time()
     norm.main()
     print("--- %.4s seconds ---" % (time.time() - start_time))
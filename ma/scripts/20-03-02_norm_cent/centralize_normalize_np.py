@@ -5,7 +5,15 @@
 
 Version description:
 - data read in row per row and transpose
+- optional RSS budget in MB (4th argument): the normalized folders are streamed into the sharded keypoint store
+  all_files_normalized.store instead of all_files_normalized.npy, one clip per folder named by its index (the npy file
+  has no folder names, the confidence is 0), a shard is committed each time the budget is reached. np.load still reads
+  the whole input, use a keypoint store and normalize_store.py to normalize any corpus size in bounded memory
 - Using the reduced all_files_np.npy file
+- mean and stdev are computed with the streaming engine of keypoint_stats.py (float64, one folder at a time)
+- a keypoint store as input: only all_mean_stdev.json is computed, in one pass over the store
+- missing joints are NaN (older npy files with "Null" are read as well), the normalization is a numpy operation per
+  folder and key, see missing_joints.py. Joints without mean and stdev are null in all_mean_stdev.json
 """
 
 import json
@@ -13,22 +21,35 @@ import random
 
 import numpy as np
 import os
-import statistics
 from pathlib import Path
 import sys
 import time
-import warnings
 import os
-import psutil
 import copy
 
+try:
+    from keypoints2text.kp_to_text_real_data.memory_budget import MemoryBudget
+    from keypoints2text.kp_to_text_real_data.keypoint_stats import RunningMeanStdev, compute_store_stats, \
+        write_mean_stdev
+    from keypoints2text.kp_to_text_real_data.keypoint_store import is_keypoint_store, key_slices, ShardWriter, \
+        NUM_JOINTS
+    from keypoints2text.kp_to_text_real_data.missing_joints import centralize_keypoints, normalize_values, \
+        mean_stdev, mean_stdev_arrays, to_float_array, to_json_list, keypoints_from_person, set_person_keypoints
+except ImportError:  # server uses different imports than local
+    from memory_budget import MemoryBudget
+    from keypoint_stats import RunningMeanStdev, compute_store_stats, write_mean_stdev
+    from keypoint_store import is_keypoint_store, key_slices, ShardWriter, NUM_JOINTS
+    from missing_joints import centralize_keypoints, normalize_values, mean_stdev, mean_stdev_arrays, to_float_array, \
+        to_json_list, keypoints_from_person, set_person_keypoints
+
 class Normalize:
 
-    def __init__(self, path_to_numpy_file, path_to_target_dir="", path_to_json_dir=""):
+    def __init__(self, path_to_numpy_file, path_to_target_dir="", path_to_json_dir="", memory_budget_mb=None):
         self.path_to_numpy_file = Path(path_to_numpy_file)
         self.path_to_target_dir = path_to_target_dir
         self.path_to_json = Path(path_to_json_dir)
         self.keys = ['pose_keypoints_2d', 'face_keypoints_2d', 'hand_left_keypoints_2d', 'hand_right_keypoints_2d']
+        self.memory_budget = MemoryBudget(memory_budget_mb)
 
         # set global? np.load settings. If not, np.load throws error
         old = np.load
@@ -40,6 +61,11 @@ class Normalize:
         self.create_folders()
         self.print_memory_usage()
 
+        # keypoint store: only the stats are computed, the normalization works on the npy layout
+        if is_keypoint_store(self.path_to_numpy_file):
+            self.compute_mean_stdev_store()
+            return
+
         # centralize values
         all_files_dictionary_centralized = None
         # dont use centralization, in current version
@@ -71,101 +97,15 @@ class Normalize:
         # used keys of openpose here
         for subdir in all_files_dictionary.keys():
 
-            all_files = {}
             round_precision = 5
 
-            # load files from one folder into dictionary
-            for file in all_files_dictionary[subdir]:
-                temp_df = all_files_dictionary[subdir][file]
-                # print(temp_df)
-                all_files[file] = {}
-                once = 1
-                # init dictionaries & write x, y values into dictionary
-                for k in self.keys:
-                    all_files[file][k] = {'x': [], 'y': []}
-                    all_files[file][k]['x'].append(temp_df['people'][0][k][0::3])
-                    all_files[file][k]['y'].append(temp_df['people'][0][k][1::3])
-                    temp_c = temp_df['people'][0][k][2::3]
-                    results_x = []
-                    results_y = []
-                    x_in_key = all_files[file][k]['x'][0]
-                    y_in_key = all_files[file][k]['y'][0]
-
-                    # set neck once
-                    if once == 1:
-                        neck_zero_x = all_files[file][k]['x'][0][0]
-                        neck_zero_y = all_files[file][k]['y'][0][0]
-                        once = 0
-
-                    # compute for pose
-                    if k == "pose_keypoints_2d":
-                        results_x.append(0)
-                        results_y.append(0)
-                        # start with 1 -> element 0 is neck
-                        # get upper body
-                        for idx in range(1, len(x_in_key[:9])):
-                            if x_in_key[idx] == 0:
-                                results_x.append('Null')
-                            else:
-                                results_x.append(round(neck_zero_x - x_in_key[idx], round_precision))
-
-                            if y_in_key[idx] == 0:
-                                results_y.append("Null")
-                            else:
-                                results_y.append(round(neck_zero_y - y_in_key[idx], round_precision))
-
-                        # add Null as legs
-                        results_x += (['Null'] * 6)
-                        results_y += (['Null'] * 6)
-
-                        for idx in range(15, len(x_in_key[:19])):
-                            if x_in_key[idx] == 0:
-                                results_x.append('Null')
-                            else:
-                                results_x.append(round(neck_zero_x - x_in_key[idx], round_precision))
-
-                            if y_in_key[idx] == 0:
-                                results_y.append("Null")
-                            else:
-                                results_y.append(round(neck_zero_y - y_in_key[idx], round_precision))
-
-                        # add more legs
-                        results_x += (['Null'] * 6)
-                        results_y += (['Null'] * 6)
-
-                        values = []
-                        for index in range(len(temp_c)):
-                            values.append(results_x[index])
-                            values.append(results_y[index])
-                            values.append(temp_c[index])
-                        temp_df['people'][0][k] = values
-                    else:
-                        # start with 1 -> element 0 is neck
-                        # get upper body
-                        for idx in range(0, len(x_in_key)):
-                            if x_in_key[idx] == 0:
-                                results_x.append('Null')
-                            else:
-                                results_x.append(round(neck_zero_x - x_in_key[idx], round_precision))
-
-                            if y_in_key[idx] == 0:
-                                results_y.append("Null")
-                            else:
-                                results_y.append(round(neck_zero_y - y_in_key[idx], round_precision))
-
-                        values = []
-                        for index in range(len(temp_c)):
-                            values.append(results_x[index])
-                            values.append(results_y[index])
-                            values.append(temp_c[index])
-                        temp_df['people'][0][k] = values
-
-                all_files_dictionary[subdir][file] = temp_df
-
-                # ## Save our changes to JSON file
-                # jsonFile = open(data_dir_target / subdir / file, "w+")
-                # jsonFile.write(json.dumps(temp_df))
-                # jsonFile.close()
+            # files x 137 joints x (x, y, c), missing joints -> NaN
+            files = list(all_files_dictionary[subdir])
+            keypoints = np.stack([keypoints_from_person(all_files_dictionary[subdir][file]['people'][0], np.float64)
+                                  for file in files])
+            centralized = centralize_keypoints(keypoints, round_precision, np.float64)
+            for index, file in enumerate(files):
+                set_person_keypoints(all_files_dictionary[subdir][file]['people'][0], centralized[index])
 
         print("centralization done")
         self.save_to_numpy(all_files_dictionary)
@@ -180,67 +120,29 @@ class Normalize:
 
     def compute_mean_stdev_transposed(self, all_files_dictionary_centralized=None):
         """
-        Read data row per row and transpose to computed mean and stdev
+        Compute mean and stdev of each joint with the streaming engine of keypoint_stats.py, one folder at a time.
+        Missing values (NaN, "Null" in older files) are excluded.
         :param all_files_dictionary_centralized:
         :return:
         """
 
         all_files = self.dictionary_check(all_files_dictionary_centralized)
         self.print_memory_usage()
-        # use keys of openpose here
-        # all_mean_stdev = {}  # holds means and stdev of each directory, one json file per directory
-
-        # keys
-        # | - key (pose, face hands)
-        # | - - x_coord
-        # | - - - x_values of file_0
-        # | - - - x_values of file_n
-        # | - - y_coord
-
-        keys = [[[], []], [[], []], [[], []], [[], []]]
-        all_mean_stdev = [[[], []], [[], []], [[], []], [[], []]]
 
+        # one RunningMeanStdev per key (pose, face, hands), created with the amount of joints of the first file
+        keys = []
         for subdir in all_files:
-            # load files from one folder into dictionary
-            for file in subdir:
-                # for key in file:
-                for i in range(len(file)):
-                    # print(file[i][0::2])
-                    keys[i][0].append(file[i][0::2].tolist())
-                    keys[i][1].append(file[i][1::2].tolist())
+            if len(subdir) == 0:
+                continue
+            if not keys:
+                keys = [RunningMeanStdev(len(subdir[0][i]) // 2) for i in range(len(subdir[0]))]
+            for i in range(len(keys)):
+                # files x joints x (x, y)
+                values = np.stack([to_float_array(file[i], np.float64) for file in subdir]).reshape(len(subdir), -1, 2)
+                keys[i].update(values, np.isfinite(values))
 
         print("Files read, computing mean and stdev")
-
-        # for k in keys:
-        for i in range(len(keys)):
-            mean_stdev_x = []
-            mean_stdev_y = []
-            for list in np.array(keys[i][0]).T:
-                if "Null" in list:
-                    list = [i for i in list if i != "Null"]
-                    if list == []:
-                        mean_stdev_x.append(["Null", "Null"])
-                    else:
-                        list = [float(item) for item in list]
-                        mean_stdev_x.append([np.mean(list), statistics.pstdev(list)])
-                else:
-                    list = [float(item) for item in list]
-                    mean_stdev_x.append([np.mean(list), statistics.pstdev(list)])
-                    # print(mean_stdev_x)
-
-            for list in np.array(keys[i][1]).T:
-                if "Null" in list:
-                    list = [i for i in list if i != "Null"]
-                    if list == []:
-                        mean_stdev_y.append(["Null", "Null"])
-                    else:
-                        list = [float(item) for item in list]
-                        mean_stdev_y.append([np.mean(list), statistics.pstdev(list)])
-                else:
-                    list = [float(item) for item in list]
-                    mean_stdev_y.append([np.mean(list), statistics.pstdev(list)])
-
-            all_mean_stdev[i] = [np.array(mean_stdev_x).T.tolist(), np.array(mean_stdev_y).T.tolist()]
+        all_mean_stdev = [stats.mean_stdev_lists() for stats in keys]
 
         # write the computed means and std_dev into json file
         f = open(self.path_to_target_dir / "all_mean_stdev.json", "w")
@@ -249,6 +151,18 @@ class Normalize:
 
         return all_mean_stdev
 
+    def compute_mean_stdev_store(self, num_workers=1):
+        """
+        Compute mean and stdev of each joint of a keypoint store in one pass over the memory mapped keypoints
+        :param num_workers: amount of processes
+        :return:
+        """
+        print("Computing mean and stdev of the store %s" % self.path_to_numpy_file)
+        stats = compute_store_stats(self.path_to_numpy_file, num_workers)
+        all_mean_stdev = write_mean_stdev(stats, self.path_to_target_dir)
+        self.print_memory_usage()
+        return all_mean_stdev
+
     def compute_mean_stdev_np(self, all_files_dictionary_centralized=None):
         """
         Read data column per column with np arrays and np.c_ to computed mean and stdev
@@ -270,36 +184,23 @@ class Normalize:
                 print(temp_df)
                 if once == 1:
                     for k in self.keys:
-                        all_files_xy['all'][k] = {'x': np.empty((len(temp_df['people'][0][k][0::3]), 0), dtype=np.float),
-                                                  'y': np.empty((len(temp_df['people'][0][k][1::3]), 0), dtype=np.float)}
+                        all_files_xy['all'][k] = {'x': np.empty((len(temp_df['people'][0][k][0::3]), 0), dtype=np.float64),
+                                                  'y': np.empty((len(temp_df['people'][0][k][1::3]), 0), dtype=np.float64)}
                     once = 0
 
                 for k in self.keys:
                     all_files_xy['all'][k]['x'] = np.c_[
-                        all_files_xy['all'][k]['x'], np.array(temp_df['people'][0][k][0::3])]
+                        all_files_xy['all'][k]['x'], to_float_array(temp_df['people'][0][k][0::3], np.float64)]
                     all_files_xy['all'][k]['y'] = np.c_[
-                        all_files_xy['all'][k]['y'], np.array(temp_df['people'][0][k][1::3])]
+                        all_files_xy['all'][k]['y'], to_float_array(temp_df['people'][0][k][1::3], np.float64)]
         print("Files read, computing mean and stdev")
 
         for k in self.keys:
-            mean_stdev_x = []
-            mean_stdev_y = []
-            for list in np.array(all_files_xy['all'][k]['x']):
-                warnings.simplefilter(action='ignore', category=FutureWarning)
-                if "Null" in list:
-                    mean_stdev_x.append(["Null", "Null"])
-                else:
-                    list = [float(item) for item in list]
-                    mean_stdev_x.append([np.mean(list), statistics.pstdev(list)])
-
-            for list in np.array(all_files_xy['all'][k]['y']):
-                if "Null" in list:
-                    mean_stdev_y.append(["Null", "Null"])
-                else:
-                    list = [float(item) for item in list]
-                    mean_stdev_y.append([np.mean(list), statistics.pstdev(list)])
-
-            all_mean_stdev[k] = [np.array(mean_stdev_x).T.tolist(), np.array(mean_stdev_y).T.tolist()]
+            # joints x files
+            mean_stdev_x = mean_stdev(all_files_xy['all'][k]['x'].T, skip_missing=False)
+            mean_stdev_y = mean_stdev(all_files_xy['all'][k]['y'].T, skip_missing=False)
+            all_mean_stdev[k] = [[to_json_list(mean_stdev_x[0]), to_json_list(mean_stdev_x[1])],
+                                 [to_json_list(mean_stdev_y[0]), to_json_list(mean_stdev_y[1])]]
 
         # write the computed means and std_dev into json file
         f = open(self.path_to_target_dir / "all_mean_stdev.json", "w")
@@ -344,26 +245,12 @@ class Normalize:
         print("Files read, computing mean and stdev")
 
         for k in self.keys:
-            mean_stdev_x = []
-            mean_stdev_y = []
             self.print_memory_usage()
-            for list in np.array(all_files_xy['all'][k]['x']):
-
-                warnings.simplefilter(action='ignore', category=FutureWarning)
-                if 'Null' in list:
-                    mean_stdev_x.append(["Null", "Null"])
-                else:
-                    list = [float(item) for item in list]
-                    mean_stdev_x.append([np.mean(list), statistics.pstdev(list)])
-
-            for list in np.array(all_files_xy['all'][k]['y']):
-                if 'Null' in list:
-                    mean_stdev_y.append(["Null", "Null"])
-                else:
-                    list = [float(item) for item in list]
-                    mean_stdev_y.append([np.mean(list), statistics.pstdev(list)])
-
-            all_mean_stdev[k] = [np.array(mean_stdev_x).T.tolist(), np.array(mean_stdev_y).T.tolist()]
+            # joints x files
+            mean_stdev_x = mean_stdev(to_float_array(all_files_xy['all'][k]['x'], np.float64).T, skip_missing=False)
+            mean_stdev_y = mean_stdev(to_float_array(all_files_xy['all'][k]['y'], np.float64).T, skip_missing=False)
+            all_mean_stdev[k] = [[to_json_list(mean_stdev_x[0]), to_json_list(mean_stdev_x[1])],
+                                 [to_json_list(mean_stdev_y[0]), to_json_list(mean_stdev_y[1])]]
 
         # write the computed means and std_dev into json file
         f = open(self.path_to_target_dir / "all_mean_stdev.json", "w")
@@ -376,65 +263,85 @@ class Normalize:
 
         all_files = self.dictionary_check(all_files_dictionary_centralized)
         self.print_memory_usage()
+        if self.memory_budget.budget_mb is not None:
+            self.normalize_to_store(all_mean_stdev, all_files)
+            return
+
         dirs_list = []
+        # joints x (x, y), NaN for joints without mean and stdev
+        mean, stdev = mean_stdev_arrays(all_mean_stdev)
         # use mean and stdev to compute values for the json files
         for subdir in all_files:
             files_list = []
-            for file in subdir:
-                keypoints = []
-
-                # x -> [0::3]
-                # y -> [1:.3]
-                # c -> [2::3] (confidence)
-                for k in range(len(file)):
-                    # x values
-                    temp_x = file[k][0::2]
-                    temp_y = file[k][1::2]
-
-                    # get x, y values and normalize it
-                    for index in range(len(temp_x)):
-                        mean_x = all_mean_stdev[k][0][0][index]
-                        stdev_x = all_mean_stdev[k][0][1][index]
-
-                        mean_y = all_mean_stdev[k][1][0][index]
-                        stdev_y = all_mean_stdev[k][1][1][index]
-
-                        if temp_x[index] == "Null":
-                            temp_x[index] = temp_x[index]
-                        elif str(stdev_x) == "Null":
-                            temp_x[index] = temp_x[index]
-                        elif float(stdev_x) == 0:
-                            temp_x[index] = temp_x[index]
-                        else:
-                            temp_x[index] = (temp_x[index] - float(mean_x)) / float(stdev_x)
-
-                        if temp_y[index] == "Null":
-                            temp_y[index] = temp_y[index]
-                        elif str(stdev_y) == "Null":
-                            temp_y[index] = temp_y[index]
-                        elif float(stdev_y) == 0:
-                            temp_y[index] = temp_y[index]
-                        else:
-                            temp_y[index] = (temp_y[index] - float(mean_y)) / float(stdev_y)
-
-                    # build new array of normalized values
-                    values = [j for i in zip(temp_x, temp_y) for j in i]
-                    # copy the array of normalized values where it came from
-                    keypoints.append(values)
-
-                files_list.append(keypoints)
+            if len(subdir) > 0:
+                normalized = self.normalize_folder(subdir, mean, stdev)
+                # copy the normalized values where they came from, one list per key
+                for index in range(len(subdir)):
+                    files_list.append([values[index].tolist() for values in normalized])
             # print(files_list)
             dirs_list.append(files_list)
-        print(dirs_list)
         self.print_memory_usage()
 
         dictionary_file_path = self.path_to_target_dir / 'all_files_normalized.npy'
         last_folder = os.path.basename(os.path.normpath(dictionary_file_path.parent)) + "/" + str(
             dictionary_file_path.name)
         print("Saving normalized results to %s " % last_folder)
-        np.save(dictionary_file_path, files_list)
+        np.save(dictionary_file_path, self.to_object_array(dirs_list))
+        self.print_memory_usage()
+
+    def normalize_folder(self, subdir, mean, stdev):
+        """
+        :param subdir: files of one folder, one list of x, y values per key
+        :return: files x (joints * 2) per key, missing values stay NaN
+        """
+        return [normalize_values(np.stack([to_float_array(file[k], np.float64) for file in subdir])
+                                 .reshape(len(subdir), -1, 2), mean[part], stdev[part], np.float64)
+                .reshape(len(subdir), -1) for k, part in enumerate(key_slices().values())]
+
+    def normalize_to_store(self, all_mean_stdev, all_files):
+        """
+        Normalize the folders into the sharded keypoint store all_files_normalized.store, each folder is written as
+        soon as it is normalized and released from the input. A shard is committed each time the memory budget is
+        reached, the normalized folders are never collected in memory.
+        :param all_mean_stdev: means and stdevs of compute_mean_stdev_transposed
+        :param all_files: input folders, released while the folders are written
+        """
+        store_path = self.path_to_target_dir / 'all_files_normalized.store'
+        if is_keypoint_store(store_path):
+            raise ValueError("%s is a keypoint store already" % store_path)
+        print("Saving normalized results to %s " % store_path.name)
+        shard_writer = ShardWriter(store_path)
+        writer = None
+        # joints x (x, y), NaN for joints without mean and stdev
+        mean, stdev = mean_stdev_arrays(all_mean_stdev)
+        for subdir_index, subdir in enumerate(all_files):
+            if writer is None:
+                writer = shard_writer.new_shard()
+            # files x 137 joints x (x, y, c), the npy file has no confidence
+            keypoints = np.zeros((len(subdir), NUM_JOINTS, 3), dtype=np.float64)
+            if len(subdir) > 0:
+                for values, part in zip(self.normalize_folder(subdir, mean, stdev), key_slices().values()):
+                    keypoints[:, part, :2] = values.reshape(len(subdir), -1, 2)
+            writer.add_clip(str(subdir_index), keypoints)
+            all_files[subdir_index] = None
+
+            if self.memory_budget.exceeded():
+                print("Memory budget reached, committing %s (%d folders)" % (writer.path_to_store.name,
+                                                                               len(writer.clip_ids)))
+                shard_writer.commit(writer)
+                writer = None
+                self.memory_budget.flushed()
+        if writer is not None:
+            shard_writer.commit(writer)
         self.print_memory_usage()
 
+    def to_object_array(self, dirs_list):
+        """One element per folder, the folders have different amounts of files"""
+        dirs_array = np.empty(len(dirs_list), dtype=object)
+        for index, files_list in enumerate(dirs_list):
+            dirs_array[index] = files_list
+        return dirs_array
+
     def dictionary_check(self, all_files_dictionary_centralized):
         # load from .npy file
         if all_files_dictionary_centralized is None:
@@ -473,8 +380,7 @@ class Normalize:
         return Path(dictionary_file_path)
 
     def print_memory_usage(self):
-        process = psutil.Process(os.getpid())
-        print("Current memory usage: %s MB" % str(process.memory_info().rss / 1000000))  # divided to get mb
+        self.memory_budget.print_memory_usage()
 
 
 if __name__ == '__main__':
@@ -497,7 +403,12 @@ if __name__ == '__main__':
     if len(sys.argv) > 3:
         path_to_json_dir = sys.argv[3]
 
-    norm = Normalize(path_to_numpy_file, path_to_target_dir, path_to_json_dir)
+    # RSS budget in MB, 0 -> no budget
+    memory_budget_mb = 0
+    if len(sys.argv) > 4:
+        memory_budget_mb = float(sys.argv[4])
+
+    norm = Normalize(path_to_numpy_file, path_to_target_dir, path_to_json_dir, memory_budget_mb)
     start_time = time.time()
     norm.main()
     print("--- %.4s seconds ---" % (time.time() - start_time))
@@ -0,0 +1,119 @@
+"""inspect_keypoints.py: inspect keypoint archives without loading them completely
+
+Works on keypoint stores (see keypoint_store.py) and on legacy raw_data.npy dictionaries. A legacy dictionary is
+unpickled once and converted into a keypoint store next to it (<file>.store), all later calls use the clip index of
+that store and read only the bytes of the requested clip.
+
+usage:
+inspect_keypoints.py path_to_archive list
+    print all clip ids with their frame counts
+inspect_keypoints.py path_to_archive stats [clip_id]
+    print summary stats of the archive, or of one clip (value ranges and mean confidence per key)
+inspect_keypoints.py path_to_archive dump clip_id [start_frame end_frame] [json|csv]
+    print the keypoints of one clip (or of the frames start_frame <= frame < end_frame) as json (default) or csv
+"""
+
+import csv
+import json
+import os
+import sys
+from pathlib import Path
+import numpy as np
+
+try:
+    from keypoints2text.kp_to_text_real_data.keypoint_store import open_store, is_keypoint_store, \
+        convert_legacy_npy, key_slices
+except ImportError:  # server uses different imports than local
+    from keypoint_store import open_store, is_keypoint_store, convert_legacy_npy, key_slices
+
+
+class KeypointInspector:
+
+    def __init__(self, path_to_archive):
+        self.path_to_archive = Path(path_to_archive)
+        self.store = open_store(self.get_store_path())
+
+    def get_store_path(self):
+        """Path to the store of the archive, a legacy .npy file is converted on first use"""
+        if is_keypoint_store(self.path_to_archive):
+            return self.path_to_archive
+        store_path = Path(str(self.path_to_archive) + ".store")
+        if not is_keypoint_store(store_path) or \
+                os.path.getmtime(store_path / "meta.json") < os.path.getmtime(self.path_to_archive):
+            print("Indexing %s, this is done only once" % self.path_to_archive, file=sys.stderr)
+            convert_legacy_npy(self.path_to_archive, store_path)
+        return store_path
+
+    def list_clips(self):
+        for clip_id, length in zip(self.store.keys(), self.store.lengths):
+            print("%s\t%d" % (clip_id, length))
+
+    def stats(self, clip_id=None):
+        if clip_id is None:
+            lengths = np.asarray(self.store.lengths)
+            print("clips:  %d" % len(lengths))
+            print("frames: %d" % lengths.sum())
+            if len(lengths):
+                print("frames per clip: min %d | mean %.1f | median %d | max %d" % (
+                    lengths.min(), lengths.mean(), np.median(lengths), lengths.max()))
+            return
+
+        clip = self.store.get_clip(clip_id)
+        print("clip:   %s" % clip_id)
+        print("frames: %d" % clip.shape[0])
+        for k, part in key_slices().items():
+            values = clip[:, part]
+            detected = values[:, :, 2] > 0
+            if not detected.any():
+                print("%-24s not detected" % k)
+                continue
+            print("%-24s x %8.2f ... %8.2f | y %8.2f ... %8.2f | mean confidence %.3f | detected %.1f %%" % (
+                k, values[:, :, 0][detected].min(), values[:, :, 0][detected].max(),
+                values[:, :, 1][detected].min(), values[:, :, 1][detected].max(),
+                values[:, :, 2].mean(), 100 * detected.mean()))
+
+    def dump(self, clip_id, start=None, end=None, output_format="json"):
+        clip = self.store.get_clip(clip_id)
+        start = 0 if start is None else start
+        end = clip.shape[0] if end is None else min(end, clip.shape[0])
+        frames = np.asarray(clip[start:end], dtype=np.float64).round(6)  # drop float32 noise in the output
+
+        if output_format == "csv":
+            writer = csv.writer(sys.stdout)
+            writer.writerow(["frame", "key", "joint", "x", "y", "c"])
+            for idx, frame in enumerate(frames):
+                for k, part in key_slices().items():
+                    for joint, (x, y, c) in enumerate(frame[part]):
+                        writer.writerow([start + idx, k, joint, x, y, c])
+        else:
+            # same flat x, y, c layout per key as the OpenPose json files
+            result = {"clip_id": clip_id, "frames": []}
+            for idx, frame in enumerate(frames):
+                entry = {"frame": start + idx}
+                for k, part in key_slices().items():
+                    entry[k] = frame[part].reshape(-1).tolist()
+                result["frames"].append(entry)
+            print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print(__doc__)
+        sys.exit()
+
+    inspector = KeypointInspector(sys.argv[1])
+    command = sys.argv[2]
+    if command == "list":
+        inspector.list_clips()
+    elif command == "stats":
+        inspector.stats(sys.argv[3] if len(sys.argv) > 3 else None)
+    elif command == "dump" and len(sys.argv) > 3:
+        args = sys.argv[4:]
+        output_format = "json"
+        if args and args[-1] in ("json", "csv"):
+            output_format = args.pop()
+        start_frame = int(args[0]) if len(args) > 0 else None
+        end_frame = int(args[1]) if len(args) > 1 else None
+        inspector.dump(sys.argv[3], start_frame, end_frame, output_format)
+    else:
+        print(__doc__)
@@ -2,36 +2,124 @@
 
 use batches to save the files into numpy file.
 "batches": Create a txt file on the side which contains all folder names and this file is processed in batches
+"store": write all folders into a memory mapped keypoint store (see keypoint_store.py) instead of a pickled dictionary
+    - append-only: each batch of folders is written as a new shard of the store and listed in its manifest,
+      existing shards are never loaded or rewritten. An interrupted run resumes with the remaining folders.
+    - incremental: folders.json in the store keeps file count, size, mtime and content hash of each ingested folder.
+      A re-run (no folders left in remaining_folders.txt) compares it with the json directory and re-ingests only
+      added or modified folders, removed folders are dropped from the store.
+    - the json directory may contain per clip archives (.tar, .tar.gz, .tgz, .zip) next to or instead of folders,
+      the archives are streamed into the parser without extracting them, the clip id is the archive name
+    - encoding: "float32" (default), "float16" or "int16" with per clip shift / scale, see keypoint_store.py
+    - with num_workers > 1 the folders are read by a process pool, each worker parses only the keypoints of people[0]
+      and the finished clips are streamed to the store writer, at most 16 clips per worker are in flight
+"queue": like "store", but several processes (also on different hosts sharing the target directory, e.g. via NFS) ingest
+    disjoint chunks of the folders at the same time. Start the same command on each host.
+    - the first process creates a work queue (ingest_queue/ in the target directory, see work_queue.py) with the added
+      and modified folders in chunks of 250, the others join it
+    - each process claims chunks by renaming lease files and writes a shard per chunk, a chunk whose lease was not
+      renewed for 10 minutes (crashed process) is taken over by another process
+    - the process finishing the last chunk merges all shards into the manifest of the store and deletes the queue
+catalog: catalog.sqlite in the store (or next to raw_data.npy) gets one row per ingested clip with video, segment, speaker
+    and sentence id, split (from the path of the json directory), frame count, mean confidences and the position in the
+    store, see clip_catalog.py. The catalog of a store written before is built on the next run.
+memory budget: with memory_budget_mb > 0 the accumulated clips are flushed when the RSS approaches the budget
+    - "store", "queue": the current shard is committed early, a new shard is started for the following folders
+    - "npy": the batch ends early (instead of after 2000 folders) and is merged into raw_data.npy, run the script again
+      for the remaining folders. The merge loads raw_data.npy completely, so only "store" is bounded for any corpus size
+
+usage:
+save_files.py path_to_json_dir path_to_target_dir output_format num_workers encoding memory_budget_mb
+output_format: "npy" (default, raw_data.npy dictionary), "store" (keypoint store directory) or "queue"
+num_workers: amount of processes used to read the json files in "store" and "queue" mode, default 1
+encoding: encoding of new shards in "store" and "queue" mode, default float32
+memory_budget_mb: RSS budget in MB, default 0 (no budget)
 """
 
 import json
 import os
+import shutil
 import sys
 import time
+from collections import deque
+from multiprocessing import Pool
 from pathlib import Path
 import numpy as np
-import psutil
+
+try:
+    from keypoints2text.kp_to_text_real_data.keypoint_store import ShardWriter, read_clip_source, folder_signature, \
+        folder_content_hash, open_store, is_keypoint_store, write_json_atomic, is_clip_archive, clip_id_from_source, \
+        read_manifest, shard_entry, frame_from_json, NUM_JOINTS
+    from keypoints2text.kp_to_text_real_data.clip_catalog import ClipCatalog, clip_row, split_from_path, \
+        catalog_path, build_catalog
+    from keypoints2text.kp_to_text_real_data.memory_budget import MemoryBudget
+    from keypoints2text.kp_to_text_real_data.work_queue import WorkQueue
+except ImportError:  # server uses different imports than local
+    from keypoint_store import ShardWriter, read_clip_source, folder_signature, folder_content_hash, open_store, \
+        is_keypoint_store, write_json_atomic, is_clip_archive, clip_id_from_source, read_manifest, shard_entry, \
+        frame_from_json, NUM_JOINTS
+    from clip_catalog import ClipCatalog, clip_row, split_from_path, catalog_path, build_catalog
+    from memory_budget import MemoryBudget
+    from work_queue import WorkQueue
+
+
+def read_folder(path_to_folder):
+    """
+    Read the keypoints of one folder (or archive) and create its entry for folders.json, runs in the worker processes
+    :param path_to_folder: folder or archive containing the json files of one clip
+    :return: keypoints, amount of files, amount of bytes, folder entry {"num_files", "size", "mtime", "hash"}
+    """
+    entry = folder_signature(path_to_folder)
+    keypoints, num_files, num_bytes, entry["hash"] = read_clip_source(path_to_folder)
+    return keypoints, num_files, num_bytes, entry
 
 
 class SaveFiles:
 
-    def __init__(self, path_to_json_dir, path_to_target_dir):
+    def __init__(self, path_to_json_dir, path_to_target_dir, output_format="npy", num_workers=1, encoding="float32",
+                 memory_budget_mb=None):
         self.path_to_json = Path(path_to_json_dir)
         self.path_to_target_dir = path_to_target_dir
+        self.output_format = output_format
+        self.num_workers = num_workers
+        self.encoding = encoding
+        self.split = split_from_path(self.path_to_json)
+        self.store_name = "keypoint_store"
+        self.shard_size = 2000  # folders per shard
         self.keys = ['pose_keypoints_2d', 'face_keypoints_2d', 'hand_left_keypoints_2d', 'hand_right_keypoints_2d']
         self.remaining_folders_name = "remaining_folders.txt"
+        self.folder_manifest_name = "folders.json"
+        self.queue_name = "ingest_queue"
+        self.queue_chunk_size = 250  # folders per chunk of the work queue
+        self.lease_seconds = 600
+        self.pool = None
+        self.memory_budget = MemoryBudget(memory_budget_mb)
         # set global? np.load settings. If not, np.load throws error
         old = np.load
         np.load = lambda *a, **k: old(*a, **k, allow_pickle=True)
 
     def main(self):
+        if self.output_format in ("store", "queue"):
+            self.pool = Pool(self.num_workers) if self.num_workers > 1 else None
+            try:
+                if self.output_format == "queue":
+                    self.copy_to_store_queue()
+                else:
+                    data_dir_target, subdirectories, removed = self.create_folders_store()
+                    self.copy_to_store(data_dir_target, subdirectories, removed)
+            finally:
+                if self.pool:
+                    self.pool.close()
+                    self.pool.join()
+            return
+
         # create folders and paths
         data_dir_target, subdirectories = self.create_folders()
 
         # read files to dictionary and save dictionary in target directory
         self.copy_dictionary_to_file(data_dir_target, subdirectories)
 
-    def create_folders(self):
+    def create_target_dir(self):
         if self.path_to_target_dir == "":
             data_dir_target = self.path_to_json.parent / str(self.path_to_json.name + "_saved_numpy")
         else:
@@ -40,13 +128,17 @@ class SaveFiles:
         # create new target directory, the files will be saved there
         if not os.path.exists(data_dir_target):
             os.makedirs(data_dir_target)
+        return data_dir_target
+
+    def create_folders(self):
+        data_dir_target = self.create_target_dir()
 
         if os.path.isfile(data_dir_target / self.remaining_folders_name):
             subdirectories = np.loadtxt(data_dir_target / self.remaining_folders_name, delimiter="\n",
                                         dtype="str").tolist()
         else:
-            # get subdirectories of the path
-            subdirectories = [x[1] for x in os.walk(self.path_to_json)][0]
+            # get subdirectories of the path, only the first level is listed
+            subdirectories = [folder for folder in self.get_clip_sources() if not is_clip_archive(folder)]
             np.savetxt((data_dir_target / self.remaining_folders_name), subdirectories, delimiter="\n", fmt="%s")
 
         print("%d folders left." % len(subdirectories))
@@ -60,14 +152,15 @@ class SaveFiles:
         dictionary_file_path = data_dir_target / 'raw_data.npy'
         subdirectories_file = subdirectories.copy()
 
-        # proceed in batches
-        if len(subdirectories) > 2500:
+        # proceed in batches, with a memory budget the batch ends when the budget is reached
+        if len(subdirectories) > 2500 and self.memory_budget.budget_mb is None:
             subdirectories = subdirectories[:2000]
         self.print_memory_usage()
 
         print("Saving files to %s " % dictionary_file_path)
 
         all_files = {}
+        catalog_rows = []
         index = 0
 
         for subdir in subdirectories:
@@ -83,9 +176,17 @@ class SaveFiles:
             for file in json_files:
                 temp_df = json.load(open(self.path_to_json / subdir / file))
                 all_files[subdir][file] = temp_df
+            catalog_rows.append(clip_row(subdir, np.asarray([frame_from_json(frame) for frame in
+                                                             all_files[subdir].values()]).reshape(-1, NUM_JOINTS, 3),
+                                         self.split))
 
             subdirectories_file.remove(subdir)
 
+            if self.memory_budget.exceeded():
+                print("Memory budget reached after %d folders, %d folders left for the next run" % (
+                    index, len(subdirectories_file)))
+                break
+
         self.print_memory_usage()
         np.savetxt((data_dir_target / self.remaining_folders_name), subdirectories_file, delimiter="\n", fmt="%s")
 
@@ -96,12 +197,364 @@ class SaveFiles:
             np.save(dictionary_file_path, dictionary_from_file)
         else:
             np.save(dictionary_file_path, all_files)
+        with ClipCatalog(catalog_path(dictionary_file_path)) as catalog:
+            catalog.add_clips(catalog_rows)
 
         return Path(dictionary_file_path)
 
+    def create_folders_store(self):
+        """
+        Get the folders to ingest into the store: the remaining folders of an interrupted run, otherwise all added
+        and modified folders compared to folders.json
+        :return: target directory, folders to ingest, folders to remove from the store
+        """
+        data_dir_target = self.create_target_dir()
+        remaining_path = data_dir_target / self.remaining_folders_name
+        removed = []
+
+        subdirectories = []
+        if os.path.isfile(remaining_path):
+            with open(remaining_path) as f:
+                subdirectories = [line.strip() for line in f if line.strip()]
+
+        if subdirectories:
+            print("Resuming interrupted run.")
+        else:
+            subdirectories, removed = self.find_changed_folders(data_dir_target / self.store_name)
+            np.savetxt(remaining_path, subdirectories, delimiter="\n", fmt="%s")
+
+        print("%d folders left, %d folders to remove." % (len(subdirectories), len(removed)))
+        if len(subdirectories) == 0 and len(removed) == 0:
+            print("Store is up to date. Exit.")
+            sys.exit()
+
+        return data_dir_target, subdirectories, removed
+
+    def find_changed_folders(self, store_path):
+        """
+        Compare the json directory with folders.json of the store. Folders are compared by file count, size and
+        mtime first, only folders which differ there are hashed to confirm a modification.
+        :param store_path: path to the store
+        :return: added and modified folders, removed folders
+        """
+        folders = self.get_clip_sources()
+        folder_manifest = self.read_folder_manifest(store_path)
+
+        # store written before folders.json existed: assume its clips are up to date and record them
+        if not folder_manifest and is_keypoint_store(store_path):
+            store = open_store(store_path)
+            known = [folder for folder in folders if clip_id_from_source(folder) in store]
+            print("No %s found, recording %d folders of the existing store" % (self.folder_manifest_name, len(known)))
+            entries = self.imap(folder_signature, [self.path_to_json / folder for folder in known])
+            for folder, entry, content_hash in zip(known, entries, self.imap(
+                    folder_content_hash, [self.path_to_json / folder for folder in known])):
+                entry["hash"] = content_hash
+                folder_manifest[folder] = entry
+            self.write_folder_manifest(store_path, folder_manifest)
+
+        folder_set = set(folders)
+        added = [folder for folder in folders if folder not in folder_manifest]
+        removed = [folder for folder in folder_manifest if folder not in folder_set]
+
+        known = [folder for folder in folders if folder in folder_manifest]
+        candidates = []
+        for folder, signature in zip(known, self.imap(folder_signature, [self.path_to_json / f for f in known])):
+            entry = folder_manifest[folder]
+            if any(signature[key] != entry[key] for key in signature):
+                candidates.append((folder, signature))
+
+        modified = []
+        touched = 0
+        hashes = self.imap(folder_content_hash, [self.path_to_json / folder for folder, _ in candidates])
+        for (folder, signature), content_hash in zip(candidates, hashes):
+            if content_hash != folder_manifest[folder]["hash"]:
+                modified.append(folder)
+            else:  # e.g. only the mtime changed, remember the new signature
+                signature["hash"] = content_hash
+                folder_manifest[folder] = signature
+                touched += 1
+        if touched:
+            self.write_folder_manifest(store_path, folder_manifest)
+
+        print("%d added, %d modified, %d removed, %d unchanged folders" % (
+            len(added), len(modified), len(removed), len(folders) - len(added) - len(modified)))
+        return added + modified, removed
+
+    def copy_to_store(self, data_dir_target, subdirectories, removed=()):
+        """
+        Write all folders into a sharded keypoint store, one clip per folder and one shard per self.shard_size
+        folders, a shard is committed early when the memory budget is reached. remaining_folders.txt and folders.json
+        are updated after each shard, so resuming costs only the new shards. Only the clips in flight are held in
+        memory.
+        :param data_dir_target: target directory, the store is created as a subdirectory
+        :param subdirectories: folders to read
+        :param removed: folders to drop from the store, recorded with the first new shard
+        :return: path to the store
+        """
+        store_path = data_dir_target / self.store_name
+        print("Saving files to %s with %d worker(s)" % (store_path, self.num_workers))
+
+        shard_writer = ShardWriter(store_path, self.encoding)
+        folder_manifest = self.read_folder_manifest(store_path)
+        catalog = self.open_store_catalog(store_path)
+        catalog_rows = []
+        num_files = 0
+        num_bytes = 0
+        start_time = time.time()
+        # keeps the order of the folders and hands over each clip as soon as it is parsed
+        clips = self.imap_bounded(read_folder, [self.path_to_json / subdir for subdir in subdirectories])
+
+        writer = None
+        for index, (subdir, (keypoints, files_read, bytes_read, entry)) in enumerate(zip(subdirectories, clips)):
+            if writer is None:
+                writer = shard_writer.new_shard()
+            catalog_rows.append(clip_row(clip_id_from_source(subdir), keypoints, self.split,
+                                         writer.path_to_store.name, writer.num_frames))
+            writer.add_clip(clip_id_from_source(subdir), keypoints)
+            folder_manifest[subdir] = entry
+            num_files += files_read
+            num_bytes += bytes_read
+            if index % 250 == 0:
+                print("%d of %d" % (index, len(subdirectories)))
+                self.print_memory_usage()
+
+            budget_exceeded = self.memory_budget.exceeded()
+            if len(writer.clip_ids) >= self.shard_size or budget_exceeded:
+                if budget_exceeded:
+                    print("Memory budget reached, committing shard early")
+                self.commit_shard(data_dir_target, shard_writer, writer, folder_manifest, removed,
+                                  subdirectories[index + 1:], catalog, catalog_rows)
+                removed = ()
+                catalog_rows = []
+                writer = None
+                if budget_exceeded:
+                    self.memory_budget.flushed()
+
+        # last shard, or a shard which only removes folders
+        if writer is not None or removed:
+            self.commit_shard(data_dir_target, shard_writer, writer or shard_writer.new_shard(), folder_manifest,
+                              removed, [], catalog, catalog_rows)
+        catalog.close()
+
+        self.print_throughput(num_files, num_bytes, time.time() - start_time)
+        self.print_memory_usage()
+        return store_path
+
+    def commit_shard(self, data_dir_target, shard_writer, writer, folder_manifest, removed, remaining, catalog,
+                     catalog_rows):
+        """
+        Commit a shard to the manifest and record its folders in folders.json, remaining_folders.txt and the catalog
+        :param removed: folders to drop from the store with this shard
+        :param remaining: folders still to read after this shard
+        :param catalog: ClipCatalog of the store
+        :param catalog_rows: catalog rows of the clips in the shard
+        """
+        store_path = data_dir_target / self.store_name
+        shard_writer.commit(writer, [clip_id_from_source(folder) for folder in removed])
+        catalog.remove_clips([clip_id_from_source(folder) for folder in removed])
+        catalog.add_clips(catalog_rows)
+        for folder in removed:
+            folder_manifest.pop(folder, None)
+        self.write_folder_manifest(store_path, folder_manifest)
+        print("Saved shard %s (%d folders)" % (writer.path_to_store.name, len(writer.clip_ids)))
+        np.savetxt((data_dir_target / self.remaining_folders_name), remaining, delimiter="\n", fmt="%s")
+
+    def copy_to_store_queue(self):
+        """
+        Ingest the added and modified folders together with other processes via a work queue in the target directory.
+        Each process writes its own shards, the process finishing the last chunk merges them into the manifest.
+        :return: path to the store
+        """
+        data_dir_target = self.create_target_dir()
+        store_path = data_dir_target / self.store_name
+        queue = WorkQueue(data_dir_target / self.queue_name, lease_seconds=self.lease_seconds)
+
+        if queue.exists():
+            print("Joining work queue %s" % queue.path_to_queue)
+        else:
+            subdirectories, removed = self.find_changed_folders(store_path)
+            if len(subdirectories) == 0 and len(removed) == 0:
+                print("Store is up to date. Exit.")
+                return store_path
+            if queue.create(subdirectories, self.queue_chunk_size, {"removed": removed}):
+                print("Created work queue with %d folders, %d folders to remove." % (len(subdirectories), len(removed)))
+            else:
+                print("Joining work queue %s" % queue.path_to_queue)
+
+        num_files = 0
+        num_bytes = 0
+        start_time = time.time()
+        claimed = queue.claim()
+        while claimed is not None:
+            chunk, folders = claimed
+            print("Claimed %s (%d folders) as %s" % (chunk, len(folders), queue.worker_id))
+            result = self.ingest_chunk(queue, store_path, chunk, folders)
+            if result is not None and queue.complete(chunk, result):
+                num_files += result["num_files"]
+                num_bytes += result["num_bytes"]
+            else:
+                print("Lost the lease of %s to another worker, dropping its shards" % chunk)
+                for shard in (result or {}).get("shards", []):
+                    shutil.rmtree(store_path / shard["name"], ignore_errors=True)
+            claimed = queue.claim()
+        self.print_throughput(num_files, num_bytes, time.time() - start_time)
+
+        pending = queue.pending()
+        if pending:
+            print("%d chunks are in progress on other workers, the worker finishing the last one merges the shards"
+                  % pending)
+        elif queue.claim_merge():
+            self.merge_queue(queue, store_path)
+        return store_path
+
+    def ingest_chunk(self, queue, store_path, chunk, folders):
+        """
+        Write the folders of a claimed chunk into new shards of the store, the shards are not added to the manifest
+        :return: {"shards": manifest entries, "folders": folders.json entries, "catalog": catalog rows, "num_files",
+                  "num_bytes"},
+                 None if the lease was lost
+        """
+        shard_writer = ShardWriter(store_path, self.encoding)
+        result = {"shards": [], "folders": {}, "catalog": [], "num_files": 0, "num_bytes": 0}
+        clips = self.imap_bounded(read_folder, [self.path_to_json / folder for folder in folders])
+
+        writer = None
+        for index, (folder, (keypoints, files_read, bytes_read, entry)) in enumerate(zip(folders, clips)):
+            if writer is None:
+                name = "queue_%s_%s_%d" % (chunk, queue.worker_id, len(result["shards"]))
+                writer = shard_writer.new_shard(name)
+            result["catalog"].append(clip_row(clip_id_from_source(folder), keypoints, self.split,
+                                              writer.path_to_store.name, writer.num_frames))
+            writer.add_clip(clip_id_from_source(folder), keypoints)
+            result["folders"][folder] = entry
+            result["num_files"] += files_read
+            result["num_bytes"] += bytes_read
+
+            budget_exceeded = self.memory_budget.exceeded()
+            if budget_exceeded:
+                print("Memory budget reached, closing shard early")
+                writer.close()
+                result["shards"].append(shard_entry(writer))
+                writer = None
+                self.memory_budget.flushed()
+            if index % 25 == 0 and not queue.renew(chunk):
+                if writer is not None:
+                    writer.close()
+                    result["shards"].append(shard_entry(writer))
+                for shard in result["shards"]:
+                    shutil.rmtree(store_path / shard["name"], ignore_errors=True)
+                return None
+
+        if writer is not None:
+            writer.close()
+            result["shards"].append(shard_entry(writer))
+        return result
+
+    def merge_queue(self, queue, store_path):
+        """
+        Add the shards of all chunks to the manifest and their folders to folders.json and the catalog, then delete
+        the queue.
+        Shards already in the manifest are skipped, so a merge interrupted half way can be repeated.
+        """
+        results = queue.results()
+        removed = queue.info()["removed"]
+        print("Merging the shards of %d chunks" % len(results))
+
+        shard_writer = ShardWriter(store_path, self.encoding)
+        manifest_names = set(shard["name"] for shard in read_manifest(store_path)["shards"])
+        shards = [shard for _, result in results for shard in result["shards"]]
+        new_shards = [shard for shard in shards if shard["name"] not in manifest_names]
+        if len(new_shards) < len(shards):
+            removed = []  # recorded with the shards merged before
+        if removed and not new_shards:
+            writer = shard_writer.new_shard("queue_removed_%s" % queue.worker_id)
+            writer.close()
+            new_shards = [shard_entry(writer)]
+        if new_shards:
+            shard_writer.append_shards(new_shards, [clip_id_from_source(folder) for folder in removed])
+
+        folder_manifest = self.read_folder_manifest(store_path)
+        for _, result in results:
+            folder_manifest.update(result["folders"])
+        for folder in queue.info()["removed"]:
+            folder_manifest.pop(folder, None)
+        self.write_folder_manifest(store_path, folder_manifest)
+
+        with self.open_store_catalog(store_path) as catalog:
+            catalog.remove_clips([clip_id_from_source(folder) for folder in queue.info()["removed"]])
+            for _, result in results:
+                catalog.add_clips(result["catalog"])
+
+        # shards of workers which lost their lease or crashed
+        manifest_names = set(shard["name"] for shard in read_manifest(store_path)["shards"])
+        for name in os.listdir(store_path):
+            if name.startswith("queue_") and name not in manifest_names:
+                shutil.rmtree(store_path / name, ignore_errors=True)
+
+        queue.remove()
+        print("Merged %d shards into %s" % (len(new_shards), store_path))
+
+    def open_store_catalog(self, store_path):
+        """Catalog of the store, the catalog of a store written before the catalog existed is built first"""
+        if not os.path.isfile(catalog_path(store_path)) and is_keypoint_store(store_path):
+            print("No catalog found, indexing the existing store")
+            return build_catalog(store_path, self.split)
+        if not os.path.exists(store_path):
+            os.makedirs(store_path)
+        return ClipCatalog(catalog_path(store_path))
+
+    def get_clip_sources(self):
+        """
+        Folders and archives in the json directory, each of them holds the json files of one clip
+        :return: sorted list of names
+        """
+        with os.scandir(self.path_to_json) as entries:
+            return sorted(entry.name for entry in entries if entry.is_dir() or is_clip_archive(entry.name))
+
+    def imap(self, func, items):
+        """Apply func to all items in order, in the process pool if there is one"""
+        if self.pool:
+            return self.pool.imap(func, items, chunksize=4)
+        return map(func, items)
+
+    def imap_bounded(self, func, items):
+        """
+        Like imap, but at most 16 items per worker are in flight. Pool.imap submits all items at once and collects the
+        results of fast workers in memory if the consumer is slower.
+        """
+        if not self.pool:
+            yield from map(func, items)
+            return
+        pending = deque()
+        for item in items:
+            pending.append(self.pool.apply_async(func, (item,)))
+            if len(pending) >= 16 * self.num_workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+    def read_folder_manifest(self, store_path):
+        """
+        Read folders.json of the store
+        :return: dictionary folder -> {"num_files", "size", "mtime", "hash"}, empty if there is none
+        """
+        if not os.path.isfile(store_path / self.folder_manifest_name):
+            return {}
+        with open(store_path / self.folder_manifest_name) as f:
+            return json.load(f)
+
+    def write_folder_manifest(self, store_path, folder_manifest):
+        if not os.path.exists(store_path):
+            os.makedirs(store_path)
+        write_json_atomic(store_path / self.folder_manifest_name, folder_manifest)
+
+    def print_throughput(self, num_files, num_bytes, elapsed_time):
+        elapsed_time = max(elapsed_time, 1e-9)
+        print("Read %d files (%.1f MB) in %.1f s: %.1f files/s, %.2f MB/s" % (
+            num_files, num_bytes / 1000000, elapsed_time, num_files / elapsed_time, num_bytes / 1000000 / elapsed_time))
+
     def print_memory_usage(self):
-        process = psutil.Process(os.getpid())
-        print("Current memory usage: %.1f MB" % float(process.memory_info().rss / 1000000))  # divided to get mb
+        self.memory_budget.print_memory_usage()
 
 
 if __name__ == '__main__':
@@ -116,8 +569,28 @@ if __name__ == '__main__':
     path_to_target_dir = ""
     if len(sys.argv) > 2:
         path_to_target_dir = sys.argv[2]
+
+    # output format, "npy" or "store"
+    output_format = "npy"
+    if len(sys.argv) > 3:
+        output_format = sys.argv[3]
+
+    # amount of processes reading json files
+    num_workers = 1
+    if len(sys.argv) > 4:
+        num_workers = int(sys.argv[4])
+
+    # encoding of the keypoint store
+    encoding = "float32"
+    if len(sys.argv) > 5:
+        encoding = sys.argv[5]
+
+    # RSS budget in MB, 0 -> no budget
+    memory_budget_mb = 0
+    if len(sys.argv) > 6:
+        memory_budget_mb = float(sys.argv[6])
     try:
-        norm = SaveFiles(path_to_json_dir, path_to_target_dir)
+        norm = SaveFiles(path_to_json_dir, path_to_target_dir, output_format, num_workers, encoding, memory_budget_mb)
         start_time = time.time()
         norm.main()
         print("--- %.4s seconds ---" % (time.time() - start_time))
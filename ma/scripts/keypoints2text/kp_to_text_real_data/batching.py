@@ -0,0 +1,151 @@
+"""batching.py: length bucketed batches under a frame budget, padded per batch
+
+Instead of padding every clip and sentence to one fixed padding value, clips of similar length are put into the same
+batch and each batch is padded only to its own longest clip and sentence.
+
+- LengthBucketSampler groups the clips into buckets of bucket_width frames (shuffled within the buckets) and fills each
+  batch until batch size * longest clip would exceed max_frames (optionally also batch size * longest sentence
+  > max_tokens). Clips longer than max_frames (or sentences longer than max_tokens) are skipped instead of being
+  replaced by random other clips. The order of the batches is shuffled each epoch.
+- pad_collate pads a batch and returns a PaddedBatch with length and mask tensors. PaddedBatch is a tuple starting with
+  source and target, so batch[0] / batch[1] work as with the default collate.
+
+The dataset must return unpadded samples (kp_max_len=0, text_max_len=0).
+
+usage:
+    dataset = TextKeypointsDataset(..., transform=ToTensor(), kp_max_len=0, text_max_len=0)
+    loader = bucketed_loader(dataset, max_frames=4000)
+    for batch in loader:
+        batch.source  # (batch, longest clip, features), batch.source_mask: True for real frames
+"""
+
+from collections import namedtuple
+import numpy as np
+import torch
+import torch.utils.data
+from torch.nn.utils.rnn import pad_sequence
+
+try:
+    from keypoints2text.kp_to_text_real_data.data_loader import loader_args
+except ImportError:  # server uses different imports than local
+    from data_loader import loader_args
+
+PaddedBatch = namedtuple("PaddedBatch", ["source", "target", "source_lengths", "target_lengths", "source_mask",
+                                         "target_mask", "validity"])
+
+
+class LengthBucketSampler(torch.utils.data.Sampler):
+    """Batch sampler, yields lists of dataset indexes, see module docstring"""
+
+    def __init__(self, source_lengths, max_frames, target_lengths=None, max_tokens=0, bucket_width=8,
+                 max_batch_size=0, shuffle=True, seed=0):
+        """
+        :param source_lengths: frames of each sample, 0 for samples which can not be loaded
+        :param max_frames: budget of padded frames per batch (batch size * longest clip)
+        :param target_lengths: ids of each sentence, only needed with max_tokens
+        :param max_tokens: budget of padded target ids per batch, 0: no budget
+        :param bucket_width: frames per bucket, clips are only shuffled within their bucket
+        :param max_batch_size: upper limit of samples per batch, 0: no limit
+        :param shuffle: False keeps the batches sorted by length, e.g. for evaluation
+        :param seed: seed of the shuffling, each epoch uses seed + epoch
+        """
+        self.source_lengths = np.asarray(source_lengths, dtype=np.int64)
+        self.target_lengths = None if target_lengths is None else np.asarray(target_lengths, dtype=np.int64)
+        self.max_frames = max_frames
+        self.max_tokens = max_tokens if self.target_lengths is not None else 0
+        self.bucket_width = bucket_width
+        self.max_batch_size = max_batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+        usable = (self.source_lengths > 0) & (self.source_lengths <= max_frames)
+        if self.max_tokens > 0:
+            usable &= self.target_lengths <= self.max_tokens
+        self.indexes = np.flatnonzero(usable)
+        self.num_skipped = len(self.source_lengths) - len(self.indexes)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def batches(self, rng=None):
+        """
+        :param rng: np.random.Generator to shuffle within the buckets and the order of the batches, None keeps the
+            samples sorted by length
+        :return: list of lists of dataset indexes
+        """
+        lengths = self.source_lengths[self.indexes]
+        if rng is None:
+            order = self.indexes[np.argsort(lengths, kind="stable")]
+        else:
+            order = self.indexes[np.lexsort((rng.random(len(lengths)), lengths // self.bucket_width))]
+
+        batches = []
+        batch = []
+        longest_source = 0
+        longest_target = 0
+        for idx in order.tolist():
+            source = max(longest_source, self.source_lengths[idx])
+            target = max(longest_target, self.target_lengths[idx]) if self.max_tokens > 0 else 0
+            full = (len(batch) + 1) * source > self.max_frames or (len(batch) + 1) * target > self.max_tokens or \
+                0 < self.max_batch_size <= len(batch)
+            if batch and full:
+                batches.append(batch)
+                batch = []
+                source = self.source_lengths[idx]
+                target = self.target_lengths[idx] if self.max_tokens > 0 else 0
+            batch.append(idx)
+            longest_source = source
+            longest_target = target
+        if batch:
+            batches.append(batch)
+        if rng is not None:
+            rng.shuffle(batches)
+        return batches
+
+    def __iter__(self):
+        rng = np.random.default_rng(self.seed + self.epoch) if self.shuffle else None
+        self.epoch += 1
+        return iter(self.batches(rng))
+
+    def __len__(self):
+        """Amount of batches of the sorted order, the shuffled batches of an epoch may differ by a few"""
+        return len(self.batches())
+
+
+def pad_collate(batch):
+    """
+    Pad the samples of a batch to the longest clip and sentence of the batch
+    :param batch: list of dataset samples (keys, sentence) or (keys, sentence, validity)
+    :return: PaddedBatch, source (batch, frames, features) float, target (batch, ids) long padded with <pad> = 0,
+        lengths (batch,), masks True for real frames / ids, validity (batch, frames, features) or None
+    """
+    sources = [torch.as_tensor(sample[0], dtype=torch.float) for sample in batch]
+    targets = [torch.as_tensor(sample[1], dtype=torch.long) for sample in batch]
+    source_lengths = torch.as_tensor([source.size(0) for source in sources], dtype=torch.long)
+    target_lengths = torch.as_tensor([target.size(0) for target in targets], dtype=torch.long)
+    source = pad_sequence(sources, batch_first=True)
+    target = pad_sequence(targets, batch_first=True, padding_value=0)
+    source_mask = torch.arange(source.size(1))[None, :] < source_lengths[:, None]
+    target_mask = torch.arange(target.size(1))[None, :] < target_lengths[:, None]
+    validity = None
+    if len(batch[0]) > 2:
+        validity = pad_sequence([torch.as_tensor(sample[2], dtype=torch.bool) for sample in batch], batch_first=True)
+    return PaddedBatch(source, target, source_lengths, target_lengths, source_mask, target_mask, validity)
+
+
+def bucketed_loader(dataset, max_frames, max_tokens=0, shuffle=True, num_workers=0, prefetch_factor=2,
+                    **sampler_args):
+    """
+    DataLoader of a TextKeypointsDataset with LengthBucketSampler and pad_collate
+    :param dataset: TextKeypointsDataset with kp_max_len=0 and text_max_len=0
+    :param num_workers: worker processes, see data_loader.loader_args
+    :param sampler_args: further arguments of LengthBucketSampler, e.g. bucket_width
+    """
+    sampler = LengthBucketSampler(dataset.lengths.source_lengths, max_frames, dataset.lengths.target_lengths,
+                                  max_tokens, shuffle=shuffle, **sampler_args)
+    if sampler.num_skipped:
+        print("Skipping %d of %d samples longer than the batch budget or without keypoints" %
+              (sampler.num_skipped, len(sampler.source_lengths)))
+    return torch.utils.data.DataLoader(dataset, batch_sampler=sampler, collate_fn=pad_collate,
+                                       **loader_args(num_workers, prefetch_factor))
@@ -0,0 +1,215 @@
+"""clip_catalog.py: catalog of all ingested clips, one row per clip
+
+save_files.py writes catalog.sqlite into the keypoint store (or next to raw_data.npy) while it ingests the clips. The
+tools select clips with indexed queries (speaker, split) instead of walking the json directories and parsing the
+folder names on their own.
+
+Folder names of How2Sign: <video id, 11 characters>_<segment>-<speaker id>-<camera>, e.g. ad4_GWc5XRo_10-5-rgb_front
+    video_id     ad4_GWc5XRo
+    segment_id   10
+    speaker_id   5
+    sentence_id  ad4_GWc5XRo_10 (first column of how2sign.*.id_transformed.txt)
+The split (train, val, test) is taken from the path of the json directory.
+
+table clips:
+    clip_id, video_id, segment_id, speaker_id, split, num_frames,
+    conf_pose, conf_face, conf_hand_left, conf_hand_right   mean confidence per body part
+    shard, store_offset                                     shard of the store and first frame of the clip in it
+    sentence_id
+
+usage:
+clip_catalog.py path_to_store [split]
+    build the catalog of a store written before the catalog existed
+"""
+
+import os
+import sqlite3
+import sys
+from pathlib import Path
+import numpy as np
+
+try:
+    from keypoints2text.kp_to_text_real_data.keypoint_store import key_slices, is_keypoint_store, read_manifest, \
+        KeypointStore, MANIFEST_NAME
+except ImportError:  # server uses different imports than local
+    from keypoint_store import key_slices, is_keypoint_store, read_manifest, KeypointStore, MANIFEST_NAME
+
+CATALOG_NAME = "catalog.sqlite"
+SPLITS = ("train", "val", "test")
+COLUMNS = ["clip_id", "video_id", "segment_id", "speaker_id", "split", "num_frames", "conf_pose", "conf_face",
+           "conf_hand_left", "conf_hand_right", "shard", "store_offset", "sentence_id"]
+
+
+def parse_clip_id(clip_id):
+    """
+    Split a How2Sign folder name into its parts
+    :param clip_id: e.g. ad4_GWc5XRo_10-5-rgb_front
+    :return: video id, segment id, speaker id, sentence id, None for parts the name does not contain
+    """
+    video_id = clip_id[:11]
+    sentence_id = video_id + clip_id[11:].split("-")[0]
+    segment = sentence_id[12:]
+    segment_id = int(segment) if segment.isdigit() else None
+    parts = clip_id.split("-")
+    speaker_id = int(parts[-2]) if len(parts) > 2 and parts[-2].isdigit() else None
+    return video_id, segment_id, speaker_id, sentence_id
+
+
+def split_from_path(path):
+    """Last directory of the path named train, val or test, None if there is none"""
+    for part in reversed(Path(path).resolve().parts):
+        if part in SPLITS:
+            return part
+    return None
+
+
+def clip_row(clip_id, keypoints, split=None, shard=None, store_offset=None):
+    """
+    Catalog row of a clip
+    :param keypoints: array of shape (frames, 137, 3)
+    :param shard: shard of the store the clip is written to
+    :param store_offset: first frame of the clip in the shard
+    :return: dictionary with all COLUMNS
+    """
+    video_id, segment_id, speaker_id, sentence_id = parse_clip_id(clip_id)
+    row = {"clip_id": clip_id, "video_id": video_id, "segment_id": segment_id, "speaker_id": speaker_id,
+           "split": split, "num_frames": int(len(keypoints)), "shard": shard,
+           "store_offset": None if store_offset is None else int(store_offset), "sentence_id": sentence_id}
+    keypoints = np.asarray(keypoints)
+    for column, part in zip(["conf_pose", "conf_face", "conf_hand_left", "conf_hand_right"], key_slices().values()):
+        row[column] = float(keypoints[:, part, 2].mean()) if len(keypoints) else None
+    return row
+
+
+class ClipCatalog:
+    """
+    usage:
+        with ClipCatalog(path) as catalog:
+            catalog.add_clips([clip_row(...), ...])
+            catalog.clip_ids(split="train", speaker_ids=[1, 2])
+    """
+
+    def __init__(self, path_to_catalog):
+        self.path_to_catalog = Path(path_to_catalog)
+        self.connection = sqlite3.connect(str(self.path_to_catalog))
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS clips (clip_id TEXT PRIMARY KEY, video_id TEXT, segment_id INTEGER, "
+            "speaker_id INTEGER, split TEXT, num_frames INTEGER, conf_pose REAL, conf_face REAL, "
+            "conf_hand_left REAL, conf_hand_right REAL, shard TEXT, store_offset INTEGER, sentence_id TEXT)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS clips_speaker ON clips (speaker_id)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS clips_split ON clips (split, speaker_id)")
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM clips").fetchone()[0]
+
+    def add_clips(self, rows):
+        """Insert the rows in one transaction, rows of existing clips are replaced"""
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO clips (%s) VALUES (%s)" % (", ".join(COLUMNS), ", ".join("?" * len(COLUMNS))),
+                [[row[column] for column in COLUMNS] for row in rows])
+
+    def remove_clips(self, clip_ids):
+        with self.connection:
+            self.connection.executemany("DELETE FROM clips WHERE clip_id = ?", [(clip_id,) for clip_id in clip_ids])
+
+    def select(self, columns=("clip_id",), split=None, speaker_ids=None):
+        """
+        Select clips ordered by clip id
+        :param columns: columns to return
+        :param split: only clips of this split
+        :param speaker_ids: only clips of these speakers
+        :return: list of tuples
+        """
+        for column in columns:
+            if column not in COLUMNS:
+                raise ValueError("Unknown column %s, use one of %s" % (column, ", ".join(COLUMNS)))
+        where, parameters = self.where(split, speaker_ids)
+        return self.connection.execute("SELECT %s FROM clips%s ORDER BY clip_id" % (", ".join(columns), where),
+                                       parameters).fetchall()
+
+    def clip_ids(self, split=None, speaker_ids=None):
+        return [row[0] for row in self.select(("clip_id",), split, speaker_ids)]
+
+    def first_clip_per_speaker(self, speaker_ids, split=None):
+        """
+        First clip (by clip id) of each speaker
+        :return: dictionary speaker id -> clip id, speakers without clips are missing
+        """
+        where, parameters = self.where(split, speaker_ids)
+        rows = self.connection.execute("SELECT speaker_id, MIN(clip_id) FROM clips%s GROUP BY speaker_id" % where,
+                                       parameters).fetchall()
+        return dict(rows)
+
+    def where(self, split, speaker_ids):
+        conditions = []
+        parameters = []
+        if split is not None:
+            conditions.append("split = ?")
+            parameters.append(split)
+        if speaker_ids is not None:
+            speaker_ids = [int(speaker_id) for speaker_id in speaker_ids]
+            conditions.append("speaker_id IN (%s)" % ", ".join("?" * len(speaker_ids)))
+            parameters += speaker_ids
+        return (" WHERE " + " AND ".join(conditions)) if conditions else "", parameters
+
+    def close(self):
+        self.connection.close()
+
+
+def catalog_path(path):
+    """Catalog of a keypoint store, of a raw_data.npy file or the catalog file itself"""
+    path = Path(path)
+    if path.is_dir():
+        return path / CATALOG_NAME
+    if path.name == CATALOG_NAME:
+        return path
+    return path.parent / CATALOG_NAME
+
+
+def open_catalog(path):
+    """
+    Open the catalog of a store or npy file
+    :return: ClipCatalog or None if there is no catalog
+    """
+    if not os.path.isfile(catalog_path(path)):
+        return None
+    return ClipCatalog(catalog_path(path))
+
+
+def build_catalog(path_to_store, split=None):
+    """
+    Write the catalog of an existing keypoint store, reads the confidences of all clips once
+    :return: ClipCatalog
+    """
+    path_to_store = Path(path_to_store)
+    if os.path.isfile(path_to_store / MANIFEST_NAME):
+        manifest = read_manifest(path_to_store)
+        shards = [(shard["name"], KeypointStore(path_to_store / shard["name"]), shard.get("removed", []))
+                  for shard in manifest["shards"]]
+    else:
+        shards = [(None, KeypointStore(path_to_store), [])]
+
+    catalog = ClipCatalog(catalog_path(path_to_store))
+    for name, shard, removed in shards:  # in manifest order, later shards replace clips of earlier shards
+        catalog.remove_clips(removed)
+        catalog.add_clips([clip_row(clip_id, shard.get_clip_by_index(idx), split, name, shard.offsets[idx])
+                           for idx, clip_id in enumerate(shard.clip_ids)])
+    return catalog
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or not is_keypoint_store(sys.argv[1]):
+        print(__doc__)
+        sys.exit()
+
+    split = sys.argv[2] if len(sys.argv) > 2 else split_from_path(sys.argv[1])
+    with build_catalog(sys.argv[1], split) as catalog:
+        print("%d clips in %s" % (len(catalog), catalog.path_to_catalog))
@@ -4,7 +4,23 @@ Based on that tutorial
 https://stanford.edu/~shervine/blog/pytorch-how-to-generate-data-parallel
 
 Features:
-- not able to handle "null", skip if reading "null"
+- missing joints ("Null" in older npy files, NaN) are filled with missing_value (default 0.0), with
+  return_validity=True each sample also holds a bool tensor of the valid values (False for missing joints and padding)
+- normalization="global", "speaker" or "split" (keypoint store only): the clips are centralized and normalized when
+  they are loaded, with stats cached next to the store (see normalization_stats.py), no normalized copy is needed
+- feature_spec (see feature_spec.py) selects the joint groups, confidence and layout of the frame vectors, default
+  DEFAULT_FEATURES (256 values: upper body, head, face, hands, x values, y values, 6 * 0.0)
+- feature_cache="memory", "shared" or "disk" (see feature_cache.py): the frame vectors of all clips are built once,
+  __getitem__ only slices them, "disk" keeps the cache next to the keypoints for the next runs
+- DataLoader workers (num_workers > 0, see loader_args): the bulk data is in shared memory (feature_cache="shared") or
+  memory mapped (keypoint store, feature_cache="disk"), a worker gets paths and shared memory handles instead of a
+  copy of the data. The .npy dictionary is dropped once the feature cache is built.
+- the sentences are tokenized once into int32 ids and cached next to the csv file (see token_cache.py), a subword
+  vocab file (see subword.py) gives subword ids instead of word ids
+- clip_lengths() and sentence_lengths() feed the length bucketed batches of batching.py, dataset.lengths (see
+  length_stats.py) keeps them in a sidecar file with max, percentiles and histograms
+- path_to_numpy_file may point to a .npy dictionary or to a keypoint store directory (see keypoint_store.py), a
+  keypoint store is memory mapped instead of loaded into RAM
 
 """
 
@@ -13,12 +29,29 @@ from torch.utils import data
 import pandas as pd
 import numpy as np
 import numbers
+import os
 import random
 
 try:
     from keypoints2text.kp_to_text_real_data.data_utils import DataUtils
+    from keypoints2text.kp_to_text_real_data.keypoint_store import open_store, is_keypoint_store, sorted_frame_names
+    from keypoints2text.kp_to_text_real_data.missing_joints import keypoints_from_person
+    from keypoints2text.kp_to_text_real_data.normalization_stats import NormalizationStats
+    from keypoints2text.kp_to_text_real_data.feature_spec import DEFAULT_FEATURES
+    from keypoints2text.kp_to_text_real_data.feature_cache import FeatureCache, cache_key, cache_path, MODES
+    from keypoints2text.kp_to_text_real_data.token_cache import TokenCache
+    from keypoints2text.kp_to_text_real_data.vocabulary import Vocabulary
+    from keypoints2text.kp_to_text_real_data.length_stats import LengthStats
 except ImportError:  # server uses different imports than local
     from data_utils import DataUtils
+    from keypoint_store import open_store, is_keypoint_store, sorted_frame_names
+    from missing_joints import keypoints_from_person
+    from normalization_stats import NormalizationStats
+    from feature_spec import DEFAULT_FEATURES
+    from feature_cache import FeatureCache, cache_key, cache_path, MODES
+    from token_cache import TokenCache
+    from vocabulary import Vocabulary
+    from length_stats import LengthStats
 
 
 class TextKeypointsDataset(data.Dataset):
@@ -27,7 +60,17 @@ class TextKeypointsDataset(data.Dataset):
     """
 
     def __init__(self, path_to_numpy_file, path_to_csv, path_to_vocab_file, input_length, transform=None, kp_max_len=0,
-                 text_max_len=0):
+                 text_max_len=0, missing_value=0.0, return_validity=False, normalization=None,
+                 feature_spec=None, feature_cache=None):
+        """
+        :param missing_value: value of missing joints in the keypoint tensors
+        :param return_validity: return (keys, sentence, validity) instead of (keys, sentence)
+        :param normalization: normalization variant of normalization_stats.py applied to each clip, e.g. "speaker",
+            None uses the stored keypoints as they are
+        :param feature_spec: FeatureSpec of the frame vectors, None uses DEFAULT_FEATURES, input_length is its size
+        :param feature_cache: "memory", "shared" or "disk" to precompute the frame vectors of all clips, None builds them in
+            each __getitem__
+        """
         self.path_to_numpy_file = path_to_numpy_file
         self.path_to_csv = path_to_csv
         self.path_to_vocab_file = path_to_vocab_file
@@ -35,6 +78,13 @@ class TextKeypointsDataset(data.Dataset):
         self.transform = transform
         self.kp_max_len = kp_max_len
         self.text_max_len = text_max_len
+        self.missing_value = missing_value
+        self.return_validity = return_validity
+        self.feature_spec = DEFAULT_FEATURES if feature_spec is None else feature_spec
+        if self.feature_spec.size != input_length:
+            raise ValueError("input_length %d does not match the %d values of %s" % (input_length,
+                                                                                   self.feature_spec.size,
+                                                                                   self.feature_spec))
 
         # init variables
         self.int2word = {}
@@ -49,13 +99,56 @@ class TextKeypointsDataset(data.Dataset):
 
         # load keypoints
         self.saved_column_kp = self.df_kp_text_train['keypoints']
-        self.all_files = np.load(self.path_to_numpy_file).item()
+        self.store = None
+        self.all_files = None
+        self.normalization = None
+        self.feature_cache = None
+        if normalization is not None and not is_keypoint_store(self.path_to_numpy_file):
+            raise ValueError("normalization=%s needs a keypoint store, %s is not one" % (normalization,
+                                                                                      self.path_to_numpy_file))
+        if feature_cache is not None and feature_cache not in MODES:
+            raise ValueError("Unknown feature_cache %s, use one of %s" % (feature_cache, ", ".join(MODES)))
+
+        path_to_cache = None
+        if feature_cache == "disk":
+            key = cache_key(self.path_to_numpy_file, self.saved_column_kp, feature_spec=self.feature_spec,
+                            normalization=normalization, missing_value=self.missing_value)
+            path_to_cache = cache_path(self.path_to_numpy_file, key)
+            if os.path.isdir(path_to_cache):
+                self.feature_cache = FeatureCache.load(path_to_cache)
+
+        # the keypoints are only needed if there is no cache on disk yet
+        if self.feature_cache is None:
+            if is_keypoint_store(self.path_to_numpy_file):
+                self.store = open_store(self.path_to_numpy_file)
+                if normalization is not None:
+                    self.normalization = NormalizationStats.load_or_compute(self.path_to_numpy_file, normalization)
+            else:
+                self.all_files = np.load(self.path_to_numpy_file).item()
+            if feature_cache is not None:
+                self.feature_cache = self.build_feature_cache(path_to_cache)
+                # all clips of the csv file are in the cache, the keypoints are not needed anymore
+                self.store = None
+                self.all_files = None
+                self.normalization = None
+        if feature_cache == "shared":
+            self.feature_cache.share_memory()
 
         # load text
         self.saved_column_text = self.df_kp_text_train['text']
 
         # load vocab dictionaries
-        self.word2int = DataUtils().vocab_word2int(self.path_to_vocab_file)  # e.g. print: 'who': 0
+        self.vocab = Vocabulary.load(self.path_to_vocab_file)
+        self.word2int = self.vocab.word2int  # e.g. print: 'who': 0
+
+        # word ids of all sentences, <sos> ... <eos>
+        self.tokens = TokenCache.load_or_build(self.path_to_csv, self.saved_column_text, self.path_to_vocab_file,
+                                               self.vocab)
+
+        # frames and word ids of each line, max / percentiles / histograms without loading the samples
+        self.lengths = LengthStats.load_or_build(self.path_to_numpy_file, self.path_to_csv, self.path_to_vocab_file,
+                                                 self.saved_column_kp,
+                                                 lambda: (self.clip_lengths(), self.sentence_lengths()))
 
         # get amount of data
         self.amount_of_files = DataUtils().get_file_length(self.path_to_csv)
@@ -72,49 +165,94 @@ class TextKeypointsDataset(data.Dataset):
             ################################################
             # return 20  # subtract 1, because of header line
 
+    def build_feature_cache(self, path_to_cache=None):
+        """
+        Frame vectors of all clips of the csv file which are in the keypoints
+        :param path_to_cache: save the cache there, None keeps it in memory only
+        """
+        available = self.store if self.store is not None else self.all_files
+        clip_ids = [clip_id for clip_id in dict.fromkeys(self.saved_column_kp) if clip_id in available]
+        print("Building feature cache of %d clips" % len(clip_ids))
+        cache = FeatureCache.build(clip_ids, self.get_features, self.missing_value, self.feature_spec.size)
+        if path_to_cache is not None:
+            os.makedirs(path_to_cache.parent, exist_ok=True)
+            cache.save(path_to_cache)
+            cache = FeatureCache.load(path_to_cache)
+        return cache
+
+    def get_features(self, subdirectory):
+        """Frame vectors of one folder, NaN for missing joints"""
+        if self.store is not None:
+            return self.get_store_keypoints(subdirectory)
+        return self.get_dictionary_keypoints(subdirectory)
+
+    def get_keypoints(self, subdirectory):
+        """
+        Frame vectors of one folder with the missing joints filled
+        :return: np.ndarray (frames, feature_spec.size), validity (bool array of the same shape, None from the cache
+            without return_validity)
+        """
+        if self.feature_cache is not None:
+            return self.feature_cache.get(subdirectory, with_validity=self.return_validity)
+        keypoints = self.get_features(subdirectory)
+        validity = ~np.isnan(keypoints)
+        return np.where(validity, keypoints, np.float32(self.missing_value)), validity
+
+    def clip_lengths(self):
+        """
+        Frames of the clip of each line of the csv file, without loading the clips
+        :return: np.ndarray (lines,), 0 for clips which are not in the keypoints
+        """
+        if self.feature_cache is not None:
+            index, lengths = self.feature_cache.clip_index, self.feature_cache.lengths
+        elif self.store is not None:
+            index, lengths = self.store.clip_index, self.store.lengths
+        else:
+            return np.asarray([len(self.all_files.get(clip_id, ())) for clip_id in self.saved_column_kp],
+                              dtype=np.int64)
+        return np.asarray([lengths[index[clip_id]] if clip_id in index else 0 for clip_id in self.saved_column_kp],
+                          dtype=np.int64)
+
+    def sentence_lengths(self):
+        """Word ids (<sos> ... <eos>) of the sentence of each line of the csv file, np.ndarray (lines,)"""
+        return self.tokens.lengths
+
+    def get_dictionary_keypoints(self, subdirectory):
+        """
+        Build the frame vectors of one folder from the legacy .npy dictionary, the json files are sorted by frame
+        number as convert_legacy_npy does for the keypoint store (the dictionary keeps the os.listdir order)
+        :param subdirectory: folder name
+        :return: np.ndarray (frames, feature_spec.size), NaN for missing joints ("Null" or NaN)
+        """
+        files = self.all_files[subdirectory]
+        # frames x 137 joints x (x, y, c)
+        clip = np.stack([keypoints_from_person(files[file]['people'][0]) for file in sorted_frame_names(files)])
+        return self.feature_spec.apply(clip, decoded=False)
+
+    def get_store_keypoints(self, subdirectory):
+        """
+        Build the frame vectors of one folder from the keypoint store, same layout as get_dictionary_keypoints
+        :param subdirectory: folder name
+        :return: np.ndarray (frames, feature_spec.size)
+        """
+        if self.normalization is not None:
+            # the centralization needs the neck and the legs, normalize all joints and select the used ones
+            clip = self.normalization.transform(subdirectory, self.store.get_clip(subdirectory))
+            return self.feature_spec.apply(clip, decoded=False)
+        # only the used joints are decoded
+        return self.feature_spec.apply(self.store.get_clip(subdirectory, self.feature_spec.joints))
+
     def __getitem__(self, index):
         """
         Generates one sample of data
         :param index:
         :return:
         """
-        # init keypoints
-        keypoints = []
         keys_per_folder = []
         while 1:
             # get specific subdirectory corresponding to the index
             subdirectory = self.saved_column_kp[index]
-            keys = ['pose_keypoints_2d', 'face_keypoints_2d', 'hand_left_keypoints_2d', 'hand_right_keypoints_2d']
-            keys_per_folder = []
-            keys_per_folder_256 = []
-            #print("--"*20)
-            #print(subdirectory)
-
-            for file in self.all_files[subdirectory]:
-                temp_df = self.all_files[subdirectory][file]
-                # init dictionaries & write x, y values into dictionary
-                keys_x = []
-                keys_y = []
-                keys_x_256 = []
-                keys_y_256 = []
-                for k in keys:
-                    if k == "pose_keypoints_2d":
-                        # keys_x.extend(temp_df['people'][0][k][0::3])
-                        # keys_y.extend(temp_df['people'][0][k][1::3])
-
-                        keys_x_256 = temp_df['people'][0][k][0:25:3]
-                        keys_x_256.extend(temp_df['people'][0][k][45:55:3])
-                        keys_y_256 = temp_df['people'][0][k][1:26:3]
-                        keys_y_256.extend(temp_df['people'][0][k][46:56:3])
-                    else:
-                        # keys_x.extend(temp_df['people'][0][k][0::3])
-                        # keys_y.extend(temp_df['people'][0][k][1::3])
-
-                        keys_x_256.extend(temp_df['people'][0][k][0::3])
-                        keys_y_256.extend(temp_df['people'][0][k][1::3])
-
-                # keys_per_folder.append(keys_x + keys_y)
-                keys_per_folder.append(keys_x_256 + keys_y_256 + [0.0, 0.0, 0.0, 0.0, 0.0, 0.0])
+            keys_per_folder, validity = self.get_keypoints(subdirectory)
 
             # transform to tensor here
             if self.transform:
@@ -142,35 +280,44 @@ class TextKeypointsDataset(data.Dataset):
             keys = torch.zeros(temp_max_len, self.input_length)
             source = keys_per_folder
             keys[:length, :] = source
-
-
+            if validity is not None:
+                validity_padded = np.zeros((temp_max_len, self.input_length), dtype=bool)
+                validity_padded[:length, :] = validity
+                validity = validity_padded
         else:
             keys = keys_per_folder
 
         # load sentences
-        # take the sentence column of .csv file and the word2int representation
-        # -> transform sentence to index and take one line of it
-        # print(self.saved_column_text[index])
-        sentence = []
-        sentence.append(self.word2int["<sos>"])
-        sentence.extend([int(i) for i in DataUtils().text2index([self.saved_column_text[index]], self.word2int)[0]])
-        sentence.append(self.word2int["<eos>"])  # append EOS (should be int(3))
-        # with open('log_batches.txt', 'a') as f:
-        #    f.write("sentence\n")
-        #    f.write(str(sentence))
-        #    f.write("\n")
-        # Set padding length (uncomment following 2 lines for padding)
+        # the word ids (<sos> ... <eos>) of the sentence of this line of the .csv file, tokenized in __init__
+        ids = self.tokens.get(index)
+        # Set padding length
         padding_length = self.text_max_len
-        sentence += [0] * (padding_length - len(sentence))
+        sentence = np.zeros(max(padding_length, len(ids)), dtype=np.int64)
+        sentence[:len(ids)] = ids
         # transform to tensor via ToTensor TODO remove class and implement here?
         if self.transform:
             sentence = self.transform(sentence)
+        else:
+            sentence = sentence.tolist()
         # print(sentence)
 
-
+        if self.return_validity:
+            return keys, sentence, torch.from_numpy(validity)
         return keys, sentence
 
 
+def loader_args(num_workers=0, prefetch_factor=2):
+    """
+    DataLoader arguments for num_workers worker processes, the workers persist over the epochs instead of being started
+    (and getting the dataset) again for each epoch
+    :param prefetch_factor: batches loaded in advance per worker
+    :return: dictionary of keyword arguments
+    """
+    if num_workers <= 0:
+        return {"num_workers": 0}
+    return {"num_workers": num_workers, "persistent_workers": True, "prefetch_factor": prefetch_factor}
+
+
 class ToTensor(object):
     """Convert ndarrays in sample to Tensors."""
 
@@ -0,0 +1,171 @@
+"""feature_cache.py: precomputed frame vectors of the clips of a dataset
+
+TextKeypointsDataset(..., feature_cache="memory", "shared" or "disk") builds the feature matrix (frames, feature_spec.size) of
+each clip once, after normalization, feature selection and filling the missing joints, and keeps all of them in one
+float32 array. __getitem__ only slices this array. The validity of the values (False for missing joints) is kept as a
+bitmask (see missing_joints.pack_validity).
+
+"shared" keeps the arrays in shared memory (torch), the DataLoader workers use them without a copy per worker, "disk"
+memory maps them, which is shared between the workers as well. The workers get the clip index and the lengths only,
+a pickled cache holds the shared tensors or the path of the memory mapped files instead of the data.
+
+"disk" persists the cache next to the keypoints and memory maps it on the next run, the pickled .npy dictionary is not
+loaded at all then:
+    <store>/feature_cache/<key>/            keypoint store
+    <dir of raw_data.npy>/feature_cache/<key>/
+The key covers the keypoints (store fingerprint, size and mtime of a .npy file), the feature spec, the normalization,
+the missing value and the clips of the csv file, a changed input never uses a stale cache.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+import numpy as np
+import torch
+
+try:
+    from keypoints2text.kp_to_text_real_data.keypoint_store import store_fingerprint, is_keypoint_store
+    from keypoints2text.kp_to_text_real_data.missing_joints import pack_validity, unpack_validity
+except ImportError:  # server uses different imports than local
+    from keypoint_store import store_fingerprint, is_keypoint_store
+    from missing_joints import pack_validity, unpack_validity
+
+CACHE_DIR = "feature_cache"
+MODES = ("memory", "shared", "disk")
+
+
+class FeatureCache:
+    """
+    usage:
+        cache = FeatureCache.build(clip_ids, load_features, missing_value=0.0)
+        features, validity = cache.get(clip_id, with_validity=True)
+    """
+
+    def __init__(self, clip_ids, features, validity, offsets, lengths):
+        """
+        :param clip_ids: clip ids in cache order
+        :param features: float32 array (frames of all clips, size), missing values filled
+        :param validity: uint8 array (frames of all clips, ceil(size / 8)), packed validity bitmask
+        :param offsets: first frame of each clip
+        :param lengths: amount of frames of each clip
+        """
+        self.clip_index = {clip_id: idx for idx, clip_id in enumerate(clip_ids)}
+        self.features = features
+        self.validity = validity
+        self.offsets = offsets
+        self.lengths = lengths
+        self.path = None  # directory of the memory mapped arrays, see load
+        self.shared = None  # shared memory tensors of features and validity, see share_memory
+
+    def __len__(self):
+        return len(self.clip_index)
+
+    def __contains__(self, clip_id):
+        return clip_id in self.clip_index
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.path is not None or self.shared is not None:
+            # pickling a memory map copies the data, the arrays are reopened from the path or the shared tensors (which
+            # the DataLoader pickles as shared memory handles)
+            state["features"] = state["validity"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.path is not None:
+            self.features = np.load(self.path / "features.npy", mmap_mode="r")
+            self.validity = np.load(self.path / "validity.npy", mmap_mode="r")
+        elif self.shared is not None:
+            self.features, self.validity = (tensor.numpy() for tensor in self.shared)
+
+    def share_memory(self):
+        """Move features and validity into shared memory, the arrays become views of the shared tensors"""
+        if self.path is None and self.shared is None:
+            self.shared = tuple(torch.from_numpy(np.ascontiguousarray(array)).share_memory_()
+                                for array in (self.features, self.validity))
+            self.features, self.validity = (tensor.numpy() for tensor in self.shared)
+        return self
+
+    @classmethod
+    def build(cls, clip_ids, load_features, missing_value=0.0, size=0):
+        """
+        :param clip_ids: clips to cache
+        :param load_features: function clip id -> float array (frames, size), NaN for missing values
+        :param missing_value: value of the missing values in the cache
+        :param size: values per frame, the shape of the arrays of an empty cache
+        """
+        clip_ids = list(clip_ids)
+        if not clip_ids:
+            # e.g. none of the clips of the csv file is in the keypoints
+            features = np.zeros((0, size), dtype=np.float32)
+            return cls(clip_ids, features, pack_validity(features), np.zeros(0, dtype=np.int64),
+                       np.zeros(0, dtype=np.int64))
+        features = []
+        validity = []
+        for clip_id in clip_ids:
+            clip = np.asarray(load_features(clip_id), dtype=np.float32)
+            validity.append(pack_validity(clip))
+            features.append(np.where(np.isnan(clip), np.float32(missing_value), clip))
+        lengths = np.asarray([clip.shape[0] for clip in features], dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+        return cls(clip_ids, np.concatenate(features), np.concatenate(validity), offsets, lengths)
+
+    def save(self, path):
+        """Write the cache into a directory, via a temporary directory, so a crashed run leaves no partial cache"""
+        path = Path(path)
+        temp_path = Path(str(path) + ".tmp")
+        shutil.rmtree(temp_path, ignore_errors=True)
+        os.makedirs(temp_path)
+        np.save(temp_path / "features.npy", self.features)
+        np.save(temp_path / "validity.npy", self.validity)
+        np.save(temp_path / "offsets.npy", self.offsets)
+        np.save(temp_path / "lengths.npy", self.lengths)
+        np.save(temp_path / "clip_ids.npy", np.asarray(list(self.clip_index), dtype=np.str_))
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Memory map the features and validity of a saved cache"""
+        path = Path(path)
+        cache = cls(np.load(path / "clip_ids.npy").tolist(), np.load(path / "features.npy", mmap_mode="r"),
+                    np.load(path / "validity.npy", mmap_mode="r"), np.load(path / "offsets.npy"),
+                    np.load(path / "lengths.npy"))
+        cache.path = path
+        return cache
+
+    def get(self, clip_id, with_validity=False):
+        """
+        :return: features (frames, size) as a read-only view, validity (bool array of the same shape) or None
+        """
+        idx = self.clip_index[clip_id]
+        part = slice(self.offsets[idx], self.offsets[idx] + self.lengths[idx])
+        features = self.features[part]
+        if not with_validity:
+            return features, None
+        return features, unpack_validity(self.validity[part], features.shape[1])
+
+
+def cache_path(path_to_keypoints, key):
+    """Directory of a cache next to a keypoint store or .npy file"""
+    path_to_keypoints = Path(path_to_keypoints)
+    parent = path_to_keypoints if is_keypoint_store(path_to_keypoints) else path_to_keypoints.parent
+    return parent / CACHE_DIR / key
+
+
+def cache_key(path_to_keypoints, clip_ids, **settings):
+    """
+    Key of the cache of some clips with some settings
+    :param settings: everything the features depend on besides the keypoints, e.g. feature_spec, normalization
+    :return: hex digest, 16 characters
+    """
+    if is_keypoint_store(path_to_keypoints):
+        data = store_fingerprint(path_to_keypoints)
+    else:
+        stat = os.stat(path_to_keypoints)
+        data = "%d-%d" % (stat.st_size, stat.st_mtime_ns)
+    content = json.dumps({"data": data, "clips": sorted(set(clip_ids)),
+                          "settings": {name: repr(value) for name, value in settings.items()}}, sort_keys=True)
+    return hashlib.sha1(content.encode()).hexdigest()[:16]
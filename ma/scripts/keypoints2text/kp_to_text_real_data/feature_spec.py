@@ -0,0 +1,110 @@
+"""feature_spec.py: declarative selection of the frame features fed to the models
+
+A FeatureSpec lists joint groups, whether the confidence is included and the layout of the coordinates. It is compiled
+once into the joints to decode from the store and a gather index, the frame vectors of a whole clip are then built
+with one fancy indexing operation on the (frames, joints, 3) array.
+
+Joint groups (JOINT_GROUPS):
+    upper_body  pose 0-8        head    pose 15-18      legs    pose 9-14, 19-24
+    face        face 0-69       hand_left / hand_right  hand 0-20
+Layouts:
+    planar       x of all joints, y of all joints (, c of all joints)
+    interleaved  x, y (, c) per joint
+padding: amount of 0.0 values appended to each frame vector
+
+DEFAULT_FEATURES is the 256 values layout of the models: upper body, head, face and hands, planar, no confidence,
+6 * 0.0 (2 * 125 + 6).
+
+usage:
+    spec = FeatureSpec(("upper_body", "head", "hand_left", "hand_right"), confidence=True)
+    frames = spec.apply(store.get_clip(clip_id, spec.joints))  # (frames, spec.size), float32
+"""
+
+import numpy as np
+
+try:
+    from keypoints2text.kp_to_text_real_data.keypoint_store import key_slices
+except ImportError:  # server uses different imports than local
+    from keypoint_store import key_slices
+
+# group -> (OpenPose key, joints of the key)
+JOINT_GROUPS = {
+    "upper_body": ("pose_keypoints_2d", np.r_[0:9]),
+    "head": ("pose_keypoints_2d", np.r_[15:19]),
+    "legs": ("pose_keypoints_2d", np.r_[9:15, 19:25]),
+    "face": ("face_keypoints_2d", np.r_[0:70]),
+    "hand_left": ("hand_left_keypoints_2d", np.r_[0:21]),
+    "hand_right": ("hand_right_keypoints_2d", np.r_[0:21]),
+}
+LAYOUTS = ("planar", "interleaved")
+
+
+class FeatureSpec:
+
+    def __init__(self, groups=("upper_body", "head", "face", "hand_left", "hand_right"), confidence=False,
+                 layout="planar", padding=6):
+        """
+        :param groups: names of JOINT_GROUPS, in the order of the features
+        :param confidence: include the confidence of the joints
+        :param layout: one of LAYOUTS
+        :param padding: amount of 0.0 values appended to each frame
+        """
+        unknown = [group for group in groups if group not in JOINT_GROUPS]
+        if unknown:
+            raise ValueError("Unknown joint groups %s, use %s" % (", ".join(unknown), ", ".join(JOINT_GROUPS)))
+        if layout not in LAYOUTS:
+            raise ValueError("Unknown layout %s, use one of %s" % (layout, ", ".join(LAYOUTS)))
+        self.groups = tuple(groups)
+        self.confidence = confidence
+        self.layout = layout
+        self.padding = padding
+
+        slices = key_slices()
+        # joints of the store (137) in feature order, a joint selected by several groups is used once
+        selected = np.concatenate([slices[JOINT_GROUPS[group][0]].start + JOINT_GROUPS[group][1]
+                                   for group in self.groups])
+        _, first = np.unique(selected, return_index=True)
+        selected = selected[np.sort(first)]
+        self.num_joints = len(selected)
+        self.num_channels = 3 if confidence else 2
+        # decode only these joints (sorted, as the store reads them), positions of the selected joints among them
+        self.joints = np.sort(selected)
+        position = np.searchsorted(self.joints, selected)
+        # gather indexes into the flattened (joints * 3) values of a frame: decoded joints only and all 137 joints
+        self.index = self.compile(position)
+        self.full_index = self.compile(selected)
+
+    def compile(self, position):
+        """Gather index of the selected values for joints at position in the flattened frame"""
+        channels = np.arange(self.num_channels)
+        if self.layout == "planar":
+            return (position[np.newaxis, :] * 3 + channels[:, np.newaxis]).reshape(-1)
+        return (position[:, np.newaxis] * 3 + channels[np.newaxis, :]).reshape(-1)
+
+    @property
+    def size(self):
+        """Length of a frame vector"""
+        return len(self.index) + self.padding
+
+    def apply(self, clip, decoded=True):
+        """
+        Frame vectors of a clip
+        :param clip: float array (frames, len(self.joints), 3) as returned by store.get_clip(clip_id, spec.joints), or
+            (frames, 137, 3) with decoded=False
+        :param decoded: False if clip holds all joints of the store
+        :return: float32 array (frames, self.size), missing joints stay NaN
+        """
+        index = self.index if decoded else self.full_index
+        flat = np.asarray(clip, dtype=np.float32).reshape(clip.shape[0], -1)
+        if self.padding == 0:
+            return flat[:, index]
+        frames = np.zeros((clip.shape[0], self.size), dtype=np.float32)
+        frames[:, :len(index)] = flat[:, index]
+        return frames
+
+    def __repr__(self):
+        return "FeatureSpec(%s, confidence=%s, layout=%s, padding=%d)" % (list(self.groups), self.confidence,
+                                                                           self.layout, self.padding)
+
+
+DEFAULT_FEATURES = FeatureSpec()
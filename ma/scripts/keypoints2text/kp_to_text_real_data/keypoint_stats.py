@@ -0,0 +1,228 @@
+"""keypoint_stats.py: streaming mean and stdev of the keypoints of a keypoint store
+
+One pass over the store in chunks of frames. Each chunk is reduced with numpy to count, mean and sum of squared
+deviations per joint and axis (float64), the chunk results are merged with the parallel variance formula of Chan et al.
+Partial results of several processes or hosts are merged the same way.
+
+Missing values are excluded per joint and axis: 0.0 (OpenPose writes 0 for joints it did not detect, the
+centralization writes NaN for them, older files "Null"). The stdev is the population stdev (statistics.pstdev).
+
+all_mean_stdev.json has the layout of centralize_normalize_np.py, one entry per key (pose, face, hand left, hand right):
+    [[means_x, stdevs_x], [means_y, stdevs_y]]
+with null for joints without any value.
+
+usage:
+keypoint_stats.py stats path_to_store path_to_target_dir [num_workers]
+    compute all_mean_stdev.json of the store
+keypoint_stats.py partial path_to_store path_to_partial part num_parts
+    compute the partial result (path_to_partial ends with .npz) of part (0 based) of num_parts equal parts of the
+    clips, e.g. one part per host
+keypoint_stats.py merge path_to_target_dir path_to_partial [path_to_partial ...]
+    merge partial results and write all_mean_stdev.json
+"""
+
+import json
+import sys
+import time
+from multiprocessing import Pool
+from pathlib import Path
+import numpy as np
+
+try:
+    from keypoints2text.kp_to_text_real_data.keypoint_store import open_store, key_slices, NUM_JOINTS
+    from keypoints2text.kp_to_text_real_data.missing_joints import centralize_keypoints
+except ImportError:  # server uses different imports than local
+    from keypoint_store import open_store, key_slices, NUM_JOINTS
+    from missing_joints import centralize_keypoints
+
+
+class RunningMeanStdev:
+    """
+    Count, mean and sum of squared deviations (M2) per joint and axis
+    usage:
+        stats = RunningMeanStdev()
+        for chunk in chunks:  # (frames, joints, axes)
+            stats.update(chunk)
+        mean, stdev = stats.mean_stdev()
+    """
+
+    def __init__(self, num_joints=NUM_JOINTS, num_axes=2):
+        self.count = np.zeros((num_joints, num_axes), dtype=np.float64)
+        self.mean = np.zeros((num_joints, num_axes), dtype=np.float64)
+        self.m2 = np.zeros((num_joints, num_axes), dtype=np.float64)
+
+    def update(self, values, mask=None):
+        """
+        Add a chunk of frames
+        :param values: array (frames, joints, axes), e.g. keypoints[:, :, :2]
+        :param mask: bool array of the same shape, True for values to use. Default: all values except 0.0 and NaN
+        """
+        values = np.asarray(values, dtype=np.float64)
+        if mask is None:
+            mask = valid_mask(values)
+        count = mask.sum(axis=0).astype(np.float64)
+        masked = np.where(mask, values, 0.0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.where(count > 0, masked.sum(axis=0) / count, 0.0)
+        m2 = (np.where(mask, values - mean, 0.0) ** 2).sum(axis=0)
+        self.merge_moments(count, mean, m2)
+
+    def merge(self, other):
+        """Add the partial result of another RunningMeanStdev"""
+        self.merge_moments(other.count, other.mean, other.m2)
+
+    def merge_moments(self, count, mean, m2):
+        total = self.count + count
+        with np.errstate(invalid="ignore", divide="ignore"):
+            delta = mean - self.mean
+            self.mean = np.where(total > 0, self.mean + delta * count / total, 0.0)
+            self.m2 = np.where(total > 0, self.m2 + m2 + delta ** 2 * self.count * count / total, 0.0)
+        self.count = total
+
+    def mean_stdev(self):
+        """
+        :return: mean and population stdev per joint and axis, NaN where there is no value
+        """
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.where(self.count > 0, self.mean, np.nan)
+            stdev = np.where(self.count > 0, np.sqrt(self.m2 / self.count), np.nan)
+        return mean, stdev
+
+    def save(self, path):
+        np.savez(path, count=self.count, mean=self.mean, m2=self.m2)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        stats = cls(*data["count"].shape)
+        stats.count, stats.mean, stats.m2 = data["count"], data["mean"], data["m2"]
+        return stats
+
+    def mean_stdev_lists(self, joints=slice(None)):
+        """
+        Means and stdevs of some joints as lists
+        :return: [[means_x, stdevs_x], [means_y, stdevs_y]], None (null) for joints without values
+        """
+        mean, stdev = self.mean_stdev()
+        return [[null_list(mean[joints, axis]), null_list(stdev[joints, axis])] for axis in range(2)]
+
+    def to_json_layout(self):
+        """Means and stdevs of all 137 joints in the layout of all_mean_stdev.json, one entry per key"""
+        return [self.mean_stdev_lists(part) for part in key_slices().values()]
+
+
+def valid_mask(values):
+    """True for values which are neither missing (0.0) nor NaN"""
+    return np.isfinite(values) & (values != 0)
+
+
+def null_list(values):
+    return [None if np.isnan(value) else float(value) for value in values]
+
+
+def update_stats(stats, chunk, centralize=False):
+    """
+    Add a chunk of keypoints (frames, 137, 3) of a store
+    :param centralize: add the centralized values (see missing_joints.centralize_keypoints) instead of the stored ones,
+        all finite values are used then, as in centralize_normalize_np.py
+    """
+    if not centralize:
+        stats.update(chunk[:, :, :2])
+        return
+    values = centralize_keypoints(chunk, dtype=np.float64)[:, :, :2]
+    stats.update(values, np.isfinite(values))
+
+
+def clip_range_stats(args):
+    """
+    Stats of the clips start <= idx < stop of a store, runs in the worker processes
+    :param args: (path to store, start, stop, chunk size in frames, centralize)
+    :return: RunningMeanStdev
+    """
+    path_to_store, start, stop, chunk_size, centralize = args
+    return clip_list_stats(path_to_store, range(start, stop), chunk_size, centralize)
+
+
+def clip_list_stats(path_to_store, indexes, chunk_size=100000, centralize=False):
+    """
+    Stats of some clips of a store
+    :param indexes: clip indexes in store order
+    :return: RunningMeanStdev
+    """
+    store = open_store(path_to_store)
+    stats = RunningMeanStdev()
+    chunk = []
+    num_frames = 0
+    for idx in indexes:
+        clip = store.get_clip_by_index(idx)
+        chunk.append(clip)
+        num_frames += clip.shape[0]
+        if num_frames >= chunk_size:
+            update_stats(stats, np.concatenate(chunk), centralize)
+            chunk = []
+            num_frames = 0
+    if chunk:
+        update_stats(stats, np.concatenate(chunk), centralize)
+    return stats
+
+
+def part_range(num_clips, part, num_parts):
+    """Clip index range of one of num_parts equal parts"""
+    return num_clips * part // num_parts, num_clips * (part + 1) // num_parts
+
+
+def compute_store_stats(path_to_store, num_workers=1, chunk_size=100000, centralize=False):
+    """
+    Mean and stdev of all clips of a store
+    :param num_workers: amount of processes, each of them reduces a range of the clips
+    :param chunk_size: frames per chunk
+    :param centralize: stats of the centralized keypoints, see update_stats
+    :return: RunningMeanStdev
+    """
+    store = open_store(path_to_store)
+    if num_workers <= 1:
+        stats = RunningMeanStdev()
+        for chunk in store.iter_frame_chunks(chunk_size):
+            update_stats(stats, chunk, centralize)
+        return stats
+
+    ranges = [(path_to_store,) + part_range(len(store), part, num_workers) + (chunk_size, centralize)
+              for part in range(num_workers)]
+    stats = RunningMeanStdev()
+    with Pool(num_workers) as pool:
+        for partial in pool.imap_unordered(clip_range_stats, ranges):
+            stats.merge(partial)
+    return stats
+
+
+def write_mean_stdev(stats, path_to_target_dir):
+    """Write all_mean_stdev.json, returns its content"""
+    all_mean_stdev = stats.to_json_layout()
+    with open(Path(path_to_target_dir) / "all_mean_stdev.json", "w") as f:
+        f.write(json.dumps(all_mean_stdev))
+    return all_mean_stdev
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 4:
+        print(__doc__)
+        sys.exit()
+
+    start_time = time.time()
+    command = sys.argv[1]
+    if command == "stats":
+        result = compute_store_stats(sys.argv[2], int(sys.argv[4]) if len(sys.argv) > 4 else 1)
+        write_mean_stdev(result, sys.argv[3])
+    elif command == "partial" and len(sys.argv) > 5:
+        num_clips = len(open_store(sys.argv[2]))
+        start, stop = part_range(num_clips, int(sys.argv[4]), int(sys.argv[5]))
+        clip_range_stats((sys.argv[2], start, stop, 100000, False)).save(sys.argv[3])
+    elif command == "merge":
+        result = RunningMeanStdev.load(sys.argv[3])
+        for path_to_partial in sys.argv[4:]:
+            result.merge(RunningMeanStdev.load(path_to_partial))
+        write_mean_stdev(result, sys.argv[2])
+    else:
+        print(__doc__)
+        sys.exit()
+    print("--- %.4s seconds ---" % (time.time() - start_time))
@@ -0,0 +1,679 @@
+"""
+keypoint_store.py: columnar on-disk store for OpenPose keypoints
+
+Replaces the pickled {folder: {frame.json: openpose_json}} dictionary (raw_data.npy) with a packed format that can be
+opened with np.memmap. Opening a store only reads the small index files, the keypoints are paged in on access and
+DataLoader workers share the page cache instead of holding a private copy of the corpus.
+
+Layout of a store directory:
+    meta.json       number of frames / joints, dtype and version of the store
+    keypoints.bin   raw array of shape (total_frames, 137, 3) -> x, y, confidence of each joint
+    offsets.npy     int64, index of the first frame of each clip in keypoints.bin
+    lengths.npy     int64, number of frames of each clip
+    clip_ids.npy    clip id (name of the OpenPose output folder) of each clip
+    shift.npy       int16 encoding only: float32 (clips, 3), per clip offset of x, y, confidence
+    scale.npy       int16 encoding only: float32 (clips, 3), per clip step size of x, y, confidence
+
+Encodings (dtype in meta.json), decoded to float32 on access:
+    float32         default, lossless
+    float16         half the size, max error ~0.25 px for coordinates < 1024 px
+    int16           half the size, codes are mapped linearly onto the value range of each clip and channel
+                    (error < range / 65534), the code -32768 is reserved so 0.0 (missing joint) stays exactly 0.0,
+                    keypoints with NaN (centralized or normalized) are rejected
+
+Joint order along axis 1: pose (25), face (70), hand_left (21), hand_right (21), as in the OpenPose json files.
+
+Sharded store: a directory with a manifest.json and one keypoint store per shard (shard_00000, shard_00001, ...).
+Shards are only ever added, existing shards are never rewritten. ShardedKeypointStore presents all shards as one
+store, if a clip id occurs in several shards the latest shard wins. A shard entry in the manifest may list "removed"
+clip ids, these clips are dropped from all earlier shards. Use open_store() to open either kind of store.
+"""
+
+import hashlib
+import json
+import os
+import re
+import tarfile
+import zipfile
+from pathlib import Path
+import numpy as np
+
+KEYS = ['pose_keypoints_2d', 'face_keypoints_2d', 'hand_left_keypoints_2d', 'hand_right_keypoints_2d']
+JOINTS_PER_KEY = {'pose_keypoints_2d': 25, 'face_keypoints_2d': 70, 'hand_left_keypoints_2d': 21,
+                  'hand_right_keypoints_2d': 21}
+NUM_JOINTS = sum(JOINTS_PER_KEY.values())  # 137
+STORE_VERSION = 1
+MANIFEST_NAME = "manifest.json"
+ENCODINGS = ("float32", "float16", "int16")
+INT16_ZERO = -32768  # int16 code reserved for exactly 0.0
+INT16_STEPS = 65534  # codes -32767 ... 32767
+ARCHIVE_SUFFIXES = (".tar", ".tar.gz", ".tgz", ".zip")
+FRAME_NUMBER = re.compile(r"(\d+)_keypoints\.json$")
+
+
+def key_slices():
+    """
+    Joint range of each OpenPose key along the joint axis of the store
+    :return: dictionary key -> slice, e.g. 'face_keypoints_2d' -> slice(25, 95)
+    """
+    slices = {}
+    start = 0
+    for k in KEYS:
+        slices[k] = slice(start, start + JOINTS_PER_KEY[k])
+        start += JOINTS_PER_KEY[k]
+    return slices
+
+
+def frame_from_json(frame):
+    """
+    Convert one parsed OpenPose json frame into a (137, 3) float32 array
+    Frames without a detected person are filled with 0.0 (OpenPose uses 0 for missing joints)
+    :param frame: parsed json of a single frame
+    :return: np.ndarray (137, 3)
+    """
+    result = np.zeros((NUM_JOINTS, 3), dtype=np.float32)
+    if not frame.get('people'):
+        return result
+    person = frame['people'][0]
+    for k, part in key_slices().items():
+        values = person.get(k)
+        if values:
+            result[part] = np.asarray(values, dtype=np.float32).reshape(-1, 3)
+    return result
+
+
+def parse_openpose_json(text):
+    """
+    Schema specific parser for an OpenPose json file, only the four *_keypoints_2d arrays of people[0] are parsed
+    straight into a float32 buffer, no python objects are built for the rest of the file.
+    The first occurrence of each key belongs to people[0], because OpenPose writes the people in order.
+    Falls back to json.loads if the file does not look like expected.
+    :param text: content of the json file
+    :return: np.ndarray (137, 3)
+    """
+    result = np.zeros((NUM_JOINTS, 3), dtype=np.float32)
+    for k, part in key_slices().items():
+        start = text.find('"%s"' % k)
+        if start == -1:  # e.g. no person detected
+            return frame_from_json(json.loads(text))
+        start = text.find("[", start) + 1
+        end = text.find("]", start)
+        if not text[start:end].strip():
+            continue
+        try:
+            values = np.array(text[start:end].split(","), dtype=np.float32)
+        except ValueError:  # not a list of numbers
+            return frame_from_json(json.loads(text))
+        if values.size != JOINTS_PER_KEY[k] * 3:
+            return frame_from_json(json.loads(text))
+        result[part] = values.reshape(-1, 3)
+    return result
+
+
+def read_clip_folder(path_to_folder):
+    """
+    Read all OpenPose json files of one folder with parse_openpose_json
+    :param path_to_folder: folder containing the *_keypoints.json files of one clip
+    :return: keypoints (frames, 137, 3), amount of files read, amount of bytes read, content hash of the folder
+    """
+    path_to_folder = Path(path_to_folder)
+    file_names = sorted_frame_names(os.listdir(path_to_folder))
+    keypoints = np.zeros((len(file_names), NUM_JOINTS, 3), dtype=np.float32)
+    num_bytes = 0
+    content_hash = hashlib.sha1()
+    for idx, file_name in enumerate(file_names):
+        with open(path_to_folder / file_name, "rb") as f:
+            content = f.read()
+        num_bytes += len(content)
+        update_content_hash(content_hash, file_name, content)
+        keypoints[idx] = parse_openpose_json(content.decode())
+    return keypoints, len(file_names), num_bytes, content_hash.hexdigest()
+
+
+def read_clip_archive(path_to_archive):
+    """
+    Read all OpenPose json files of one .tar, .tar.gz or .zip archive without extracting it, the members are
+    streamed into parse_openpose_json and ordered by the frame number in their file name afterwards
+    :param path_to_archive: archive containing the *_keypoints.json files of one clip
+    :return: keypoints (frames, 137, 3), amount of files read, amount of bytes read, content hash of the archive
+    """
+    frames = []
+    num_bytes = 0
+    for file_name, content in iter_archive_members(path_to_archive):
+        num_bytes += len(content)
+        frames.append((frame_sort_key(file_name), file_name, hashlib.sha1(content).digest(),
+                       parse_openpose_json(content.decode())))
+    frames.sort(key=lambda frame: frame[0])
+
+    keypoints = np.zeros((len(frames), NUM_JOINTS, 3), dtype=np.float32)
+    content_hash = hashlib.sha1()
+    for idx, (_, file_name, file_digest, frame) in enumerate(frames):
+        content_hash.update(file_name.encode())
+        content_hash.update(file_digest)
+        keypoints[idx] = frame
+    return keypoints, len(frames), num_bytes, content_hash.hexdigest()
+
+
+def iter_archive_members(path_to_archive):
+    """
+    Iterate over the json files of an archive, tar files are read as a stream (no seeking in compressed files)
+    :param path_to_archive: .tar, .tar.gz, .tgz or .zip file
+    :return: generator of (file name without directories, content as bytes)
+    """
+    path_to_archive = str(path_to_archive)
+    if path_to_archive.endswith(".zip"):
+        with zipfile.ZipFile(path_to_archive) as archive:
+            for info in archive.infolist():
+                if not info.is_dir() and info.filename.endswith(".json"):
+                    yield os.path.basename(info.filename), archive.read(info)
+    else:
+        with tarfile.open(path_to_archive, "r|*") as archive:
+            for member in archive:
+                if member.isfile() and member.name.endswith(".json"):
+                    yield os.path.basename(member.name), archive.extractfile(member).read()
+
+
+def update_content_hash(content_hash, file_name, content):
+    """Add one file to a content hash: file name and sha1 of the content, independent of folder or archive"""
+    content_hash.update(file_name.encode())
+    content_hash.update(hashlib.sha1(content).digest())
+
+
+def folder_content_hash(path_to_folder):
+    """
+    Content hash of the json files of one folder or archive, same hash as computed by read_clip_folder and
+    read_clip_archive
+    :param path_to_folder: folder or archive containing the *_keypoints.json files of one clip
+    :return: hex digest
+    """
+    if is_clip_archive(path_to_folder):
+        members = sorted(((frame_sort_key(file_name), file_name, hashlib.sha1(content).digest())
+                          for file_name, content in iter_archive_members(path_to_folder)), key=lambda m: m[0])
+        content_hash = hashlib.sha1()
+        for _, file_name, file_digest in members:
+            content_hash.update(file_name.encode())
+            content_hash.update(file_digest)
+        return content_hash.hexdigest()
+
+    path_to_folder = Path(path_to_folder)
+    content_hash = hashlib.sha1()
+    for file_name in sorted_frame_names(os.listdir(path_to_folder)):
+        with open(path_to_folder / file_name, "rb") as f:
+            update_content_hash(content_hash, file_name, f.read())
+    return content_hash.hexdigest()
+
+
+def folder_signature(path_to_folder):
+    """
+    Cheap signature of a folder or archive from stat calls only, used to find folders which might have changed
+    :param path_to_folder: folder or archive containing the *_keypoints.json files of one clip
+    :return: dictionary {"num_files": int, "size": int, "mtime": int (ns)}
+    """
+    if is_clip_archive(path_to_folder):
+        stat = os.stat(path_to_folder)
+        return {"num_files": 1, "size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+    num_files = 0
+    size = 0
+    mtime = 0
+    with os.scandir(path_to_folder) as entries:
+        for entry in entries:
+            if not entry.name.endswith('.json'):
+                continue
+            stat = entry.stat()
+            num_files += 1
+            size += stat.st_size
+            mtime = max(mtime, stat.st_mtime_ns)
+    return {"num_files": num_files, "size": size, "mtime": mtime}
+
+
+def read_clip_source(path_to_source):
+    """Read one clip from a folder or an archive, see read_clip_folder / read_clip_archive"""
+    if is_clip_archive(path_to_source):
+        return read_clip_archive(path_to_source)
+    return read_clip_folder(path_to_source)
+
+
+def is_clip_archive(path):
+    return str(path).endswith(ARCHIVE_SUFFIXES)
+
+
+def clip_id_from_source(name):
+    """Clip id of a folder or archive name, e.g. 'abc-1-rgb_front.tar.gz' -> 'abc-1-rgb_front'"""
+    for suffix in ARCHIVE_SUFFIXES:
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+def encode_clip(keypoints, encoding):
+    """
+    Encode the float32 keypoints of one clip
+    :param keypoints: np.ndarray (frames, joints, 3) float32
+    :param encoding: one of ENCODINGS
+    :return: encoded array, shift (3,) and scale (3,) for int16 otherwise None, None
+    :raises ValueError: int16 and keypoints with NaN (missing joints of centralized or normalized keypoints) or inf
+    """
+    if encoding == "float32":
+        return keypoints, None, None
+    if encoding == "float16":
+        return keypoints.astype(np.float16), None, None
+    if not np.isfinite(keypoints).all():
+        raise ValueError("int16 can not hold missing joints (NaN) or infinite values, use float32 or float16")
+    if keypoints.size == 0:
+        return keypoints.astype(np.int16), np.zeros(3, dtype=np.float32), np.ones(3, dtype=np.float32)
+    # value range per channel without the missing joints, they are encoded as INT16_ZERO anyway
+    valid = keypoints != 0
+    shift = np.where(valid, keypoints, np.inf).min(axis=(0, 1))
+    upper = np.where(valid, keypoints, -np.inf).max(axis=(0, 1))
+    shift[~np.isfinite(shift)] = 0.0
+    upper[~np.isfinite(upper)] = 0.0
+    scale = (upper - shift) / INT16_STEPS
+    scale[scale == 0] = 1.0
+    codes = np.rint((keypoints - shift) / scale) - (INT16_STEPS // 2)
+    codes[keypoints == 0] = INT16_ZERO
+    return codes.astype(np.int16), shift.astype(np.float32), scale.astype(np.float32)
+
+
+def decode_keypoints(raw, shift=None, scale=None):
+    """
+    Decode stored keypoints to float32, vectorized over the whole array
+    :param raw: stored array (frames, joints, 3)
+    :param shift: int16 only, shift broadcastable to raw, e.g. (3,) for one clip or (frames, 1, 3)
+    :param scale: int16 only, scale broadcastable to raw
+    :return: np.ndarray float32, raw itself if it is already float32
+    """
+    if raw.dtype == np.float32:
+        return raw
+    if raw.dtype == np.int16:
+        values = (raw.astype(np.float32) + (INT16_STEPS // 2)) * scale + shift
+        values[raw == INT16_ZERO] = 0.0
+        return values
+    return raw.astype(np.float32)
+
+
+def frame_sort_key(file_name):
+    """Sort key of a json file: the frame number in <video>_<frame number>_keypoints.json, then the name"""
+    match = FRAME_NUMBER.search(file_name)
+    return (int(match.group(1)) if match else -1, file_name)
+
+
+def sorted_frame_names(file_names):
+    """Sort the json files of one folder by frame number, OpenPose names them <video>_<frame number>_keypoints.json"""
+    return sorted((file_name for file_name in file_names if file_name.endswith('.json')), key=frame_sort_key)
+
+
+class KeypointStoreWriter:
+    """
+    Write clips sequentially into a new keypoint store
+    usage:
+        with KeypointStoreWriter(path, encoding="float32") as writer:
+            writer.add_clip("clip_id", keypoints)  # keypoints: (frames, 137, 3)
+    """
+
+    def __init__(self, path_to_store, encoding="float32"):
+        if encoding not in ENCODINGS:
+            raise ValueError("Unknown encoding %s, use one of %s" % (encoding, ", ".join(ENCODINGS)))
+        self.path_to_store = Path(path_to_store)
+        self.encoding = encoding
+        if not os.path.exists(self.path_to_store):
+            os.makedirs(self.path_to_store)
+        self.data_file = open(self.path_to_store / "keypoints.bin", "wb")
+        self.clip_ids = []
+        self.offsets = []
+        self.lengths = []
+        self.shifts = []
+        self.scales = []
+        self.num_frames = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def add_clip(self, clip_id, keypoints):
+        """
+        Append a clip to the store
+        :param clip_id: name of the clip (OpenPose output folder)
+        :param keypoints: array like of shape (frames, 137, 3)
+        """
+        keypoints = np.ascontiguousarray(keypoints, dtype=np.float32)
+        if keypoints.ndim != 3 or keypoints.shape[1:] != (NUM_JOINTS, 3):
+            raise ValueError("Clip %s has shape %s, expected (frames, %d, 3)" % (clip_id, keypoints.shape, NUM_JOINTS))
+        encoded, shift, scale = encode_clip(keypoints, self.encoding)
+        self.data_file.write(encoded.tobytes())
+        if self.encoding == "int16":
+            self.shifts.append(shift)
+            self.scales.append(scale)
+        self.clip_ids.append(str(clip_id))
+        self.offsets.append(self.num_frames)
+        self.lengths.append(keypoints.shape[0])
+        self.num_frames += keypoints.shape[0]
+
+    def add_json_clip(self, clip_id, frames):
+        """
+        Append a clip from parsed OpenPose json frames
+        :param clip_id: name of the clip
+        :param frames: list of parsed json frames, in frame order
+        """
+        keypoints = np.zeros((len(frames), NUM_JOINTS, 3), dtype=np.float32)
+        for idx, frame in enumerate(frames):
+            keypoints[idx] = frame_from_json(frame)
+        self.add_clip(clip_id, keypoints)
+
+    def close(self):
+        if self.data_file.closed:
+            return
+        self.data_file.close()
+        np.save(self.path_to_store / "offsets.npy", np.asarray(self.offsets, dtype=np.int64))
+        np.save(self.path_to_store / "lengths.npy", np.asarray(self.lengths, dtype=np.int64))
+        np.save(self.path_to_store / "clip_ids.npy", np.asarray(self.clip_ids, dtype=np.str_))
+        if self.encoding == "int16":
+            np.save(self.path_to_store / "shift.npy", np.asarray(self.shifts, dtype=np.float32).reshape(-1, 3))
+            np.save(self.path_to_store / "scale.npy", np.asarray(self.scales, dtype=np.float32).reshape(-1, 3))
+        meta = {"version": STORE_VERSION, "num_clips": len(self.clip_ids), "num_frames": self.num_frames,
+                "num_joints": NUM_JOINTS, "dtype": self.encoding}
+        with open(self.path_to_store / "meta.json", "w") as f:
+            f.write(json.dumps(meta))
+
+
+class KeypointStore:
+    """
+    Read-only access to a keypoint store, the keypoints are memory mapped and decoded to float32 on access
+    """
+
+    def __init__(self, path_to_store):
+        self.path_to_store = Path(path_to_store)
+        with open(self.path_to_store / "meta.json") as f:
+            self.meta = json.load(f)
+        self.offsets = np.load(self.path_to_store / "offsets.npy")
+        self.lengths = np.load(self.path_to_store / "lengths.npy")
+        self.clip_ids = np.load(self.path_to_store / "clip_ids.npy").tolist()
+        self.clip_index = {clip_id: idx for idx, clip_id in enumerate(self.clip_ids)}
+
+        dtype = np.dtype(self.meta.get("dtype", "float32"))
+        self.shift = None
+        self.scale = None
+        if dtype == np.int16:
+            self.shift = np.load(self.path_to_store / "shift.npy")
+            self.scale = np.load(self.path_to_store / "scale.npy")
+
+        if self.meta["num_frames"] > 0:
+            self.keypoints = np.memmap(self.path_to_store / "keypoints.bin", dtype=dtype, mode="r",
+                                       shape=(self.meta["num_frames"], self.meta["num_joints"], 3))
+        else:  # np.memmap can not map empty files
+            self.keypoints = np.zeros((0, self.meta["num_joints"], 3), dtype=dtype)
+
+    def __len__(self):
+        return len(self.clip_ids)
+
+    def __contains__(self, clip_id):
+        return clip_id in self.clip_index
+
+    def __getitem__(self, clip_id):
+        return self.get_clip(clip_id)
+
+    def __getstate__(self):
+        # e.g. for DataLoader workers: pickling the memory map would copy all keypoints, the store is opened again
+        return {"path_to_store": self.path_to_store}
+
+    def __setstate__(self, state):
+        self.__init__(state["path_to_store"])
+
+    def keys(self):
+        """Clip ids in store order, mirrors dict.keys() of the legacy dictionary"""
+        return list(self.clip_ids)
+
+    def get_clip(self, clip_id, joints=None):
+        """
+        Get the keypoints of one clip
+        :param clip_id: name of the clip
+        :param joints: optional index array, only these joints are decoded
+        :return: float32 (frames, joints, 3), a read-only view into the memory mapped keypoints if the store is
+                 float32 and no joints are selected
+        """
+        return self.get_clip_by_index(self.clip_index[clip_id], joints)
+
+    def get_clip_by_index(self, idx, joints=None):
+        start = self.offsets[idx]
+        raw = self.keypoints[start:start + self.lengths[idx]]
+        if joints is not None:
+            raw = raw[:, joints]
+        if self.scale is None:
+            return decode_keypoints(raw)
+        return decode_keypoints(raw, self.shift[idx], self.scale[idx])
+
+    def iter_frame_chunks(self, chunk_size=100000):
+        """
+        Iterate over all frames of the store in chunks
+        :param chunk_size: max amount of frames per chunk
+        :return: generator of float32 (frames, 137, 3) arrays
+        """
+        for start in range(0, self.keypoints.shape[0], chunk_size):
+            raw = self.keypoints[start:start + chunk_size]
+            if self.scale is None:
+                yield decode_keypoints(raw)
+            else:
+                # clip of each frame, for the per clip shift and scale
+                clip_idx = np.searchsorted(self.offsets, np.arange(start, start + raw.shape[0]), side="right") - 1
+                yield decode_keypoints(raw, self.shift[clip_idx][:, None, :], self.scale[clip_idx][:, None, :])
+
+
+class ShardedKeypointStore:
+    """
+    Read-only view over all shards listed in the manifest of a sharded store, same interface as KeypointStore
+    """
+
+    def __init__(self, path_to_store):
+        self.path_to_store = Path(path_to_store)
+        self.manifest = read_manifest(self.path_to_store)
+        self.shards = [KeypointStore(self.path_to_store / shard["name"]) for shard in self.manifest["shards"]]
+
+        # clip id -> (shard index, index in shard), later shards replace clips of earlier shards
+        locations = {}
+        for shard_idx, shard in enumerate(self.shards):
+            for clip_id in self.manifest["shards"][shard_idx].get("removed", []):
+                locations.pop(clip_id, None)
+            for idx, clip_id in enumerate(shard.clip_ids):
+                locations.pop(clip_id, None)
+                locations[clip_id] = (shard_idx, idx)
+        self.clip_ids = list(locations.keys())
+        self.locations = list(locations.values())
+        self.clip_index = {clip_id: idx for idx, clip_id in enumerate(self.clip_ids)}
+        self.lengths = np.asarray([self.shards[shard_idx].lengths[idx] for shard_idx, idx in self.locations],
+                                  dtype=np.int64)
+
+    def __len__(self):
+        return len(self.clip_ids)
+
+    def __contains__(self, clip_id):
+        return clip_id in self.clip_index
+
+    def __getitem__(self, clip_id):
+        return self.get_clip(clip_id)
+
+    def __getstate__(self):
+        return {"path_to_store": self.path_to_store}
+
+    def __setstate__(self, state):
+        self.__init__(state["path_to_store"])
+
+    def keys(self):
+        return list(self.clip_ids)
+
+    def get_clip(self, clip_id, joints=None):
+        return self.get_clip_by_index(self.clip_index[clip_id], joints)
+
+    def get_clip_by_index(self, idx, joints=None):
+        shard_idx, shard_clip_idx = self.locations[idx]
+        return self.shards[shard_idx].get_clip_by_index(shard_clip_idx, joints)
+
+    def iter_frame_chunks(self, chunk_size=100000):
+        """
+        Iterate over the frames of all current clips in chunks
+        Shards without replaced clips are read in chunks, otherwise clip by clip
+        """
+        active = [set() for _ in self.shards]
+        for shard_idx, idx in self.locations:
+            active[shard_idx].add(idx)
+        for shard_idx, shard in enumerate(self.shards):
+            if len(active[shard_idx]) == len(shard):
+                yield from shard.iter_frame_chunks(chunk_size)
+            else:
+                for idx in sorted(active[shard_idx]):
+                    yield shard.get_clip_by_index(idx)
+
+
+def read_manifest(path_to_store):
+    """
+    Read the manifest of a sharded store, an empty manifest is returned if there is none yet
+    :param path_to_store: directory of the sharded store
+    :return: dictionary {"version": int, "shards": [{"name": str, "num_clips": int, "num_frames": int,
+             "removed": [clip ids]}, ...]}
+    """
+    manifest_path = Path(path_to_store) / MANIFEST_NAME
+    if not os.path.isfile(manifest_path):
+        return {"version": STORE_VERSION, "shards": []}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def write_manifest(path_to_store, manifest):
+    """Write the manifest atomically, readers never see a half written file"""
+    write_json_atomic(Path(path_to_store) / MANIFEST_NAME, manifest)
+
+
+def write_json_atomic(path, content):
+    """Write a json file via a temporary file and os.replace"""
+    temp_path = Path(str(path) + ".tmp")
+    with open(temp_path, "w") as f:
+        f.write(json.dumps(content, indent=1))
+    os.replace(temp_path, path)
+
+
+class ShardWriter:
+    """
+    Append new shards to a sharded store
+    usage:
+        shard_writer = ShardWriter(path)
+        with shard_writer.new_shard() as writer:
+            writer.add_clip(...)
+        shard_writer.commit(writer)  # shard becomes visible to readers only after commit
+    """
+
+    def __init__(self, path_to_store, encoding="float32"):
+        self.path_to_store = Path(path_to_store)
+        self.encoding = encoding
+        if not os.path.exists(self.path_to_store):
+            os.makedirs(self.path_to_store)
+
+    def new_shard(self, name=None):
+        """
+        Create a writer for the next shard. A shard left over from an interrupted run is not in the manifest and
+        gets overwritten.
+        :param name: name of the shard directory, default shard_<number of shards in the manifest>. Processes writing
+            shards of the same store at the same time need unique names.
+        """
+        if name is None:
+            name = "shard_%05d" % len(read_manifest(self.path_to_store)["shards"])
+        return KeypointStoreWriter(self.path_to_store / name, self.encoding)
+
+    def commit(self, writer, removed=()):
+        """
+        Add a closed shard to the manifest
+        :param writer: KeypointStoreWriter returned by new_shard
+        :param removed: clip ids which are dropped from the earlier shards
+        """
+        writer.close()
+        self.append_shards([shard_entry(writer)], removed)
+
+    def append_shards(self, shards, removed=()):
+        """
+        Add closed shards to the manifest with a single write
+        :param shards: manifest entries of the shards, see shard_entry
+        :param removed: clip ids which are dropped from the earlier shards, recorded with the first shard
+        """
+        manifest = read_manifest(self.path_to_store)
+        shards = [dict(shard) for shard in shards]
+        if removed:
+            shards[0]["removed"] = list(removed)
+        manifest["shards"] += shards
+        write_manifest(self.path_to_store, manifest)
+
+
+def shard_entry(writer):
+    """Manifest entry of a shard written by a closed KeypointStoreWriter"""
+    return {"name": writer.path_to_store.name, "num_clips": len(writer.clip_ids), "num_frames": writer.num_frames}
+
+
+def convert_legacy_npy(path_to_numpy_file, path_to_store):
+    """
+    Convert a legacy raw_data.npy dictionary {folder: {frame.json: openpose_json}} into a keypoint store
+    :param path_to_numpy_file: path to the pickled dictionary
+    :param path_to_store: target directory of the store
+    :return: path to the store
+    """
+    all_files = np.load(path_to_numpy_file, allow_pickle=True).item()
+    with KeypointStoreWriter(path_to_store) as writer:
+        for subdir in all_files:
+            frames = [all_files[subdir][file] for file in sorted_frame_names(all_files[subdir].keys())]
+            writer.add_json_clip(subdir, frames)
+    return Path(path_to_store)
+
+
+def convert_store(path_to_store, path_to_target, encoding):
+    """
+    Write all clips of a (sharded) store into a new single store with another encoding
+    :param path_to_store: source store
+    :param path_to_target: directory of the new store
+    :param encoding: one of ENCODINGS
+    :return: path to the new store
+    """
+    store = open_store(path_to_store)
+    with KeypointStoreWriter(path_to_target, encoding) as writer:
+        for idx, clip_id in enumerate(store.keys()):
+            writer.add_clip(clip_id, store.get_clip_by_index(idx))
+    return Path(path_to_target)
+
+
+def store_fingerprint(path_to_store):
+    """
+    Fingerprint of the content of a (sharded) store, computed from the small index files (manifest, meta.json,
+    lengths and clip ids of each shard) and the size and mtime of the keypoints (keypoints.bin, shift.npy and
+    scale.npy) instead of their content. It changes whenever clips are added, replaced or removed, also if a store
+    is rewritten in place with the same clips and frame counts.
+    :return: hex digest, 16 characters
+    """
+    path_to_store = Path(path_to_store)
+    fingerprint = hashlib.sha1()
+    store_dirs = [path_to_store]
+    if os.path.isfile(path_to_store / MANIFEST_NAME):
+        manifest = read_manifest(path_to_store)
+        fingerprint.update(json.dumps(manifest, sort_keys=True).encode())
+        store_dirs = [path_to_store / shard["name"] for shard in manifest["shards"]]
+    for store_dir in store_dirs:
+        for file_name in ("meta.json", "lengths.npy", "clip_ids.npy"):
+            with open(store_dir / file_name, "rb") as f:
+                fingerprint.update(f.read())
+        for file_name in ("keypoints.bin", "shift.npy", "scale.npy"):
+            if os.path.isfile(store_dir / file_name):
+                stat = os.stat(store_dir / file_name)
+                fingerprint.update(("%s %d %d" % (file_name, stat.st_size, stat.st_mtime_ns)).encode())
+    return fingerprint.hexdigest()[:16]
+
+
+def is_keypoint_store(path):
+    """Check if a path points to a (sharded) keypoint store directory instead of a .npy file"""
+    return os.path.isfile(Path(path) / "meta.json") or os.path.isfile(Path(path) / MANIFEST_NAME)
+
+
+def open_store(path):
+    """
+    Open a keypoint store or a sharded keypoint store
+    :param path: store directory
+    :return: KeypointStore or ShardedKeypointStore
+    """
+    if os.path.isfile(Path(path) / MANIFEST_NAME):
+        return ShardedKeypointStore(path)
+    return KeypointStore(path)
@@ -0,0 +1,175 @@
+"""length_stats.py: frames and word ids of each sample of a dataset, with max, percentiles and histograms
+
+TextKeypointsDataset records the source length (frames of the clip) and the target length (word ids of the sentence,
+<sos> ... <eos>) of each line of the csv file when it is built, from the lengths of the keypoint store (or feature
+cache) and the token cache, without loading a sample. Padding and bucketing decisions read them from
+dataset.lengths instead of iterating over the data loader.
+
+The lengths are kept in a sidecar file next to the csv file, so tools get them without building the dataset:
+    <dir of the csv file>/length_stats/<csv name>_<key>.json
+The key covers the keypoints (store fingerprint, size and mtime of a .npy file), the csv and the vocab file.
+Samples whose clip is not in the keypoints have source length 0 and are left out of the statistics.
+
+usage:
+length_stats.py path_to_keypoints path_to_csv path_to_vocab_file [bins]
+    print max, percentiles and histograms of the dataset, builds the dataset if there is no sidecar yet
+"""
+
+import json
+import os
+import sys
+from pathlib import Path
+import numpy as np
+
+try:
+    from keypoints2text.kp_to_text_real_data.feature_cache import cache_key
+    from keypoints2text.kp_to_text_real_data import token_cache
+except ImportError:  # server uses different imports than local
+    from feature_cache import cache_key
+    import token_cache
+
+CACHE_DIR = "length_stats"
+PERCENTILES = (50, 90, 95, 99)
+
+
+class LengthStats:
+    """
+    usage:
+        stats = dataset.lengths
+        max_frames, max_words = stats.max()
+        frames_p95, words_p95 = stats.percentile(95)
+    """
+
+    def __init__(self, source_lengths, target_lengths):
+        """
+        :param source_lengths: frames of each sample, 0 for samples without keypoints
+        :param target_lengths: word ids of each sample
+        """
+        self.source_lengths = np.asarray(source_lengths, dtype=np.int64)
+        self.target_lengths = np.asarray(target_lengths, dtype=np.int64)
+        self.usable = self.source_lengths > 0
+
+    def __len__(self):
+        return int(self.usable.sum())
+
+    @classmethod
+    def merge(cls, *stats):
+        """Statistics of several datasets together, e.g. train and val"""
+        return cls(np.concatenate([part.source_lengths for part in stats]),
+                   np.concatenate([part.target_lengths for part in stats]))
+
+    def lengths(self):
+        """Source and target lengths of the samples with keypoints"""
+        return self.source_lengths[self.usable], self.target_lengths[self.usable]
+
+    def max(self):
+        """
+        :return: longest clip (frames), longest sentence (word ids), 0 for no samples
+        """
+        if len(self) == 0:
+            return 0, 0
+        return tuple(int(lengths.max()) for lengths in self.lengths())
+
+    def percentile(self, q):
+        """
+        :param q: percentile, 0 - 100, e.g. 95 for a padding that fits 95% of the samples
+        :return: frames, word ids (rounded up to whole values)
+        """
+        if len(self) == 0:
+            return 0, 0
+        return tuple(int(np.ceil(np.percentile(lengths, q))) for lengths in self.lengths())
+
+    def histogram(self, bins=10):
+        """
+        :param bins: amount of equal width bins or the bin edges, see np.histogram
+        :return: (counts, edges) of the source lengths, (counts, edges) of the target lengths
+        """
+        return tuple(np.histogram(lengths, bins=bins) for lengths in self.lengths())
+
+    def summary(self):
+        """Dictionary of samples, max, mean and PERCENTILES of the source and target lengths"""
+        summary = {"samples": len(self), "skipped": int((~self.usable).sum())}
+        for name, lengths in zip(("source", "target"), self.lengths()):
+            summary[name] = {"max": int(lengths.max()) if len(lengths) else 0,
+                             "mean": round(float(lengths.mean()), 2) if len(lengths) else 0.0}
+            for q in PERCENTILES:
+                summary[name]["p%d" % q] = int(np.ceil(np.percentile(lengths, q))) if len(lengths) else 0
+        return summary
+
+    def save(self, path):
+        """Write the lengths and the summary into a json file, via a temporary file"""
+        temp_path = Path(str(path) + ".tmp")
+        with open(temp_path, "w") as f:
+            json.dump({"summary": self.summary(), "source_lengths": self.source_lengths.tolist(),
+                       "target_lengths": self.target_lengths.tolist()}, f)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+        return cls(data["source_lengths"], data["target_lengths"])
+
+    @classmethod
+    def load_or_build(cls, path_to_keypoints, path_to_csv, path_to_vocab_file, clip_ids, build):
+        """
+        Load the sidecar of a dataset, build and save it if there is none yet
+        :param clip_ids: clip of each line of the csv file
+        :param build: function () -> source lengths, target lengths
+        """
+        path = cache_path(path_to_keypoints, path_to_csv, path_to_vocab_file, clip_ids)
+        if os.path.isfile(path):
+            return cls.load(path)
+        stats = cls(*build())
+        os.makedirs(path.parent, exist_ok=True)
+        stats.save(path)
+        return stats
+
+
+def cache_path(path_to_keypoints, path_to_csv, path_to_vocab_file, clip_ids):
+    """Sidecar file of a dataset, named after the hash of the keypoints, the csv and the vocab file"""
+    # the name of the token cache is the hash of the csv and the vocab file
+    tokens = token_cache.cache_path(path_to_csv, path_to_vocab_file).stem
+    key = cache_key(path_to_keypoints, clip_ids, tokens=tokens)
+    path_to_csv = Path(path_to_csv)
+    return path_to_csv.parent / CACHE_DIR / ("%s_%s.json" % (path_to_csv.stem, key))
+
+
+def print_stats(stats, bins=10):
+    summary = stats.summary()
+    print("%d samples, %d without keypoints" % (summary["samples"], summary["skipped"]))
+    for name, (counts, edges) in zip(("source", "target"), stats.histogram(bins)):
+        print("%s: %s" % (name, ", ".join("%s %s" % item for item in summary[name].items())))
+        for count, low, high in zip(counts, edges[:-1], edges[1:]):
+            print("    %8.1f - %8.1f  %d" % (low, high, count))
+
+
+if __name__ == '__main__':
+    # file with the keypoints (store or .npy), csv file and vocab file of the dataset
+    if len(sys.argv) > 3:
+        path_to_keypoints = sys.argv[1]
+        path_to_csv = sys.argv[2]
+        path_to_vocab_file = sys.argv[3]
+    else:
+        print("Set paths to the keypoints, the csv file and the vocab file")
+        sys.exit()
+
+    # amount of histogram bins
+    bins = 10
+    if len(sys.argv) > 4:
+        bins = int(sys.argv[4])
+
+    import pandas as pd
+    clip_ids = pd.read_csv(path_to_csv)["keypoints"]
+    path = cache_path(path_to_keypoints, path_to_csv, path_to_vocab_file, clip_ids)
+    if os.path.isfile(path):
+        stats = LengthStats.load(path)
+    else:
+        try:
+            from keypoints2text.kp_to_text_real_data.data_loader import TextKeypointsDataset
+            from keypoints2text.kp_to_text_real_data.feature_spec import DEFAULT_FEATURES
+        except ImportError:  # server uses different imports than local
+            from data_loader import TextKeypointsDataset
+            from feature_spec import DEFAULT_FEATURES
+        stats = TextKeypointsDataset(path_to_keypoints, path_to_csv, path_to_vocab_file, DEFAULT_FEATURES.size).lengths
+    print_stats(stats, bins)
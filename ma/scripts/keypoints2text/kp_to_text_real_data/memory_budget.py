@@ -0,0 +1,60 @@
+"""memory_budget.py: RSS budget for the preprocessing scripts
+
+The scripts accumulate clips in memory (dictionaries of json frames, normalized lists) and write them at the end.
+With a budget the accumulated clips are flushed (a shard of the keypoint store is committed, or a batch of raw_data.npy
+ends) as soon as the resident set size of the process approaches the budget. Only the output side is bounded this way,
+inputs loaded as a whole (.npy dictionaries) stay in memory.
+
+usage:
+    budget = MemoryBudget(4000)  # MB, None or 0 -> no budget, never flushes
+    for clip in clips:
+        buffer.append(clip)
+        if budget.exceeded():
+            flush(buffer)
+            buffer = []
+            budget.flushed()
+"""
+
+import gc
+import os
+import psutil
+
+
+class MemoryBudget:
+
+    def __init__(self, budget_mb=None, threshold=0.9, min_growth=0.05):
+        """
+        :param budget_mb: RSS budget in MB, None or 0 disables the budget
+        :param threshold: flush when the RSS exceeds this fraction of the budget
+        :param min_growth: fraction of the budget the RSS has to grow after a flush before the next flush. Python
+            keeps freed memory in its own allocator, so the RSS does not necessarily shrink after a flush.
+        """
+        self.budget_mb = float(budget_mb) if budget_mb else None
+        self.threshold = threshold
+        self.min_growth = min_growth
+        self.process = psutil.Process(os.getpid())
+        self.flushes = 0
+        self.last_flush_mb = 0.0
+
+    def rss_mb(self):
+        return self.process.memory_info().rss / 1000000  # divided to get mb
+
+    def exceeded(self):
+        """True if the accumulated data should be flushed"""
+        if self.budget_mb is None:
+            return False
+        rss = self.rss_mb()
+        return rss >= self.budget_mb * self.threshold and \
+            rss - self.last_flush_mb >= self.budget_mb * self.min_growth
+
+    def flushed(self):
+        """Call after the accumulated data was written and released"""
+        gc.collect()
+        self.flushes += 1
+        self.last_flush_mb = self.rss_mb()
+
+    def print_memory_usage(self):
+        if self.budget_mb is None:
+            print("Current memory usage: %.1f MB" % self.rss_mb())
+        else:
+            print("Current memory usage: %.1f MB of %.0f MB budget" % (self.rss_mb(), self.budget_mb))
@@ -0,0 +1,156 @@
+"""missing_joints.py: typed representation of missing joints
+
+OpenPose writes 0 for joints it did not detect, the centralization turns them into missing joints. Missing joints are
+NaN in float arrays (the older preprocessing scripts wrote the string "Null"), so centralization, normalization, the
+dataset and the visualizer work on whole arrays. An optional validity bitmask (1 bit per value, np.packbits) keeps the information where NaN can not be stored,
+e.g. after missing values were filled with 0 for the model.
+
+In json files missing values are written as null (NaN is not valid json).
+
+usage:
+    values = to_float_array(data['people'][0]['pose_keypoints_2d'])  # "Null", None -> NaN
+    centralized = centralize_keypoints(keypoints)  # (frames, 137, 3), missing -> NaN
+    normalized = normalize_values(values, mean, stdev)
+    mean, stdev = mean_stdev(values)  # per joint, missing values excluded
+"""
+
+import warnings
+import numpy as np
+
+try:
+    from keypoints2text.kp_to_text_real_data.keypoint_store import key_slices, KEYS
+except ImportError:  # server uses different imports than local
+    from keypoint_store import key_slices, KEYS
+
+NULL = "Null"  # legacy sentinel, still accepted as input
+
+# pose joints kept by the centralization (upper body 0-8, eyes and ears 15-18), the legs are set to missing
+POSE_UPPER_BODY = np.r_[0:9, 15:19]
+
+
+def to_float_array(values, dtype=np.float32):
+    """
+    Convert values which may contain "Null" or None into a float array with NaN for the missing values
+    :param values: list or array, also nested
+    :return: np.ndarray of dtype
+    """
+    values = np.asarray(values)
+    if values.dtype.kind in "fiub":
+        return values.astype(dtype)
+    values = values.astype(object)
+    values[(values == NULL) | np.equal(values, None)] = np.nan
+    return values.astype(dtype)
+
+
+def keypoints_from_person(person, dtype=np.float32):
+    """
+    All keys of one person of an OpenPose json frame as one array, the joint order of the keypoint store
+    :param person: e.g. data['people'][0], the values may contain "Null", None or NaN
+    :return: array (137, 3), NaN for missing values
+    """
+    return np.concatenate([to_float_array(person[k], dtype).reshape(-1, 3) for k in KEYS])
+
+
+def set_person_keypoints(person, keypoints, for_json=False):
+    """
+    Write an array (137, 3) back into the keys of a person as flat lists x, y, c
+    :param for_json: missing values become None (null) instead of NaN
+    """
+    for k, part in key_slices().items():
+        person[k] = to_json_list(keypoints[part]) if for_json else keypoints[part].reshape(-1).tolist()
+
+
+def to_json_list(values):
+    """Flat list for json files, NaN becomes None (null)"""
+    values = np.asarray(values, dtype=np.float64).reshape(-1)
+    return [None if np.isnan(value) else value for value in values.tolist()]
+
+
+def pack_validity(values):
+    """
+    Validity bitmask of the values, 1 bit per value
+    :param values: float array, NaN marks missing values
+    :return: np.uint8 array, the last axis packed with np.packbits
+    """
+    return np.packbits(~np.isnan(values), axis=-1)
+
+
+def unpack_validity(packed, count):
+    """
+    :param packed: result of pack_validity
+    :param count: length of the last axis of the original values
+    :return: bool array, True for valid values
+    """
+    return np.unpackbits(packed, axis=-1, count=count).astype(bool)
+
+
+def centralize_keypoints(keypoints, decimals=None, dtype=np.float32):
+    """
+    Centralize the keypoints towards pose joint 0: x, y -> (x_0 - x, y_0 - y) of the same frame. Joints which are 0 or
+    NaN and the legs are missing (NaN), pose joint 0 becomes 0. The confidence is kept.
+    :param keypoints: array (frames, 137, 3) as in the keypoint store
+    :param decimals: round the centralized values, None keeps them
+    :param dtype: float type of the result, np.float64 keeps the values of json files exact
+    :return: array (frames, 137, 3)
+    """
+    keypoints = to_float_array(keypoints, dtype)
+    result = keypoints.copy()
+    xy = keypoints[:, :, :2]
+    centralized = xy[:, :1, :] - xy
+    if decimals is not None:
+        centralized = np.round(centralized, decimals)
+    centralized[(xy == 0) | np.isnan(xy)] = np.nan
+
+    pose = key_slices()["pose_keypoints_2d"]
+    legs = np.setdiff1d(np.arange(pose.start, pose.stop), POSE_UPPER_BODY)
+    centralized[:, legs] = np.nan
+    centralized[:, pose.start] = 0
+    result[:, :, :2] = centralized
+    return result
+
+
+def normalize_values(values, mean, stdev, dtype=np.float32):
+    """
+    (value - mean) / stdev, values whose stdev is missing or 0 are kept, missing values stay NaN
+    :param values: array (..., joints), NaN for missing values
+    :param mean: array (joints,), NaN for joints without mean
+    :param stdev: array (joints,), NaN for joints without stdev
+    :param dtype: float type of the result
+    :return: array of the shape of values
+    """
+    values = to_float_array(values, dtype)
+    mean = to_float_array(mean, dtype)
+    stdev = to_float_array(stdev, dtype)
+    usable = np.isfinite(stdev) & (stdev != 0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        normalized = (values - mean) / stdev
+    return np.where(usable, normalized, values)
+
+
+def mean_stdev_arrays(all_mean_stdev):
+    """
+    Means and stdevs of the content of all_mean_stdev.json as arrays
+    :param all_mean_stdev: one entry per key [[means_x, stdevs_x], [means_y, stdevs_y]], "Null" or None for joints
+        without mean and stdev
+    :return: mean, stdev as float64 arrays (joints, 2), NaN for joints without mean and stdev
+    """
+    mean = np.concatenate([np.stack([to_float_array(entry[axis][0], np.float64) for axis in range(2)], axis=1)
+                           for entry in all_mean_stdev])
+    stdev = np.concatenate([np.stack([to_float_array(entry[axis][1], np.float64) for axis in range(2)], axis=1)
+                            for entry in all_mean_stdev])
+    return mean, stdev
+
+
+def mean_stdev(values, skip_missing=True):
+    """
+    Mean and population stdev (statistics.pstdev) per joint
+    :param values: array (files, joints), NaN for missing values
+    :param skip_missing: True: exclude missing values, False: joints with a missing value have no mean and stdev
+    :return: mean, stdev as float64 arrays (joints,), NaN for joints without mean and stdev
+    """
+    values = to_float_array(values, np.float64)
+    with np.errstate(invalid="ignore", divide="ignore"), warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)  # mean of empty slice
+        if skip_missing:
+            return np.nanmean(values, axis=0), np.nanstd(values, axis=0)
+        return values.mean(axis=0), values.std(axis=0)
@@ -81,7 +81,15 @@ class TransformerModel(nn.Module):
         self.decoder.bias.data.zero_()
         self.decoder.weight.data.uniform_(-initrange, initrange)
 
-    def forward(self, src, trg):
+    def forward(self, src, trg, src_key_padding_mask=None, tgt_key_padding_mask=None):
+        """
+        :param src: (frames, batch, features)
+        :param trg: (words, batch)
+        :param src_key_padding_mask: (batch, frames), True for padded frames, e.g. ~PaddedBatch.source_mask, None
+            derives it from the source values
+        :param tgt_key_padding_mask: (batch, words), True for padding, None derives it from the <pad> ids
+        :return: (words, batch, ntoken)
+        """
 
         ############### OLD
         # if self.src_mask is None or self.src_mask.size(0) != len(src):
@@ -105,12 +113,18 @@ class TransformerModel(nn.Module):
         if self.trg_mask is None or self.trg_mask.size(0) != len(trg):
             self.trg_mask = self.generate_square_subsequent_mask(len(trg)).to(trg.device)
 
-        padding_tensor = src.mean(2)
-        src_pad_mask = self.make_len_mask(padding_tensor)
-        src_pad_mask = ~src_pad_mask
-        # src_pad_mask = src_pad_mask.permute(1, 0)
-
-        trg_pad_mask = self.make_len_mask(trg)
+        if src_key_padding_mask is None:
+            padding_tensor = src.mean(2)
+            src_pad_mask = self.make_len_mask(padding_tensor)
+            src_pad_mask = ~src_pad_mask
+            # src_pad_mask = src_pad_mask.permute(1, 0)
+        else:
+            src_pad_mask = src_key_padding_mask
+
+        if tgt_key_padding_mask is None:
+            trg_pad_mask = self.make_len_mask(trg)
+        else:
+            trg_pad_mask = tgt_key_padding_mask
 
         # src = self.encoder(src)
         src = self.pos_encoder(src)
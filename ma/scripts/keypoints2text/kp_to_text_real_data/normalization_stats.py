@@ -0,0 +1,217 @@
+"""normalization_stats.py: normalization statistics of a keypoint store, cached and applied when the clips are loaded
+
+Instead of writing a normalized copy of the corpus per normalization variant (all_files_normalized.npy), the means and
+stdevs are computed once per store and variant and cached next to the store:
+    <store>/normalization_stats/<fingerprint>_<variant>.npz
+The fingerprint (keypoint_store.store_fingerprint) changes whenever clips are added, replaced or removed and when the
+keypoints of a store are rewritten in place (size and mtime), so a stale cache is not used.
+
+Variants, the clips of a group share one mean and stdev:
+    global      all clips
+    speaker     one group per speaker id (catalog.sqlite, otherwise the folder name)
+    split       one group per split (train, val, test) of catalog.sqlite
+The stats are computed on the centralized keypoints (see missing_joints.centralize_keypoints), with the suffix _raw on
+the stored keypoints, e.g. speaker_raw. Clips of groups without stats fall back to the global stats.
+
+TextKeypointsDataset(..., normalization="speaker") normalizes every clip when it is loaded.
+
+usage:
+normalization_stats.py path_to_store [variant] [num_workers]
+    compute (or load from the cache) the stats of a variant, default global
+"""
+
+import os
+import sys
+import time
+from multiprocessing import Pool
+from pathlib import Path
+import numpy as np
+
+try:
+    from keypoints2text.kp_to_text_real_data.keypoint_store import open_store, store_fingerprint, is_keypoint_store
+    from keypoints2text.kp_to_text_real_data.keypoint_stats import RunningMeanStdev, clip_list_stats
+    from keypoints2text.kp_to_text_real_data.clip_catalog import open_catalog, parse_clip_id, split_from_path
+    from keypoints2text.kp_to_text_real_data.missing_joints import centralize_keypoints, normalize_values
+except ImportError:  # server uses different imports than local
+    from keypoint_store import open_store, store_fingerprint, is_keypoint_store
+    from keypoint_stats import RunningMeanStdev, clip_list_stats
+    from clip_catalog import open_catalog, parse_clip_id, split_from_path
+    from missing_joints import centralize_keypoints, normalize_values
+
+GROUPINGS = ("global", "speaker", "split")
+CACHE_DIR = "normalization_stats"
+GLOBAL = "global"
+
+
+def parse_variant(variant):
+    """
+    :param variant: e.g. "speaker" or "speaker_raw"
+    :return: grouping (one of GROUPINGS), centralize
+    """
+    by, _, suffix = variant.partition("_")
+    if by not in GROUPINGS or suffix not in ("", "raw"):
+        raise ValueError("Unknown normalization %s, use one of %s, optionally with _raw" % (variant,
+                                                                                           ", ".join(GROUPINGS)))
+    return by, suffix != "raw"
+
+
+def clip_groups(path_to_store, by, clip_ids):
+    """
+    Group of each clip
+    :param by: one of GROUPINGS
+    :return: list of group names (str), one per clip
+    """
+    if by == GLOBAL:
+        return [GLOBAL] * len(clip_ids)
+    column = "speaker_id" if by == "speaker" else "split"
+    known = {}
+    catalog = open_catalog(path_to_store)
+    if catalog is not None:
+        with catalog:
+            known = dict(catalog.select(("clip_id", column)))
+    groups = []
+    for clip_id in clip_ids:
+        group = known.get(clip_id)
+        if group is None:
+            group = parse_clip_id(clip_id)[2] if by == "speaker" else split_from_path(path_to_store)
+        groups.append(str(group))
+    return groups
+
+
+def group_stats(args):
+    """
+    Stats of the clips of one group, runs in the worker processes
+    :param args: (path to store, group, clip indexes, centralize)
+    :return: group, RunningMeanStdev
+    """
+    path_to_store, group, indexes, centralize = args
+    return group, clip_list_stats(path_to_store, indexes, centralize=centralize)
+
+
+class NormalizationStats:
+    """
+    Means and stdevs (137 joints x (x, y)) per group of clips
+    usage:
+        stats = NormalizationStats.load_or_compute(path_to_store, "speaker")
+        keypoints = stats.transform(clip_id, store.get_clip(clip_id))
+    """
+
+    def __init__(self, variant, groups, mean, stdev, clip_ids, clip_groups):
+        """
+        :param groups: group names, GLOBAL is always one of them
+        :param mean: array (groups, 137, 2), NaN for joints without values
+        :param stdev: array (groups, 137, 2)
+        :param clip_ids: clip ids of the store
+        :param clip_groups: group of each clip
+        """
+        self.variant = variant
+        self.by, self.centralize = parse_variant(variant)
+        self.group_index = {group: idx for idx, group in enumerate(groups)}
+        self.mean = mean
+        self.stdev = stdev
+        self.clip_group = dict(zip(clip_ids, clip_groups))
+
+    @classmethod
+    def compute(cls, path_to_store, variant=GLOBAL, num_workers=1):
+        """
+        Compute the stats of all groups, one pass over the store, the groups are spread over num_workers processes
+        """
+        by, centralize = parse_variant(variant)
+        clip_ids = open_store(path_to_store).keys()
+        groups_of_clips = clip_groups(path_to_store, by, clip_ids)
+        indexes = {}
+        for idx, group in enumerate(groups_of_clips):
+            indexes.setdefault(group, []).append(idx)
+
+        tasks = [(str(path_to_store), group, group_indexes, centralize) for group, group_indexes in indexes.items()]
+        if num_workers <= 1 or len(tasks) == 1:
+            results = dict(map(group_stats, tasks))
+        else:
+            with Pool(num_workers) as pool:
+                results = dict(pool.imap_unordered(group_stats, tasks))
+
+        # the global stats are merged from the group stats
+        if GLOBAL not in results:
+            total = RunningMeanStdev()
+            for stats in results.values():
+                total.merge(stats)
+            results[GLOBAL] = total
+        groups = sorted(results)
+        mean_stdev = [results[group].mean_stdev() for group in groups]
+        return cls(variant, groups, np.stack([mean for mean, _ in mean_stdev]),
+                   np.stack([stdev for _, stdev in mean_stdev]), clip_ids, groups_of_clips)
+
+    def save(self, path):
+        """Write the stats into a .npz file, via a temporary file"""
+        groups = sorted(self.group_index, key=self.group_index.get)
+        temp_path = Path(str(path) + ".tmp")
+        with open(temp_path, "wb") as f:
+            np.savez(f, variant=self.variant, groups=np.asarray(groups, dtype=np.str_), mean=self.mean,
+                     stdev=self.stdev, clip_ids=np.asarray(list(self.clip_group), dtype=np.str_),
+                     clip_groups=np.asarray(list(self.clip_group.values()), dtype=np.str_))
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(str(data["variant"]), data["groups"].tolist(), data["mean"], data["stdev"],
+                   data["clip_ids"].tolist(), data["clip_groups"].tolist())
+
+    @classmethod
+    def load_or_compute(cls, path_to_store, variant=GLOBAL, num_workers=1, cache_dir=None):
+        """
+        Load the stats of a variant from the cache of the store, compute and cache them if they are missing
+        :param cache_dir: default <store>/normalization_stats
+        """
+        parse_variant(variant)
+        path = cache_path(path_to_store, variant, cache_dir)
+        if os.path.isfile(path):
+            return cls.load(path)
+        print("Computing %s normalization stats of %s" % (variant, path_to_store))
+        stats = cls.compute(path_to_store, variant, num_workers)
+        os.makedirs(path.parent, exist_ok=True)
+        stats.save(path)
+        return stats
+
+    def mean_stdev(self, clip_id):
+        """Mean and stdev (137, 2) of the group of a clip, the global stats for unknown clips and groups"""
+        idx = self.group_index.get(self.clip_group.get(clip_id), self.group_index[GLOBAL])
+        return self.mean[idx], self.stdev[idx]
+
+    def transform(self, clip_id, keypoints):
+        """
+        Centralize (unless the variant is _raw) and normalize the keypoints of a clip
+        :param keypoints: array (frames, 137, 3)
+        :return: float32 array (frames, 137, 3), missing joints are NaN, the confidence is kept
+        """
+        if self.centralize:
+            keypoints = centralize_keypoints(keypoints)
+        else:
+            keypoints = np.array(keypoints, dtype=np.float32)
+            # OpenPose writes 0 for joints it did not detect, the stats exclude them, they become missing (NaN) as in
+            # centralize_keypoints instead of being normalized to -mean / stdev
+            undetected = (keypoints[:, :, 0] == 0) & (keypoints[:, :, 1] == 0)
+            keypoints[undetected, :2] = np.nan
+        mean, stdev = self.mean_stdev(clip_id)
+        keypoints[:, :, :2] = normalize_values(keypoints[:, :, :2], mean, stdev)
+        return keypoints
+
+
+def cache_path(path_to_store, variant, cache_dir=None):
+    """Cache file of the stats of a variant, named after the fingerprint of the store"""
+    if cache_dir is None:
+        cache_dir = Path(path_to_store) / CACHE_DIR
+    return Path(cache_dir) / ("%s_%s.npz" % (store_fingerprint(path_to_store), variant))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or not is_keypoint_store(sys.argv[1]):
+        print(__doc__)
+        sys.exit()
+
+    variant = sys.argv[2] if len(sys.argv) > 2 else GLOBAL
+    num_workers = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    start_time = time.time()
+    result = NormalizationStats.load_or_compute(sys.argv[1], variant, num_workers)
+    print("%d groups in %s" % (len(result.group_index), cache_path(sys.argv[1], variant)))
+    print("--- %.4s seconds ---" % (time.time() - start_time))
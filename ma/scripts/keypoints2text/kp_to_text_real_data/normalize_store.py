@@ -0,0 +1,169 @@
+"""normalize_store.py: centralize and normalize a keypoint store in one streaming pass
+
+Replaces the separate centralization and normalization scripts (centralize.py, centralize_normalize*.py) for keypoint
+stores. Chunks of frames are read from the store, the neck joint (pose 0) is subtracted by broadcasting, the
+precomputed means and stdevs are applied and the chunk is written to the target store. Nothing is held in memory
+besides the current chunk, the clips are split into equal ranges, one process and one shard of the target store per
+range.
+
+The results are the ones of Normalize.centralize and Normalize.normalize (centralize_normalize_np.py): missing joints
+and the legs are NaN, joints without stdev (or stdev 0) are only centralized. The computation runs in float64, the
+target store is float32 (or float16).
+
+Without all_mean_stdev.json the stats of the centralized keypoints are computed first (an extra read-only pass, see
+keypoint_stats.py) and written into the target store directory.
+
+usage:
+normalize_store.py path_to_store path_to_target_store [num_workers] [path_to_mean_stdev] [mode]
+    num_workers: amount of processes, default 1
+    path_to_mean_stdev: all_mean_stdev.json, layout of centralize_normalize.py or centralize_normalize_np.py
+    mode: both (default), centralize or normalize
+"""
+
+import json
+import os
+import sys
+import time
+from multiprocessing import Pool
+from pathlib import Path
+import numpy as np
+
+try:
+    from keypoints2text.kp_to_text_real_data.keypoint_store import open_store, is_keypoint_store, ShardWriter, \
+        shard_entry, KEYS
+    from keypoints2text.kp_to_text_real_data.keypoint_stats import compute_store_stats, part_range, write_mean_stdev
+    from keypoints2text.kp_to_text_real_data.missing_joints import centralize_keypoints, normalize_values, \
+        mean_stdev_arrays
+except ImportError:  # server uses different imports than local
+    from keypoint_store import open_store, is_keypoint_store, ShardWriter, shard_entry, KEYS
+    from keypoint_stats import compute_store_stats, part_range, write_mean_stdev
+    from missing_joints import centralize_keypoints, normalize_values, mean_stdev_arrays
+
+MODES = ("both", "centralize", "normalize")
+
+
+def read_mean_stdev(path_to_mean_stdev):
+    """
+    Read all_mean_stdev.json, a list per key (centralize_normalize_np.py) or a dictionary keyed by the OpenPose keys
+    (centralize_normalize.py)
+    :return: mean, stdev as float64 arrays (137, 2), NaN for joints without mean and stdev
+    """
+    with open(path_to_mean_stdev) as f:
+        all_mean_stdev = json.load(f)
+    if isinstance(all_mean_stdev, dict):
+        all_mean_stdev = [all_mean_stdev[k] for k in KEYS]
+    return mean_stdev_arrays(all_mean_stdev)
+
+
+def transform_chunk(keypoints, mean=None, stdev=None, centralize=True, decimals=None):
+    """
+    Centralize and normalize a chunk of frames
+    :param keypoints: array (frames, 137, 3)
+    :param mean: array (137, 2), None to skip the normalization
+    :param stdev: array (137, 2)
+    :param centralize: subtract the neck joint, missing joints become NaN
+    :param decimals: round the centralized values (Normalize.centralize rounds to 5), None keeps them
+    :return: float64 array (frames, 137, 3), the confidence is kept
+    """
+    if centralize:
+        keypoints = centralize_keypoints(keypoints, decimals, np.float64)
+    else:
+        keypoints = np.array(keypoints, dtype=np.float64)
+    if mean is not None:
+        keypoints[:, :, :2] = normalize_values(keypoints[:, :, :2], mean, stdev, np.float64)
+    return keypoints
+
+
+def write_chunk(writer, chunk, mean, stdev, centralize, decimals):
+    """Transform the clips of a chunk with one numpy operation and add them to the writer"""
+    transformed = transform_chunk(np.concatenate([clip for _, clip in chunk]), mean, stdev, centralize, decimals)
+    offset = 0
+    for clip_id, clip in chunk:
+        writer.add_clip(clip_id, transformed[offset:offset + clip.shape[0]])
+        offset += clip.shape[0]
+
+
+def transform_clip_range(args):
+    """
+    Transform the clips start <= idx < stop of a store into a new shard, runs in the worker processes
+    :param args: (path to store, path to target store, shard name, start, stop, mean, stdev, centralize, decimals,
+        chunk size in frames, encoding)
+    :return: manifest entry of the shard
+    """
+    path_to_store, path_to_target, name, start, stop, mean, stdev, centralize, decimals, chunk_size, encoding = args
+    store = open_store(path_to_store)
+    clip_ids = store.keys()
+    with ShardWriter(path_to_target, encoding).new_shard(name) as writer:
+        chunk = []
+        num_frames = 0
+        for idx in range(start, stop):
+            clip = store.get_clip_by_index(idx)
+            chunk.append((clip_ids[idx], clip))
+            num_frames += clip.shape[0]
+            if num_frames >= chunk_size:
+                write_chunk(writer, chunk, mean, stdev, centralize, decimals)
+                chunk = []
+                num_frames = 0
+        if chunk:
+            write_chunk(writer, chunk, mean, stdev, centralize, decimals)
+    return shard_entry(writer)
+
+
+def normalize_store(path_to_store, path_to_target, num_workers=1, path_to_mean_stdev="", mode="both",
+                    decimals=None, chunk_size=100000, encoding="float32"):
+    """
+    Write the centralized and/or normalized clips of a store into a new sharded store
+    :param path_to_store: (sharded) keypoint store
+    :param path_to_target: directory of the new store, must not be a store already
+    :param num_workers: amount of processes, one shard per process
+    :param path_to_mean_stdev: all_mean_stdev.json, computed from the store if empty
+    :param mode: one of MODES
+    :param decimals: round the centralized values, None keeps them
+    :param chunk_size: frames per chunk
+    :param encoding: float32 or float16, int16 can not hold NaN
+    :return: path to the new store
+    """
+    if mode not in MODES:
+        raise ValueError("Unknown mode %s, use one of %s" % (mode, ", ".join(MODES)))
+    if encoding == "int16":
+        raise ValueError("int16 stores can not hold missing joints (NaN), use float32 or float16")
+    if is_keypoint_store(path_to_target):
+        raise ValueError("%s is a keypoint store already" % path_to_target)
+    os.makedirs(path_to_target, exist_ok=True)
+
+    centralize = mode in ("both", "centralize")
+    mean = stdev = None
+    if mode in ("both", "normalize"):
+        if path_to_mean_stdev == "":
+            print("Computing mean and stdev of %s" % path_to_store)
+            stats = compute_store_stats(path_to_store, num_workers, chunk_size, centralize)
+            write_mean_stdev(stats, path_to_target)
+            path_to_mean_stdev = Path(path_to_target) / "all_mean_stdev.json"
+        mean, stdev = read_mean_stdev(path_to_mean_stdev)
+
+    num_clips = len(open_store(path_to_store))
+    num_workers = max(1, min(num_workers, num_clips))
+    ranges = [(path_to_store, path_to_target, "shard_%05d" % part) + part_range(num_clips, part, num_workers) +
+              (mean, stdev, centralize, decimals, chunk_size, encoding) for part in range(num_workers)]
+    if num_workers == 1:
+        shards = [transform_clip_range(ranges[0])]
+    else:
+        with Pool(num_workers) as pool:
+            shards = pool.map(transform_clip_range, ranges)  # in clip order
+    # the shards become visible together with the manifest
+    ShardWriter(path_to_target, encoding).append_shards(shards)
+    return Path(path_to_target)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or not is_keypoint_store(sys.argv[1]):
+        print(__doc__)
+        sys.exit()
+
+    num_workers = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    path_to_mean_stdev = sys.argv[4] if len(sys.argv) > 4 else ""
+    mode = sys.argv[5] if len(sys.argv) > 5 else "both"
+
+    start_time = time.time()
+    normalize_store(sys.argv[1], sys.argv[2], num_workers, path_to_mean_stdev, mode)
+    print("--- %.4s seconds ---" % (time.time() - start_time))
@@ -0,0 +1,99 @@
+"""prefetch.py: batches of a DataLoader prepared on a background thread
+
+BatchPrefetcher runs the DataLoader on a background thread, converts each batch (dtype, layout, device transfer) and
+keeps up to num_batches converted batches ready. The training loop only takes the next batch from the queue, the time
+it has to wait for it is measured (take_wait_time), which is 0 as long as the loading keeps up with the training.
+
+The DataLoader is restarted at its end, the prefetcher cycles through the epochs on its own (a LengthBucketSampler
+reshuffles each epoch). Batches for which convert returns None are skipped (e.g. empty samples). An exception of the
+DataLoader or of convert is raised again in the training loop instead of restarting the DataLoader.
+
+usage:
+    batches = BatchPrefetcher(data_loader, convert=lambda data: (data[0].to(device), data[1].to(device)))
+    source, target = next(batches)
+    wait_s = batches.take_wait_time()  # seconds spent waiting for batches since the last call
+    batches.close()
+"""
+
+import queue
+import threading
+import time
+
+
+class BatchPrefetcher:
+
+    def __init__(self, data_loader, convert, num_batches=2):
+        """
+        :param data_loader: iterable of batches, iterated again after each epoch
+        :param convert: function batch -> converted batch, None skips the batch
+        :param num_batches: converted batches kept ready
+        """
+        self.data_loader = data_loader
+        self.convert = convert
+        self.batches = queue.Queue(maxsize=max(num_batches, 1))
+        self.stop = threading.Event()
+        self.epoch = 0
+        self.wait_time = 0.0
+        self.steps = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        """Background thread: load, convert and queue the batches until close"""
+        try:
+            while not self.stop.is_set():
+                converted = 0
+                for data in self.data_loader:
+                    batch = self.convert(data)
+                    if batch is None:
+                        continue
+                    converted += 1
+                    if not self.put((False, batch)):
+                        return
+                if converted == 0:
+                    raise RuntimeError("The data loader returned no usable batch")
+                self.epoch += 1
+        except Exception as error:
+            self.put((True, error))
+
+    def put(self, item):
+        """Queue an item, False if the prefetcher was closed meanwhile"""
+        while not self.stop.is_set():
+            try:
+                self.batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        failed, item = self.batches.get()
+        self.wait_time += time.perf_counter() - start
+        self.steps += 1
+        if failed:
+            self.close()
+            raise item
+        return item
+
+    def take_wait_time(self):
+        """
+        :return: seconds spent waiting for batches since the last call
+        """
+        wait_time = self.wait_time
+        self.wait_time = 0.0
+        return wait_time
+
+    def close(self):
+        """Stop the background thread, the queued batches are dropped"""
+        self.stop.set()
+        while self.thread.is_alive():
+            try:
+                while True:
+                    self.batches.get_nowait()
+            except queue.Empty:
+                pass
+            self.thread.join(timeout=0.1)
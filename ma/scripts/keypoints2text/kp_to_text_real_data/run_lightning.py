@@ -5,6 +5,11 @@
 Using the transformer model with pytorch lightning. Using only the transformer model here because its suited for the usage with lightning.
 I think moving the seq2seq with attention to lightning is tricky because of the AttnSeq2Seq class
 
+model_settings "max_frames_per_batch" > 0: length bucketed batches padded per batch (see batching.py), the steps permute
+the batch to (frames, batch, features) / (words, batch) and pass the padding masks of the batch to the transformer
+model_settings "num_workers" > 0: persistent workers ("prefetch_factor" batches each) sharing the frame vectors
+(feature_cache "shared" unless "feature_cache" is set, see data_loader.py)
+
 """
 from __future__ import unicode_literals, division
 import warnings
@@ -32,11 +37,13 @@ import traceback
 # use try/except -> local and server import differs
 try:
     from keypoints2text.kp_to_text_real_data.model_transformer import TransformerModel
-    from keypoints2text.kp_to_text_real_data.data_loader import TextKeypointsDataset, ToTensor
-    from keypoints2text.kp_to_text_real_data.data_utils import DataUtils
+    from keypoints2text.kp_to_text_real_data.data_loader import TextKeypointsDataset, ToTensor, loader_args
+    from keypoints2text.kp_to_text_real_data.batching import bucketed_loader
+    from keypoints2text.kp_to_text_real_data.vocabulary import Vocabulary
 except ImportError:  # server uses different imports than local
-    from data_loader import TextKeypointsDataset, ToTensor
-    from data_utils import DataUtils
+    from data_loader import TextKeypointsDataset, ToTensor, loader_args
+    from batching import bucketed_loader
+    from vocabulary import Vocabulary
     from model_transformer import TransformerModel
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -94,6 +101,11 @@ class Litty(LightningModule):
 
         self.model_type = config["model_settings"]["model_type"]  # model_type: basic, attn or trans
         self.num_workers = config["model_settings"]["num_workers"]
+        self.prefetch_factor = config["model_settings"].get("prefetch_factor", 2)
+        self.feature_cache = config["model_settings"].get("feature_cache", "shared" if self.num_workers > 0 else None)
+        # frame budget per batch, 0: fixed batch_size and padding
+        self.max_frames_per_batch = config["model_settings"].get("max_frames_per_batch", 0)
+        self.sample_padding = 0 if self.max_frames_per_batch > 0 else self.padding
         self.reduceplt_lr_patience = config["learning_rate_settings"]["reduceplt_lr_patience"]
         self.learning_rate = config["learning_rate_settings"]["learning_rate"]
         self.auto_lr_find = config["learning_rate_settings"]["auto_lr_find"]
@@ -135,6 +147,8 @@ class Litty(LightningModule):
 
         # vocab file, containing unique words for all (train, val & test)
         self.path_to_vocab_file_all = config["vocab_file"]["path_to_vocab_file_all"]
+        # read once, shared with the datasets (see vocabulary.py)
+        self.vocab = Vocabulary.load(self.path_to_vocab_file_all)
 
         # set tokens
         self.PAD_token = 0
@@ -194,8 +208,21 @@ class Litty(LightningModule):
         mask = mask.float().masked_fill(mask == 0, float('-inf')).masked_fill(mask == 1, float(0.0))
         return mask
 
-    def forward(self, src, trg):
-        return self.model(src, trg)
+    def forward(self, src, trg, src_key_padding_mask=None, tgt_key_padding_mask=None):
+        return self.model(src, trg, src_key_padding_mask, tgt_key_padding_mask)
+
+    def bucketed_step(self, batch):
+        """
+        Loss of a PaddedBatch of the bucketed loader, the model is not batch_first
+        :param batch: PaddedBatch, source (batch, frames, features), target (batch, words)
+        :return: loss over the real words (<pad> is ignored)
+        """
+        source_tensor = batch.source.permute(1, 0, 2)  # (frames, batch, features)
+        target_tensor = batch.target.long().t()  # (words, batch)
+        output = self(source_tensor, target_tensor, src_key_padding_mask=~batch.source_mask,
+                      tgt_key_padding_mask=~batch.target_mask)
+        criterion = nn.CrossEntropyLoss(ignore_index=self.vocab.pad_id)
+        return criterion(output.reshape(-1, output.shape[-1]), target_tensor.reshape(-1))
 
         # if self.src_mask is None or self.src_mask.size(0) != len(src):
         #     device = src.device
@@ -218,20 +245,26 @@ class Litty(LightningModule):
             path_to_vocab_file=self.path_to_vocab_file_all,
             input_length=self.input_size,
             transform=ToTensor(),
-            kp_max_len=self.padding,
-            text_max_len=self.padding)
+            kp_max_len=self.sample_padding,
+            text_max_len=self.sample_padding,
+            feature_cache=self.feature_cache)
+        if self.max_frames_per_batch > 0:
+            return bucketed_loader(text2kp_val, self.max_frames_per_batch, shuffle=False,
+                                   num_workers=self.num_workers, prefetch_factor=self.prefetch_factor)
         data_loader_val = torch.utils.data.DataLoader(text2kp_val, batch_size=self.batch_size,
-                                                      num_workers=self.num_workers)
+                                                      **loader_args(self.num_workers, self.prefetch_factor))
 
         return data_loader_val
 
     def validation_step(self, batch, batch_idx):
+        if self.max_frames_per_batch > 0:
+            return {'val_loss': self.bucketed_step(batch)}
         rouge = Rouge()
-        source_tensor, target_tensor = batch
+        source_tensor, target_tensor = batch[0], batch[1]
         # source_tensor = source_tensor.permute(1, 0, 2)
         # target_tensor = target_tensor.view(-1)
 
-        target_tensor = target_tensor.view(1, self.padding)
+        target_tensor = target_tensor.view(1, -1)
         target_tensor = target_tensor.type(torch.LongTensor).to(target_tensor.device)
 
         # with open('log_batches.txt', 'a') as f:
@@ -259,7 +292,7 @@ class Litty(LightningModule):
         # target_tensor[target_tensor == 3] = 0
         output = self(source_tensor, target_tensor)
         output_dim = output.shape[-1]
-        ignore_index = DataUtils().text2index(["<pad>"], DataUtils().vocab_word2int(self.path_to_vocab_file_all))[0][0]
+        ignore_index = self.vocab.pad_id
         criterion = nn.CrossEntropyLoss(ignore_index=ignore_index)
         # loss = criterion(output.view(-1, self.output_size), target_tensor)
 
@@ -393,20 +426,27 @@ class Litty(LightningModule):
                                              path_to_csv=self.path_to_csv_train,
                                              path_to_vocab_file=self.path_to_vocab_file_all,
                                              input_length=self.input_size,
-                                             transform=ToTensor(), kp_max_len=self.padding, text_max_len=self.padding)
+                                             transform=ToTensor(), kp_max_len=self.sample_padding,
+                                             text_max_len=self.sample_padding, feature_cache=self.feature_cache)
+        if self.max_frames_per_batch > 0:
+            return bucketed_loader(text2kp_train, self.max_frames_per_batch, num_workers=self.num_workers,
+                                   prefetch_factor=self.prefetch_factor)
         data_loader_train = torch.utils.data.DataLoader(text2kp_train, batch_size=self.batch_size, shuffle=True,
-                                                        num_workers=self.num_workers)
+                                                        **loader_args(self.num_workers, self.prefetch_factor))
         return data_loader_train
 
     def training_step(self, batch, batch_idx):
-        source_tensor, target_tensor = batch
+        if self.max_frames_per_batch > 0:
+            loss = self.bucketed_step(batch)
+            return {'loss': loss, 'log': {'train_loss': loss}}
+        source_tensor, target_tensor = batch[0], batch[1]
         # source_tensor = source_tensor.permute(1, 0, 2)
 
-        target_tensor = target_tensor.view(1, self.padding)
+        target_tensor = target_tensor.view(1, -1)
         # target_tensor = target_tensor[:-1, :]
         target_tensor = target_tensor.type(torch.LongTensor).to(target_tensor.device)
 
-        ignore_index = DataUtils().text2index(["<pad>"], DataUtils().vocab_word2int(self.path_to_vocab_file_all))[0][0]
+        ignore_index = self.vocab.pad_id
         criterion = nn.CrossEntropyLoss(ignore_index=ignore_index)
 
         # target_tensor[target_tensor == 3] = 0
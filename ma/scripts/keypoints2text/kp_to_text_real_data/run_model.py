@@ -4,6 +4,10 @@ run_model.py:
 - run basic seq2seq, seq2seq with attention and transformer model
 - "framewise": use data_loader_framewise (-1, batch_size, 274), instead of flatten input
 - if necessary use run_model.py path_to_hparams
+- model_settings "max_frames_per_batch" > 0: length bucketed batches under a frame budget, padded per batch instead of
+  padding every sample to "padding" (see batching.py)
+- the batches are loaded, converted and moved to the device on a background thread, model_settings "prefetch_batches"
+  batches ahead (see prefetch.py), the time waited for them is logged as info/data_wait_ms
 
 """
 
@@ -29,20 +33,24 @@ import warnings
 warnings.filterwarnings("ignore")
 
 try:
-    from keypoints2text.kp_to_text_real_data.data_loader import TextKeypointsDataset, ToTensor
+    from keypoints2text.kp_to_text_real_data.data_loader import TextKeypointsDataset, ToTensor, loader_args
+    from keypoints2text.kp_to_text_real_data.batching import bucketed_loader
+    from keypoints2text.kp_to_text_real_data.prefetch import BatchPrefetcher
+    from keypoints2text.kp_to_text_real_data.vocabulary import Vocabulary
     # from keypoints2text.kp_to_text_real_data.model_seq2seq import Encoder, Decoder, Seq2Seq
     from keypoints2text.kp_to_text_real_data.model_seq2seq_attention import AttnEncoder, AttnDecoderRNN, AttnSeq2Seq
     from keypoints2text.kp_to_text_real_data.model_seq2seq_attention_batches import Encoder, Seq2Seq, Decoder, Attention
     from keypoints2text.kp_to_text_real_data.model_transformer import TransformerModel
-    from keypoints2text.kp_to_text_real_data.data_utils import DataUtils
     from keypoints2text.kp_to_text_real_data.save_model import Helper, Save, Mode
 except ImportError:  # server uses different imports than local
-    from data_loader import TextKeypointsDataset, ToTensor
+    from data_loader import TextKeypointsDataset, ToTensor, loader_args
+    from batching import bucketed_loader
+    from prefetch import BatchPrefetcher
+    from vocabulary import Vocabulary
     # from model_seq2seq import Encoder, Decoder, Seq2Seq
     from model_seq2seq_attention import AttnEncoder, AttnDecoderRNN, AttnSeq2Seq
     from model_seq2seq_attention_batches import Encoder, Seq2Seq, Decoder, Attention
     from model_transformer import TransformerModel
-    from data_utils import DataUtils
     from save_model import Helper, Save, Mode
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -79,6 +87,14 @@ class RunModel:
 
         self.model_type = config["model_settings"]["model_type"]  # model_type: basic, attn or trans
         self.num_workers = config["model_settings"]["num_workers"]
+        # batches loaded in advance per worker, the workers persist over the epochs
+        self.prefetch_factor = config["model_settings"].get("prefetch_factor", 2)
+        # workers share the frame vectors instead of getting a copy of the keypoints each
+        self.feature_cache = config["model_settings"].get("feature_cache", "shared" if self.num_workers > 0 else None)
+        # converted batches prepared in advance on a background thread (see prefetch.py)
+        self.prefetch_batches = config["model_settings"].get("prefetch_batches", 2)
+        # frame budget per batch, 0: fixed batch_size and padding
+        self.max_frames_per_batch = config["model_settings"].get("max_frames_per_batch", 0)
 
         # learning rate settings / training setting
         self.learning_rate = config["learning_rate_settings"]["learning_rate"]
@@ -122,6 +138,9 @@ class RunModel:
 
         # vocab file, containing unique words for all (train, val & test)
         self.path_to_vocab_file_all = config["vocab_file"]["path_to_vocab_file_all"]
+        # read once, shared with the datasets (see vocabulary.py)
+        self.vocab_train = Vocabulary.load(self.path_to_vocab_file_train)
+        self.vocab_all = Vocabulary.load(self.path_to_vocab_file_all)
 
         # set tokens
         self.PAD_token = 0
@@ -187,29 +206,36 @@ class RunModel:
             self.current_folder = os.path.dirname(self.load_model_path)
 
         # Dataloaders for train, val & test
+        # bucketed batches are padded per batch, the samples are not padded
+        sample_padding = 0 if self.max_frames_per_batch > 0 else self.padding
         text2kp_train = TextKeypointsDataset(path_to_numpy_file=self.path_to_numpy_file_train,
                                              path_to_csv=self.path_to_csv_train,
                                              path_to_vocab_file=self.path_to_vocab_file_train, input_length=self.input_size,
-                                             transform=ToTensor(), kp_max_len=self.padding, text_max_len=self.padding)
-        self.data_loader_train = torch.utils.data.DataLoader(text2kp_train, batch_size=self.batch_size, shuffle=True,
-                                                             num_workers=0)
+                                             transform=ToTensor(), kp_max_len=sample_padding,
+                                             text_max_len=sample_padding, feature_cache=self.feature_cache)
+        workers = loader_args(self.num_workers, self.prefetch_factor)
+        if self.max_frames_per_batch > 0:
+            self.data_loader_train = bucketed_loader(text2kp_train, self.max_frames_per_batch,
+                                                     num_workers=self.num_workers,
+                                                     prefetch_factor=self.prefetch_factor)
+        else:
+            self.data_loader_train = torch.utils.data.DataLoader(text2kp_train, batch_size=self.batch_size,
+                                                                 shuffle=True, **workers)
 
         # vocab size, amount of different unique words
         if self.output_size == 0:
-            self.output_size = DataUtils().get_file_length(self.path_to_vocab_file_all)
+            self.output_size = len(self.vocab_all)
 
         # max length of source keypoints and target sentence
         if self.hidden_size == 0:
-            print("Searching for source and target max length")
-            max_len_source, max_len_target, lengths = DataUtils().get_kp_text_max_lengths(
-                self.data_loader_train, self.data_loader_train, self.data_loader_train)
+            # recorded when the dataset is built (see length_stats.py), no pass over the data
+            max_len_source, max_len_target = text2kp_train.lengths.max()
+            print("Source and target max length: %d frames, %d words" % (max_len_source, max_len_target))
             if max_len_source > max_len_target:
                 self.hidden_size = max_len_source
             else:
                 self.hidden_size = max_len_target
-            with open('../quick_test/lengths.txt', 'w') as f:
-                for item in lengths:
-                    f.write("%s\n" % item)
+            text2kp_train.lengths.save(os.path.join(self.current_folder, "length_stats.json"))
 
         # Dataloaders for train, val & test
         # text2kp_train = TextKeypointsDataset(
@@ -223,11 +249,19 @@ class RunModel:
         text2kp_val = TextKeypointsDataset(path_to_numpy_file=self.path_to_numpy_file_val,
                                            path_to_csv=self.path_to_csv_val,
                                            path_to_vocab_file=self.path_to_vocab_file_val, input_length=self.input_size,
-                                           transform=ToTensor(), kp_max_len=self.padding, text_max_len=self.padding)
-        self.data_loader_val = torch.utils.data.DataLoader(text2kp_val, batch_size=self.batch_size, shuffle=True,
-                                                           num_workers=0)
-        self.data_loader_val_eval = torch.utils.data.DataLoader(text2kp_val, batch_size=1, shuffle=True,
-                                                                num_workers=0)
+                                           transform=ToTensor(), kp_max_len=sample_padding,
+                                           text_max_len=sample_padding, feature_cache=self.feature_cache)
+        if self.max_frames_per_batch > 0:
+            self.data_loader_val = bucketed_loader(text2kp_val, self.max_frames_per_batch,
+                                                   num_workers=self.num_workers, prefetch_factor=self.prefetch_factor)
+            self.data_loader_val_eval = bucketed_loader(text2kp_val, self.max_frames_per_batch, max_batch_size=1,
+                                                        num_workers=self.num_workers,
+                                                        prefetch_factor=self.prefetch_factor)
+        else:
+            self.data_loader_val = torch.utils.data.DataLoader(text2kp_val, batch_size=self.batch_size, shuffle=True,
+                                                               **workers)
+            self.data_loader_val_eval = torch.utils.data.DataLoader(text2kp_val, batch_size=1, shuffle=True,
+                                                                    **workers)
 
         # text2kp_test = TextKeypointsDataset(
         #     path_to_numpy_file=self.path_to_numpy_file_test,
@@ -341,7 +375,7 @@ class RunModel:
         model_optimizer = optim.Adam(self.model.parameters(), lr=lr)
         # scheduler = torch.optim.lr_scheduler.StepLR(model_optimizer, self.step_lr_each_nstep, gamma=self.step_lr_gamma)
         scheduler_plat = torch.optim.lr_scheduler.ReduceLROnPlateau(model_optimizer, patience=self.reduceplt_lr_patience, min_lr=0.00001)
-        ignore_index = DataUtils().text2index(["<pad>"], DataUtils().vocab_word2int(self.path_to_vocab_file_all))[0][0]
+        ignore_index = self.vocab_all.pad_id
 
         # if self.model_type == "trans":
         #     criterion = nn.CrossEntropyLoss(ignore_index=ignore_index)
@@ -360,11 +394,12 @@ class RunModel:
         train_loss_save = 0
         idx_epoch = 1
         idx_epoch_save = 0
-        it_train = iter(train_loader)
+        it_train = self.prefetch(train_loader)
+        data_wait_show = 0.0
 
         val_loss_show = 0
         val_loss_save = 0
-        it_val = iter(val_loader)
+        it_val = self.prefetch(val_loader)
 
         if self.use_epochs == 1:
             remaining = 1
@@ -376,11 +411,11 @@ class RunModel:
 
         while remaining <= end:
 
-            train_loss = self.train_model(it_train, train_loader, model_optimizer, criterion)
+            train_loss = self.train_model(it_train, model_optimizer, criterion)
             train_loss_show += train_loss
             train_loss_save += train_loss
 
-            val_loss = self.val_model(it_val, val_loader, criterion)
+            val_loss = self.val_model(it_val, criterion)
             val_loss_show += val_loss
             val_loss_save += val_loss
 
@@ -393,6 +428,10 @@ class RunModel:
                 'train_loss': train_loss,
                 'val_loss': val_loss,
             }, idx_epoch)
+            # time the train step waited for its batches, 0 as long as the loading keeps up
+            data_wait = it_train.take_wait_time()
+            data_wait_show += data_wait
+            self.writer.add_scalar('info/data_wait_ms', data_wait * 1000, idx_epoch)
 
             # num_iteration may not be 0, else error.
             if self.use_epochs == 0:
@@ -418,9 +457,11 @@ class RunModel:
                 # use that instead of cheduler.get_lr[0] (deprecated), because of ReduceOnPlateau
                 lr = float([group['lr'] for group in model_optimizer.param_groups][0])
                 teacher_forcing_print = self.model.teacher_forcing if self.model_type == "attn" or self.model_type == "attn_batch" else 0.0
-                print('Epoch %5d | avg t_loss: %6.2f | avg v_loss: %6.2f | lr: %f | tf: %.2f | elapsed time: %s'
-                      % (idx_epoch, train_avg_loss, val_avg_loss, lr, round(teacher_forcing_print, 2),
-                         str(datetime.timedelta(seconds=int(elapsed_time_s)))))
+                print('Epoch %5d | avg t_loss: %6.2f | avg v_loss: %6.2f | lr: %f | tf: %.2f | data wait: %6.1f ms | '
+                      'elapsed time: %s' % (idx_epoch, train_avg_loss, val_avg_loss, lr, round(teacher_forcing_print, 2),
+                                            data_wait_show / self.show_every * 1000,
+                                            str(datetime.timedelta(seconds=int(elapsed_time_s)))))
+                data_wait_show = 0.0
 
                 remaining_time = int(time_end - time.time())
                 if time_end != 0.0:
@@ -478,52 +519,47 @@ class RunModel:
 
             idx_epoch += 1
 
-    def load_data(self, data_iterator, data_loader):
+        it_train.close()
+        it_val.close()
+
+    def convert_batch(self, data):
         """
-        Load input data from iterator and data_loader
-        Check if data has min and max length
-        :param data_iterator:
-        :param data_loader:
-        :return: source and target data
+        Convert a batch of the data loader into the model input, runs on the thread of the BatchPrefetcher
+        :param data: batch of the data loader, data[0] source, data[1] target
+        :return: source and target tensor on the device, None for empty batches
         """
-        while 1:
-            try:
-                data = next(data_iterator)
-                # data[0].size(): (batchsize=1, frames=15, keypoints=274) => [1, 15, 274]
-                # data[0].size(0): 15
-                # data[1].size(): (batchsize=1, words=3) => [1, 3]
-                # data[1].size(0): 3
-
-                source_tensor = torch.as_tensor(data[0], dtype=torch.float, device=device)
-                source_tensor = source_tensor.permute(1, 0, 2)
-                if self.model_type == "trans":
-                    target_tensor = torch.as_tensor(data[1], dtype=torch.long, device=device).view(-1)
-                else:
-                    target_tensor = torch.as_tensor(data[1], dtype=torch.long, device=device).view(-1, self.batch_size)
-                # print(target_tensor)
-                source_tensor_size = source_tensor.size(0)
-                target_tensor_size = target_tensor.size(0)
-
-                # if 0 < source_tensor_size <= (self.max_length * self.batch_size) and 0 < target_tensor_size:
-                if 0 < source_tensor_size and 0 < target_tensor_size:
-                    break
-            except StopIteration:  # reinitialize data loader if num_iteration > amount of data
-                data_iterator = iter(data_loader)
-            except RuntimeError:
-                data_iterator = iter(data_loader)
+        # data[0].size(): (batchsize=1, frames=15, keypoints=274) => [1, 15, 274]
+        # data[0].size(0): 15
+        # data[1].size(): (batchsize=1, words=3) => [1, 3]
+        # data[1].size(0): 3
+
+        source_tensor = torch.as_tensor(data[0], dtype=torch.float, device=device)
+        source_tensor = source_tensor.permute(1, 0, 2)
+        if self.model_type == "trans":
+            target_tensor = torch.as_tensor(data[1], dtype=torch.long, device=device).view(-1)
+        else:
+            # bucketed batches hold a varying amount of samples
+            target_tensor = torch.as_tensor(data[1], dtype=torch.long, device=device).view(-1, data[1].size(0))
+
+        # if 0 < source_tensor_size <= (self.max_length * self.batch_size) and 0 < target_tensor_size:
+        if source_tensor.size(0) == 0 or target_tensor.size(0) == 0:
+            return None
         return source_tensor, target_tensor
 
-    def train_model(self, it_train, train_loader, model_optimizer, criterion):
+    def prefetch(self, data_loader):
+        """Batches of data_loader converted by convert_batch on a background thread, cycles through the epochs"""
+        return BatchPrefetcher(data_loader, self.convert_batch, self.prefetch_batches)
+
+    def train_model(self, it_train, model_optimizer, criterion):
         """
         the inner most method to train the model, the actual training is implemented here
-        :param source_tensor:
-        :param target_tensor:
+        :param it_train: BatchPrefetcher of the train data
         :param model_optimizer:
         :param criterion:
         :return:
         """
         self.model.train()
-        # train_data = self.load_data(it_train, train_loader)
+        # train_data = next(it_train)
         # source_tensor = train_data[0]
         # target_tensor = train_data[1]
 
@@ -531,7 +567,7 @@ class RunModel:
         epoch_loss = 0.0
         loss = None
         for acuumulated_step_i in range(self.fake_batch):
-            train_data = self.load_data(it_train, train_loader)
+            train_data = next(it_train)
             source_tensor = train_data[0]
             target_tensor = train_data[1]
             if self.model_type == "trans":
@@ -561,14 +597,14 @@ class RunModel:
         model_optimizer.zero_grad()
         return float(epoch_loss)
 
-    def val_model(self, it_val, val_loader, criterion):
+    def val_model(self, it_val, criterion):
         """Validate model during train runtime"""
         loss = None
         epoch_loss = 0.0
         self.model.eval()  # Turn on the evaluation mode
         for acuumulated_step_i in range(self.fake_batch):
             with torch.no_grad():
-                val_data = self.load_data(it_val, val_loader)
+                val_data = next(it_val)
                 source_tensor = val_data[0]
                 target_tensor = val_data[1]
 
@@ -596,10 +632,10 @@ class RunModel:
         :param keypoints_loader: 
         :return: 
         """""
-        it = iter(keypoints_loader)
+        it = self.prefetch(keypoints_loader)
         rouge = Rouge()
         for idx in range(1, self.num_iteration_eval + 1):
-            iterator_data = self.load_data(it, keypoints_loader)
+            iterator_data = next(it)
 
             with torch.no_grad():
 
@@ -615,9 +651,8 @@ class RunModel:
                         for item in sublist:
                             flat_list.append(item)
 
-                hypothesis = DataUtils().int2text(flat_list, DataUtils().vocab_int2word(self.path_to_vocab_file_train))
-                hypothesis = list(filter("<pad>".__ne__, hypothesis))
-                hypothesis = list(filter("<eos>".__ne__, hypothesis))
+                # without <pad> and <eos>
+                hypothesis = self.vocab_train.decode(flat_list)
                 hyp_str = " ".join(hypothesis)
 
                 decoded_words = []
@@ -629,15 +664,11 @@ class RunModel:
                 for ot in range(output.size(0)):
                     topv, topi = output[ot].topk(1)
                     if topi[0].item() == self.EOS_token:
-                        decoded_words.append('<eos>')
                         break
                     else:
                         decoded_words.append(topi[0].item())
 
-                reference = DataUtils().int2text(decoded_words,
-                                                 DataUtils().vocab_int2word(self.path_to_vocab_file_all))
-                reference = list(filter("<pad>".__ne__, reference))
-                reference = list(filter("<eos>".__ne__, reference))
+                reference = self.vocab_all.decode(decoded_words)
                 ref_str = " ".join(reference)
 
                 # if len(hypothesis) >= 4 or len(reference) >= 4:
@@ -677,6 +708,7 @@ class RunModel:
                     self.metrics["bleu4"].append(bleu4_score)
                     self.metrics["meteor"].append(meteor_score)
                     self.metrics["rouge"].append(rouge_score)
+        it.close()
 
     def save_helper(self, save, mode):
 
@@ -0,0 +1,224 @@
+"""subword.py: byte pair encoding (BPE) of the target sentences, trained offline from the sentence files
+
+Instead of one id per word (vocab_utils.py), the words are split into subwords: the trainer starts from the characters
+of all words and repeatedly merges the most frequent pair of adjacent symbols, until the vocab has vocab_size entries.
+Frequent words stay whole, rare words are split into known pieces instead of becoming <unk>. A smaller vocab_size
+means a smaller output layer and softmax of the decoders, at the cost of longer target sequences.
+
+Files (vocab file as vocab_utils.py, one token per line, the line number is the id):
+    <name>.txt          <pad>, <unk>, <sos>, <eos>, the characters and the merged subwords
+    <name>_merges.txt   the merges in training order, one pair per line
+A subword which does not end a word has the suffix @@, e.g. "walking" -> "walk@@ ing".
+
+Vocabulary.load (vocabulary.py) uses the merges file if there is one next to the vocab file: the dataset, the token
+cache and the evaluation encode and decode with subwords as soon as the vocab paths of the hparams file point to the
+subword vocab file (output_size 0 takes the size of the vocab). Decoding joins the subwords back into words, the
+metrics are computed on words.
+
+usage:
+subword.py path_to_vocab_file vocab_size path_to_sentences [path_to_sentences ...]
+    train the subwords of the sentence files (ID Sentence per line, e.g. how2sign.train.id_transformed.txt, or a csv
+    file with a "text" column) and write path_to_vocab_file and its merges file
+"""
+
+import csv
+import heapq
+import sys
+import time
+from collections import Counter, defaultdict
+from pathlib import Path
+
+SPECIAL_TOKENS = ["<pad>", "<unk>", "<sos>", "<eos>"]
+END = "</w>"  # end of word marker of the symbols during the training and in the merges file
+CONTINUE = "@@"  # suffix of the subwords which do not end a word in the vocab file
+
+
+def merges_path(path_to_vocab_file):
+    """Merges file of a subword vocab file"""
+    path_to_vocab_file = Path(path_to_vocab_file)
+    return path_to_vocab_file.with_name(path_to_vocab_file.stem + "_merges.txt")
+
+
+def read_sentences(path_to_sentences):
+    """
+    :param path_to_sentences: csv file with a "text" column, or text file with ID Sentence per line
+    :return: list of sentences
+    """
+    with open(path_to_sentences, encoding='utf-8') as f:
+        if Path(path_to_sentences).suffix == ".csv":
+            return [row["text"] for row in csv.DictReader(f)]
+        # the first element of each line is the ID
+        return [line.strip().partition(" ")[2] for line in f]
+
+
+def word_symbols(word):
+    """Characters of a word, the last one with the end of word marker"""
+    return list(word[:-1]) + [word[-1] + END]
+
+
+def to_token(symbol):
+    """Vocab file token of a symbol: "ing</w>" -> "ing", "walk" -> "walk@@\""""
+    if symbol.endswith(END):
+        return symbol[:-len(END)]
+    return symbol + CONTINUE
+
+
+def merge_pair(symbols, pair):
+    """Replace each occurrence of pair in symbols (left to right) by the merged symbol"""
+    merged = []
+    idx = 0
+    while idx < len(symbols):
+        if idx + 1 < len(symbols) and symbols[idx] == pair[0] and symbols[idx + 1] == pair[1]:
+            merged.append(pair[0] + pair[1])
+            idx += 2
+        else:
+            merged.append(symbols[idx])
+            idx += 1
+    return merged
+
+
+def learn_merges(word_counts, num_merges, min_frequency=2):
+    """
+    Learn the BPE merges, the pair counts are updated only for the words containing the merged pair
+    :param word_counts: dictionary word -> frequency
+    :param num_merges: maximum amount of merges
+    :param min_frequency: stop when the most frequent pair occurs less often
+    :return: list of merged pairs in training order
+    """
+    words = [word_symbols(word) for word in word_counts]
+    frequencies = list(word_counts.values())
+    pair_counts = Counter()
+    pair_words = defaultdict(set)
+    for idx, symbols in enumerate(words):
+        for pair in zip(symbols, symbols[1:]):
+            pair_counts[pair] += frequencies[idx]
+            pair_words[pair].add(idx)
+    # most frequent pair first, ties by the pair itself, outdated entries are skipped when popped
+    heap = [(-count, pair) for pair, count in pair_counts.items()]
+    heapq.heapify(heap)
+
+    merges = []
+    while heap and len(merges) < num_merges:
+        count, pair = heapq.heappop(heap)
+        if -count != pair_counts[pair]:
+            continue
+        if -count < min_frequency:
+            break
+        merges.append(pair)
+        changed = set()
+        for idx in pair_words.pop(pair):
+            symbols = words[idx]
+            frequency = frequencies[idx]
+            for old in zip(symbols, symbols[1:]):
+                pair_counts[old] -= frequency
+                changed.add(old)
+            symbols = merge_pair(symbols, pair)
+            for new in zip(symbols, symbols[1:]):
+                pair_counts[new] += frequency
+                pair_words[new].add(idx)
+                changed.add(new)
+            words[idx] = symbols
+        for changed_pair in changed:
+            if pair_counts[changed_pair] > 0:
+                heapq.heappush(heap, (-pair_counts[changed_pair], changed_pair))
+    return merges
+
+
+def train(sentences, vocab_size, min_frequency=2):
+    """
+    :param sentences: texts, words separated by spaces
+    :param vocab_size: size of the vocab including SPECIAL_TOKENS and the characters
+    :return: vocab tokens, merges
+    """
+    word_counts = Counter(word for sentence in sentences for word in sentence.split(" ") if word)
+    characters = sorted({symbol for word in word_counts for symbol in word_symbols(word)})
+    num_merges = vocab_size - len(SPECIAL_TOKENS) - len(characters)
+    if num_merges < 0:
+        print("vocab_size %d is smaller than the %d characters, using characters only" % (vocab_size,
+                                                                                         len(characters)))
+    merges = learn_merges(word_counts, max(num_merges, 0), min_frequency)
+    # a subword can be merged from different pairs, it is in the vocab once
+    tokens = list(dict.fromkeys(SPECIAL_TOKENS + [to_token(symbol) for symbol in characters] +
+                                [to_token(left + right) for left, right in merges]))
+    return tokens, merges
+
+
+def save(path_to_vocab_file, tokens, merges):
+    """Write the vocab file and its merges file"""
+    with open(path_to_vocab_file, 'w') as f:
+        for token in tokens:
+            f.write("%s\n" % token)
+    with open(merges_path(path_to_vocab_file), 'w') as f:
+        for left, right in merges:
+            f.write("%s %s\n" % (left, right))
+
+
+class BytePairEncoding:
+    """
+    usage:
+        bpe = BytePairEncoding.load(merges_path(path_to_vocab_file))
+        bpe.segment("walking")  # ["walk@@", "ing"]
+        bpe.join(["walk@@", "ing"])  # ["walking"]
+    """
+
+    def __init__(self, merges):
+        """
+        :param merges: merged pairs in training order
+        """
+        self.ranks = {tuple(pair): rank for rank, pair in enumerate(merges)}
+        # word -> subwords, the vocabulary of the sentences is small
+        self.cache = {}
+
+    def __len__(self):
+        return len(self.ranks)
+
+    @classmethod
+    def load(cls, path_to_merges):
+        with open(path_to_merges, encoding='utf-8') as f:
+            return cls(line.split() for line in f if line.strip())
+
+    def segment(self, word):
+        """
+        Subwords of a word, the merges are applied in training order
+        :return: list of vocab file tokens
+        """
+        if word in self.cache:
+            return self.cache[word]
+        if not word:
+            return [word]
+        symbols = word_symbols(word)
+        while len(symbols) > 1:
+            pair = min(zip(symbols, symbols[1:]), key=lambda pair: self.ranks.get(pair, len(self.ranks)))
+            if pair not in self.ranks:
+                break
+            symbols = merge_pair(symbols, pair)
+        self.cache[word] = [to_token(symbol) for symbol in symbols]
+        return self.cache[word]
+
+    @staticmethod
+    def join(tokens):
+        """Words of a list of subwords, a subword with @@ is joined with the next one"""
+        text = " ".join(tokens).replace(CONTINUE + " ", "")
+        if text.endswith(CONTINUE):
+            text = text[:-len(CONTINUE)]
+        return text.split(" ") if text else []
+
+
+if __name__ == '__main__':
+    # target vocab file, size of the vocab and sentence files
+    if len(sys.argv) > 3:
+        path_to_vocab_file = sys.argv[1]
+        vocab_size = int(sys.argv[2])
+        paths_to_sentences = sys.argv[3:]
+    else:
+        print("Set path to the target vocab file, the vocab size and the files containing sentences")
+        sys.exit()
+
+    start_time = time.time()
+    all_sentences = []
+    for path in paths_to_sentences:
+        all_sentences.extend(read_sentences(path))
+    vocab_tokens, vocab_merges = train(all_sentences, vocab_size)
+    save(path_to_vocab_file, vocab_tokens, vocab_merges)
+    print("Subwords (incl. PAD/UNK/SOS/EOS): %d, merges: %d" % (len(vocab_tokens), len(vocab_merges)))
+    print("--- %.4s seconds ---" % (time.time() - start_time))
@@ -0,0 +1,79 @@
+"""test_normalization_stats.py: missing joints of the normalization variants, cache of the stats
+
+usage:
+python -m pytest test_normalization_stats.py
+"""
+
+import time
+
+import numpy as np
+import pandas as pd
+
+try:
+    from keypoints2text.kp_to_text_real_data.keypoint_store import KeypointStoreWriter, NUM_JOINTS
+    from keypoints2text.kp_to_text_real_data.normalization_stats import NormalizationStats
+    from keypoints2text.kp_to_text_real_data.data_loader import TextKeypointsDataset
+    from keypoints2text.kp_to_text_real_data.feature_spec import DEFAULT_FEATURES
+except ImportError:  # server uses different imports than local
+    from keypoint_store import KeypointStoreWriter, NUM_JOINTS
+    from normalization_stats import NormalizationStats
+    from data_loader import TextKeypointsDataset
+    from feature_spec import DEFAULT_FEATURES
+
+CLIP_IDS = ["vid0000000_1-1-rgb_front", "vid0000001_1-1-rgb_front", "vid0000002_1-2-rgb_front"]
+
+
+def write_store(path, seed=0):
+    """Store of three clips of two speakers, about 10% of the joints are not detected (0.0)"""
+    rng = np.random.default_rng(seed)
+    clips = {}
+    with KeypointStoreWriter(path) as writer:
+        for clip_id, num_frames in zip(CLIP_IDS, (5, 9, 7)):
+            clip = rng.uniform(1, 700, size=(num_frames, NUM_JOINTS, 3)).astype(np.float32)
+            clip[rng.random(clip.shape[:2]) < 0.1] = 0.0
+            writer.add_clip(clip_id, clip)
+            clips[clip_id] = clip
+    return clips
+
+
+def test_raw_variant_missing_joints_are_nan(tmp_path):
+    clips = write_store(tmp_path / "store")
+    stats = NormalizationStats.load_or_compute(tmp_path / "store", "speaker_raw")
+    for clip_id, clip in clips.items():
+        normalized = stats.transform(clip_id, clip)
+        undetected = (clip[:, :, 0] == 0) & (clip[:, :, 1] == 0)
+        assert np.isnan(normalized[undetected, :2]).all()
+        assert not np.isnan(normalized[~undetected, :2]).any()
+
+
+def test_store_rewritten_in_place(tmp_path):
+    write_store(tmp_path / "store")
+    before = NormalizationStats.load_or_compute(tmp_path / "store", "global_raw")
+    # same clips and frame counts, other keypoints, written after the mtime resolution of the file system
+    time.sleep(0.05)
+    clips = write_store(tmp_path / "store", seed=1)
+    after = NormalizationStats.load_or_compute(tmp_path / "store", "global_raw")
+    expected = NormalizationStats.compute(tmp_path / "store", "global_raw")
+    clip_id = CLIP_IDS[0]
+    assert np.array_equal(after.transform(clip_id, clips[clip_id]), expected.transform(clip_id, clips[clip_id]),
+                          equal_nan=True)
+    assert not np.array_equal(after.transform(clip_id, clips[clip_id]), before.transform(clip_id, clips[clip_id]),
+                              equal_nan=True)
+
+
+def test_raw_variant_validity(tmp_path):
+    clips = write_store(tmp_path / "store")
+    pd.DataFrame({"keypoints": CLIP_IDS, "text": ["hello world"] * len(CLIP_IDS)}).to_csv(tmp_path / "kp.csv",
+                                                                                         index=False)
+    with open(tmp_path / "vocab.txt", "w") as f:
+        f.write("<pad>\n<unk>\n<sos>\n<eos>\nhello\nworld\n")
+    dataset = TextKeypointsDataset(tmp_path / "store", tmp_path / "kp.csv", tmp_path / "vocab.txt",
+                                   DEFAULT_FEATURES.size, normalization="speaker_raw", return_validity=True)
+    for index, clip_id in enumerate(CLIP_IDS):
+        _, _, validity = dataset[index]
+        expected = ~np.isnan(DEFAULT_FEATURES.apply(np.where(clips[clip_id] == 0, np.nan, clips[clip_id]),
+                                                    decoded=False))
+        # the 6 padding values are 0.0, not missing
+        expected[:, -DEFAULT_FEATURES.padding:] = True
+        assert np.array_equal(validity.numpy(), expected)
+        assert not validity.numpy().all()
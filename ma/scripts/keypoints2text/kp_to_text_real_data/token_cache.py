@@ -0,0 +1,103 @@
+"""token_cache.py: sentences of a csv file tokenized once into int32 word ids
+
+All sentences of the csv file are turned into word ids with Vocabulary.encode_batch (split on spaces, unknown words
+are <unk>), framed by <sos> and <eos>, and kept in one int32 array with offsets and lengths per row. The result is
+written next to the csv file and reused by later runs and by the data loader workers:
+    <dir of the csv file>/token_cache/<csv name>_<key>.npz
+The key is a hash of the content of the csv and the vocab file (and the merges file of a subword vocab, see
+subword.py), an edited csv or vocab file is tokenized again.
+
+usage:
+    tokens = TokenCache.load_or_build(path_to_csv, sentences, path_to_vocab_file)
+    ids = tokens.get(index)  # int32 array: <sos> ... <eos>
+"""
+
+import hashlib
+import os
+from pathlib import Path
+import numpy as np
+
+try:
+    from keypoints2text.kp_to_text_real_data.vocabulary import Vocabulary
+    from keypoints2text.kp_to_text_real_data.subword import merges_path
+except ImportError:  # server uses different imports than local
+    from vocabulary import Vocabulary
+    from subword import merges_path
+
+CACHE_DIR = "token_cache"
+
+
+class TokenCache:
+
+    def __init__(self, ids, offsets, lengths):
+        """
+        :param ids: int32 array, the ids of all sentences
+        :param offsets: first id of each sentence
+        :param lengths: amount of ids of each sentence
+        """
+        self.ids = ids
+        self.offsets = offsets
+        self.lengths = lengths
+
+    def __len__(self):
+        return len(self.lengths)
+
+    @classmethod
+    def build(cls, sentences, vocab):
+        """
+        :param sentences: text of each row of the csv file
+        :param vocab: Vocabulary, must contain <sos> and <eos>
+        """
+        indexes = vocab.encode_batch(list(sentences), sos_eos=True)
+        lengths = np.asarray([len(sentence) for sentence in indexes], dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+        ids = np.concatenate(indexes) if indexes else np.zeros(0, dtype=np.int32)
+        return cls(ids, offsets, lengths)
+
+    def save(self, path):
+        """Write the cache into a .npz file, via a temporary file"""
+        temp_path = Path(str(path) + ".tmp")
+        with open(temp_path, "wb") as f:
+            np.savez(f, ids=self.ids, offsets=self.offsets, lengths=self.lengths)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data["ids"], data["offsets"], data["lengths"])
+
+    @classmethod
+    def load_or_build(cls, path_to_csv, sentences, path_to_vocab_file, vocab=None):
+        """
+        Load the tokenized sentences of a csv file, tokenize and save them if there is no cache yet
+        :param sentences: text column of the csv file
+        :param vocab: Vocabulary of path_to_vocab_file, Vocabulary.load(path_to_vocab_file) if None
+        """
+        path = cache_path(path_to_csv, path_to_vocab_file)
+        if os.path.isfile(path):
+            return cls.load(path)
+        if vocab is None:
+            vocab = Vocabulary.load(path_to_vocab_file)
+        tokens = cls.build(sentences, vocab)
+        os.makedirs(path.parent, exist_ok=True)
+        tokens.save(path)
+        return tokens
+
+    def get(self, index):
+        """Ids of the sentence in row index: <sos>, words, <eos>"""
+        return self.ids[self.offsets[index]:self.offsets[index] + self.lengths[index]]
+
+
+def cache_path(path_to_csv, path_to_vocab_file):
+    """Cache file of a csv file, named after the hash of the csv and the vocab file (and its merges file)"""
+    content_hash = hashlib.sha1()
+    paths = [path_to_csv, path_to_vocab_file]
+    if os.path.isfile(merges_path(path_to_vocab_file)):
+        paths.append(merges_path(path_to_vocab_file))
+    for path in paths:
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                content_hash.update(block)
+        content_hash.update(b"\0")
+    path_to_csv = Path(path_to_csv)
+    return path_to_csv.parent / CACHE_DIR / ("%s_%s.npz" % (path_to_csv.stem, content_hash.hexdigest()[:16]))
@@ -0,0 +1,128 @@
+"""vocabulary.py: the words of a vocab file (one word per line, the line number is the id), loaded once
+
+Vocabulary.load(path) reads a vocab file once per process and returns the same object for each further call with that
+file (reloaded if the file changed), the dataset, the trainers and the evaluation share it instead of reading the file
+for each lookup. The ids of the special words (<pad>, <sos>, <eos>, <unk>) are attributes.
+
+encode_batch splits sentences on spaces and maps them to int32 ids with one sorted lookup (np.searchsorted) over all
+words of the batch, unknown words are <unk>. decode_batch maps ids to words with one table lookup and drops <pad> and
+<eos>, ids outside the vocab become their number as text (as DataUtils.int2text).
+
+A subword vocab file (see subword.py, the merges file is next to it) splits the words into subwords before the lookup,
+decode_batch joins the subwords back into words.
+
+usage:
+    vocab = Vocabulary.load(path_to_vocab_file)
+    ids = vocab.encode_batch(["a sentence", "another one"], sos_eos=True)  # list of int32 arrays
+    words = vocab.decode_batch(target_tensor.tolist())  # list of lists of words
+    criterion = nn.CrossEntropyLoss(ignore_index=vocab.pad_id)
+"""
+
+import os
+import numpy as np
+
+try:
+    from keypoints2text.kp_to_text_real_data.subword import BytePairEncoding, merges_path
+except ImportError:  # server uses different imports than local
+    from subword import BytePairEncoding, merges_path
+
+# path -> (size and mtime of the vocab file and its merges file, Vocabulary)
+_loaded = {}
+
+
+class Vocabulary:
+
+    def __init__(self, words, bpe=None):
+        """
+        :param words: word (or subword) of each id
+        :param bpe: BytePairEncoding of a subword vocab, None for whole words
+        """
+        self.bpe = bpe
+        # id -> word
+        self.words = np.asarray(list(words), dtype=np.str_)
+        # word -> id, the last id of a word which occurs several times (as DataUtils.vocab_word2int)
+        self.word2int = {word: idx for idx, word in enumerate(self.words.tolist())}
+        self.sorted_words = np.asarray(sorted(self.word2int), dtype=np.str_)
+        self.sorted_ids = np.asarray([self.word2int[word] for word in self.sorted_words.tolist()], dtype=np.int32)
+
+        # <unk> is 1 if the vocab file has no <unk> (as DataUtils.text2index)
+        self.unk_id = self.word2int.get("<unk>", 1)
+        self.pad_id = self.word2int.get("<pad>", self.unk_id)
+        self.sos_id = self.word2int.get("<sos>", self.unk_id)
+        self.eos_id = self.word2int.get("<eos>", self.unk_id)
+        self.stripped_ids = np.asarray([self.word2int[word] for word in ("<pad>", "<eos>") if word in self.word2int],
+                                       dtype=np.int64)
+
+    def __len__(self):
+        return len(self.words)
+
+    def __contains__(self, word):
+        return word in self.word2int
+
+    @classmethod
+    def load(cls, path_to_vocab_file):
+        """Vocabulary of a vocab file, read once per process and file version"""
+        path = os.path.abspath(path_to_vocab_file)
+        path_to_merges = merges_path(path)
+        version = tuple((stat.st_size, stat.st_mtime_ns) for stat in
+                        [os.stat(path)] + ([os.stat(path_to_merges)] if os.path.isfile(path_to_merges) else []))
+        if path not in _loaded or _loaded[path][0] != version:
+            bpe = BytePairEncoding.load(path_to_merges) if len(version) > 1 else None
+            with open(path) as f:
+                _loaded[path] = (version, cls((line.strip() for line in f), bpe))
+        return _loaded[path][1]
+
+    @property
+    def int2word(self):
+        """Dictionary id -> word, e.g. for DataUtils.int2text"""
+        return dict(enumerate(self.words.tolist()))
+
+    def encode_batch(self, sentences, sos_eos=False):
+        """
+        :param sentences: texts, words separated by single spaces
+        :param sos_eos: frame each sentence with <sos> and <eos>
+        :return: list of int32 arrays, one per sentence
+        """
+        split = [sentence.split(" ") for sentence in sentences]
+        if self.bpe is not None:
+            split = [[subword for word in sentence for subword in self.bpe.segment(word)] for sentence in split]
+        words = np.asarray([word for sentence in split for word in sentence], dtype=np.str_)
+        ids = np.full(len(words), self.unk_id, dtype=np.int32)
+        if len(words) and len(self.sorted_words):
+            position = np.minimum(np.searchsorted(self.sorted_words, words), len(self.sorted_words) - 1)
+            known = self.sorted_words[position] == words
+            ids[known] = self.sorted_ids[position[known]]
+        sentences_ids = np.split(ids, np.cumsum([len(sentence) for sentence in split])[:-1])
+        if sos_eos:
+            sos = np.asarray([self.sos_id], dtype=np.int32)
+            eos = np.asarray([self.eos_id], dtype=np.int32)
+            return [np.concatenate([sos, sentence, eos]) for sentence in sentences_ids]
+        return sentences_ids
+
+    def encode(self, sentence, sos_eos=False):
+        """Ids of one sentence, see encode_batch"""
+        return self.encode_batch([sentence], sos_eos)[0]
+
+    def decode_batch(self, batch):
+        """
+        :param batch: ids of each sentence, e.g. a (batch, ids) array or a list of lists
+        :return: list of lists of words, without <pad> and <eos>, subwords are joined into words
+        """
+        if len(batch) == 0:
+            return []
+        lengths = [len(ids) for ids in batch]
+        ids = np.concatenate([np.asarray(ids, dtype=np.int64).reshape(-1) for ids in batch])
+        known = (ids >= 0) & (ids < len(self.words))
+        words = self.words[np.where(known, ids, 0)].astype(object)
+        if not known.all():
+            words[~known] = ids[~known].astype(str)
+        keep = ~np.isin(ids, self.stripped_ids)
+        decoded = [part[mask].tolist() for part, mask in zip(np.split(words, np.cumsum(lengths)[:-1]),
+                                                             np.split(keep, np.cumsum(lengths)[:-1]))]
+        if self.bpe is not None:
+            return [self.bpe.join(sentence) for sentence in decoded]
+        return decoded
+
+    def decode(self, ids):
+        """Words of one sentence, see decode_batch"""
+        return self.decode_batch([ids])[0]
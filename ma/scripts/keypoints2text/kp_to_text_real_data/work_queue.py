@@ -0,0 +1,247 @@
+"""work_queue.py: work queue on a shared filesystem, no lock service needed
+
+Several processes, also on different hosts sharing an NFS mount, work on disjoint chunks of a list of items. All
+state is kept in files below the queue directory and every state change is a single os.rename, which is atomic on
+local filesystems and on NFS. Of several processes renaming the same file exactly one succeeds.
+
+<queue>/
+    queue.json                      chunk count and job information, written before the queue becomes visible
+    todo/chunk_00000.json           items of a chunk nobody claimed yet
+    claimed/chunk_00000@worker      lease of a worker, the mtime is the time of the last renewal
+    done/chunk_00000.json           result of a finished chunk
+    merging@worker                  lease of the worker merging the results
+
+- claim: rename todo/<chunk> -> claimed/<chunk>@<worker>
+- renew: touch the lease file, a worker whose lease file is gone lost the chunk to another worker
+- expiry: a lease not renewed within lease_seconds is taken over by renaming it to claimed/<chunk>@<new worker>
+- complete: rename the lease to <lease>.finished (fails if it was taken over), write done/<chunk>.json and delete
+  the finished lease
+- merge: after all chunks are done one worker renames queue.json to merging@<worker> and merges the results
+
+Lease times are compared with the clock of the file server (mtime of a freshly touched file), not the local clock.
+
+usage:
+    queue = WorkQueue(path)
+    queue.create(items, chunk_size, info)  # returns False if another process created the queue first
+    claimed = queue.claim()
+    while claimed is not None:
+        chunk, items = claimed
+        ...  # call queue.renew(chunk) regularly, stop if it returns False
+        queue.complete(chunk, result)
+        claimed = queue.claim()
+    if queue.pending() == 0 and queue.claim_merge():
+        ...  # merge queue.results()
+        queue.remove()
+"""
+
+import json
+import os
+import shutil
+import socket
+import uuid
+from pathlib import Path
+
+try:
+    from keypoints2text.kp_to_text_real_data.keypoint_store import write_json_atomic
+except ImportError:  # server uses different imports than local
+    from keypoint_store import write_json_atomic
+
+
+class WorkQueue:
+
+    def __init__(self, path_to_queue, worker_id=None, lease_seconds=600):
+        """
+        :param path_to_queue: queue directory on the shared filesystem
+        :param worker_id: unique name of this process, default <host>-<pid>
+        :param lease_seconds: a claimed chunk whose lease was not renewed for this long is handed to another worker
+        """
+        self.path_to_queue = Path(path_to_queue)
+        if worker_id is None:
+            worker_id = "%s-%d" % (socket.gethostname(), os.getpid())
+        self.worker_id = worker_id.replace("@", "_").replace(os.sep, "_")
+        self.lease_seconds = lease_seconds
+
+    def exists(self):
+        return os.path.isdir(self.path_to_queue)
+
+    def create(self, items, chunk_size, info=None):
+        """
+        Split the items into chunks and create the queue. The queue is built in a temporary directory and renamed,
+        so other processes see either no queue or a complete one.
+        :param items: list of json serializable items
+        :param chunk_size: items per chunk
+        :param info: json serializable information about the job, see info()
+        :return: True if this process created the queue, False if it existed already
+        """
+        temp_path = Path("%s.%s.%s" % (self.path_to_queue, self.worker_id, uuid.uuid4().hex[:8]))
+        for state in ("todo", "claimed", "done"):
+            os.makedirs(temp_path / state)
+        num_chunks = 0
+        for start in range(0, len(items), chunk_size):
+            write_json_atomic(temp_path / "todo" / ("chunk_%05d.json" % num_chunks), items[start:start + chunk_size])
+            num_chunks += 1
+        write_json_atomic(temp_path / "queue.json", {"num_chunks": num_chunks, "info": info})
+        try:
+            os.rename(temp_path, self.path_to_queue)
+        except OSError:  # another process was faster
+            shutil.rmtree(temp_path, ignore_errors=True)
+            return False
+        return True
+
+    def info(self):
+        """Job information passed to create()"""
+        return self.read_queue_json()["info"]
+
+    def num_chunks(self):
+        return self.read_queue_json()["num_chunks"]
+
+    def read_queue_json(self):
+        for name in ["queue.json"] + self.list_files(self.path_to_queue, "merging@"):
+            try:
+                with open(self.path_to_queue / name) as f:
+                    return json.load(f)
+            except FileNotFoundError:  # renamed by a merging worker in between
+                continue
+        raise FileNotFoundError("No queue.json in %s" % self.path_to_queue)
+
+    def claim(self):
+        """
+        Claim an unclaimed chunk, or a chunk whose lease expired
+        :return: (chunk name, items of the chunk) or None if no chunk is left
+        """
+        for file_name in self.list_files(self.path_to_queue / "todo"):
+            chunk = file_name[:-len(".json")]
+            lease_path = self.lease_path(chunk)
+            try:
+                os.rename(self.path_to_queue / "todo" / file_name, lease_path)
+            except FileNotFoundError:  # claimed by another worker
+                continue
+            if self.renew(chunk):
+                return chunk, read_json(lease_path)
+
+        try:
+            now = self.server_time()
+        except FileNotFoundError:  # merged and removed by another worker
+            return None
+        for lease_name in self.list_files(self.path_to_queue / "claimed"):
+            lease = self.path_to_queue / "claimed" / lease_name
+            try:
+                expired = now - os.stat(lease).st_mtime > self.lease_seconds
+            except FileNotFoundError:
+                continue
+            if not expired:
+                continue
+            chunk = lease_name.split("@")[0]
+            try:
+                os.rename(lease, self.lease_path(chunk))
+            except FileNotFoundError:  # renewed under a new name or taken over by another worker
+                continue
+            if self.renew(chunk):
+                print("Took over %s from %s, its lease expired" % (chunk, lease_name.split("@", 1)[1]))
+                return chunk, read_json(self.lease_path(chunk))
+        return None
+
+    def renew(self, chunk):
+        """
+        Renew the lease of a claimed chunk
+        :return: False if the lease was taken over by another worker
+        """
+        try:
+            os.utime(self.lease_path(chunk))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def complete(self, chunk, result):
+        """
+        Store the result of a claimed chunk
+        :param result: json serializable result
+        :return: False if the lease was taken over by another worker, the result is dropped then
+        """
+        # a worker dying before the result is written leaves the finished lease, it expires like any other lease
+        finished_path = Path(str(self.lease_path(chunk)) + ".finished")
+        try:
+            os.rename(self.lease_path(chunk), finished_path)
+        except FileNotFoundError:
+            return False
+        write_json_atomic(self.path_to_queue / "done" / (chunk + ".json"), result)
+        try:
+            os.remove(finished_path)
+        except FileNotFoundError:  # expired while the result was written, the other worker overwrites the result
+            pass
+        return True
+
+    def pending(self):
+        """Amount of chunks which are not done yet, 0 if the queue was merged and removed already"""
+        try:
+            return self.num_chunks() - len(self.list_files(self.path_to_queue / "done"))
+        except FileNotFoundError:
+            return 0
+
+    def results(self):
+        """
+        Results of all finished chunks
+        :return: list of (chunk name, result) in chunk order
+        """
+        return [(file_name[:-len(".json")], read_json(self.path_to_queue / "done" / file_name))
+                for file_name in self.list_files(self.path_to_queue / "done")]
+
+    def claim_merge(self):
+        """
+        Claim the merge of the results, the lease of a merging worker expires like the lease of a chunk
+        :return: True if this process has to merge the results
+        """
+        merging_path = self.path_to_queue / ("merging@" + self.worker_id)
+        try:
+            os.rename(self.path_to_queue / "queue.json", merging_path)
+            os.utime(merging_path)  # the mtime of queue.json is the creation time of the queue
+            return True
+        except FileNotFoundError:
+            pass
+        try:
+            now = self.server_time()
+        except FileNotFoundError:
+            return False
+        for lease_name in self.list_files(self.path_to_queue, "merging@"):
+            lease = self.path_to_queue / lease_name
+            try:
+                if now - os.stat(lease).st_mtime <= self.lease_seconds:
+                    continue
+                os.rename(lease, merging_path)
+                os.utime(merging_path)
+                return True
+            except FileNotFoundError:
+                continue
+        return False
+
+    def remove(self):
+        """Delete the queue after the results were merged"""
+        removed_path = Path("%s.removed.%s" % (self.path_to_queue, self.worker_id))
+        os.rename(self.path_to_queue, removed_path)
+        shutil.rmtree(removed_path, ignore_errors=True)
+
+    def lease_path(self, chunk):
+        return self.path_to_queue / "claimed" / ("%s@%s" % (chunk, self.worker_id))
+
+    def server_time(self):
+        """Current time of the file server, the mtime of a freshly touched file"""
+        clock_path = self.path_to_queue / (".clock@" + self.worker_id)
+        with open(clock_path, "w"):
+            pass
+        now = os.stat(clock_path).st_mtime
+        os.remove(clock_path)
+        return now
+
+    def list_files(self, path, prefix=""):
+        """Sorted names of the files in path, temporary and hidden files are skipped"""
+        try:
+            names = os.listdir(path)
+        except FileNotFoundError:
+            return []
+        return sorted(name for name in names if name.startswith(prefix) and not name.startswith(".")
+                      and not name.endswith(".tmp"))
+
+
+def read_json(path):
+    with open(path) as f:
+        return json.load(f)
@@ -7,7 +7,7 @@ Tasks:
     - read numpy file of dataset (train, val or test)
     - print confidence level for
         - pose, face, hand_l/r
-    -
+    - numpy file may also be a keypoint store directory, the confidences are then read from the memory mapped array
 
 """
 
@@ -17,6 +17,11 @@ import sys
 from pathlib import Path
 import json
 
+try:
+    from keypoints2text.kp_to_text_real_data.keypoint_store import open_store, is_keypoint_store, key_slices
+except ImportError:  # server uses different imports than local
+    from keypoint_store import open_store, is_keypoint_store, key_slices
+
 
 class ConfidenceAnalysis:
 
@@ -33,6 +38,11 @@ class ConfidenceAnalysis:
 
     def get_confidence(self):
         """ load from .npy file """
+        if is_keypoint_store(self.path_to_numpy_file):
+            self.get_confidence_store()
+            self.save_confidence()
+            return
+
         kp_files = np.load(self.path_to_numpy_file).item()
 
         df_kp = pd.DataFrame(kp_files.keys(), columns=["keypoints"])
@@ -48,6 +58,25 @@ class ConfidenceAnalysis:
         for k in self.keys:
             self.confidences[k] = np.mean(self.confidences[k])
 
+        self.save_confidence()
+
+    def get_confidence_store(self, chunk_size=100000):
+        """
+        Mean confidence per key from a keypoint store, read in chunks of frames so memory stays bounded
+        Same result as get_confidence: each frame has the same number of joints per key
+        """
+        store = open_store(self.path_to_numpy_file)
+        sums = {k: 0.0 for k in self.keys}
+        num_frames = 0
+        for chunk in store.iter_frame_chunks(chunk_size):
+            chunk = np.asarray(chunk[:, :, 2], dtype=np.float64)
+            num_frames += chunk.shape[0]
+            for k, part in key_slices().items():
+                sums[k] += chunk[:, part].mean(axis=1).sum()
+        for k in self.keys:
+            self.confidences[k] = sums[k] / num_frames if num_frames else float("nan")
+
+    def save_confidence(self):
         print(self.path_to_numpy_file)
         print(self.confidences)
 
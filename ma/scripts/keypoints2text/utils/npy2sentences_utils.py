@@ -2,12 +2,15 @@
 
 npy2sentences_utils.py path_to_npy_file path_to_sentence_file path_to_target_folder
 
-path_to_npy_file: set path to the .npy file containing all the train, val or test data
+path_to_npy_file: set path to the .npy file (or keypoint store directory) containing all the train, val or test data
 path_to_sentence_file: set path to transformed (cleaned, processed) .txt-file containing all sentences
 e.g. how2sign.train.id_transformed.txt
     - e.g. a line in the file: ad4_GWc5XRo_10 one two three
 path_to_target_folder where the new file should be saved to
 
+If the store (or the directory of the .npy file) contains a clip catalog (catalog.sqlite, see clip_catalog.py), the
+clip ids and sentence ids are read from the catalog and the keypoints are not loaded at all.
+
 """
 
 import pandas as pd
@@ -15,6 +18,13 @@ import numpy as np
 import sys
 from pathlib import Path
 
+try:
+    from keypoints2text.kp_to_text_real_data.keypoint_store import open_store, is_keypoint_store
+    from keypoints2text.kp_to_text_real_data.clip_catalog import open_catalog, parse_clip_id
+except ImportError:  # server uses different imports than local
+    from keypoint_store import open_store, is_keypoint_store
+    from clip_catalog import open_catalog, parse_clip_id
+
 
 class NpyToSentence:
 
@@ -30,8 +40,7 @@ class NpyToSentence:
 
     def keypoints2sentence(self):
         """ load from .npy file """
-        kp_files = np.load(self.path_to_numpy_file).item()
-        df_kp = pd.DataFrame(kp_files.keys(), columns=["keypoints"])
+        df_kp = pd.DataFrame(self.get_clips(), columns=["keypoints", "sentence_id"])
         kp2sentence = []
 
         d = {'keypoints': [], 'text': []}
@@ -43,8 +52,7 @@ class NpyToSentence:
 
         speaker = []
         counter = 0
-        for kp in df_kp["keypoints"]:
-            vid_speaker = kp[:11] + kp[11:].split('-')[0]
+        for kp, vid_speaker in zip(df_kp["keypoints"], df_kp["sentence_id"]):
             speaker.append(vid_speaker)
             for idx in range(len(df_text['keypoints'])):
                 if vid_speaker in df_text['keypoints'][idx]:
@@ -57,6 +65,21 @@ class NpyToSentence:
         df_kp_text_train = pd.DataFrame(kp2sentence, columns=["keypoints", "text"])
         df_kp_text_train.to_csv(self.path_to_target / str(str(self.path_to_csv.name) + "_2npy.txt"), index=False)
 
+    def get_clips(self):
+        """
+        Clip ids and their sentence ids, from the clip catalog if there is one
+        :return: list of [clip id, sentence id]
+        """
+        catalog = open_catalog(self.path_to_numpy_file)
+        if catalog is not None and len(catalog):
+            with catalog:
+                return catalog.select(("clip_id", "sentence_id"))
+        if is_keypoint_store(self.path_to_numpy_file):
+            kp_files = open_store(self.path_to_numpy_file)  # only the clip index is read
+        else:
+            kp_files = np.load(self.path_to_numpy_file).item()
+        return [[kp, parse_clip_id(kp)[3]] for kp in kp_files.keys()]
+
 
 if __name__ == '__main__':
     # file with sentences